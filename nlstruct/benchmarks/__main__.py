@@ -0,0 +1,5 @@
+import sys
+
+from nlstruct.benchmarks.batcher import main
+
+sys.exit(main())
@@ -0,0 +1,209 @@
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import scipy
+import torch
+
+from nlstruct.benchmarks.synthetic import make_synthetic_batcher
+from nlstruct.core.batcher import Batcher, factorize
+
+BENCHMARKS = ["getitem", "query_ids", "factorize", "switch_foreign_ids_mode", "densify", "sparsify", "concat"]
+
+
+def measure(fn, repeat=5, min_time=0.05):
+    """
+    Time a function, calling it enough times per repetition for the repetition to last at least `min_time` seconds
+
+    Parameters
+    ----------
+    fn: callable
+    repeat: int
+    min_time: float
+
+    Returns
+    -------
+    dict
+        Number of calls per repetition and best / median / mean time of a call in seconds
+    """
+    start = time.perf_counter()
+    fn()
+    first = time.perf_counter() - start
+    number = max(1, int(min_time / first)) if first > 0 else 1000
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+    return {"number": number, "repeat": repeat, "best": min(times), "median": float(np.median(times)), "mean": float(np.mean(times))}
+
+
+def make_cases(batcher, batch_size, seed=0):
+    """
+    Functions that run each benchmarked operation once on the given batcher
+    """
+    random = np.random.RandomState(seed)
+    n_samples = len(batcher)
+    prepared = batcher.prepare_for_indexing()
+    plan = prepared.compile_query_plan()
+    batch_ids = [random.randint(0, n_samples, batch_size) for _ in range(16)]
+    batches = [prepared.query_ids(ids, plan=plan) for ids in batch_ids]
+    dense_batches = [batch.densify() for batch in batches]
+    main_table = prepared.main_table
+    # Factorize the first foreign ids of the main table against their table, as query_ids does,
+    # or the tokens if the main table has no foreign ids
+    foreign_col, (foreign_table, _) = next(iter(prepared.foreign_ids.get(main_table, {}).items()), ("token", (None, None)))
+    factorize_kwargs = {
+        "values": prepared.tables[main_table][foreign_col],
+        "mask": prepared.tables[main_table][prepared.masks.get(main_table, {}).get(foreign_col, f"{foreign_col}_mask")],
+        "reference_values": prepared.tables[foreign_table][prepared.primary_ids[foreign_table]] if foreign_table is not None else None,
+        "reference_index": prepared.id_index(foreign_table) if foreign_table is not None else None,
+    }
+    counter = iter(range(1 << 62))
+
+    cases = {
+        # Views are lazy: the rows are only gathered when the tables are read
+        "getitem": lambda: prepared[batch_ids[next(counter) % len(batch_ids)]].gather(),
+        "query_ids": lambda: prepared.query_ids(batch_ids[next(counter) % len(batch_ids)], plan=plan),
+        "factorize": lambda: factorize(**factorize_kwargs),
+        "switch_foreign_ids_mode": lambda: batcher.switch_foreign_ids_mode("relative").switch_foreign_ids_mode("absolute"),
+        "densify": lambda: batches[next(counter) % len(batches)].densify(),
+        "sparsify": lambda: dense_batches[next(counter) % len(dense_batches)].sparsify(),
+        "concat": lambda: Batcher.concat(batches, allow_non_unique_primary_ids=True),
+    }
+    return cases
+
+
+def get_environment():
+    """
+    Description of the code and the machine that produced the results
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "date": datetime.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "torch": torch.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+    }
+
+
+def run_benchmarks(scales=(10000, 100000, 1000000), n_tables=(1, 3, 5), formats=("sparse", "dense"), benchmarks=None, batch_size=32,
+                   repeat=5, min_time=0.05, seed=0, verbose=1):
+    """
+    Run the benchmarks of the Batcher hot paths on synthetic batchers (see `make_synthetic_batcher`)
+
+    Parameters
+    ----------
+    scales: list of int
+        Numbers of samples of the synthetic batchers
+    n_tables: list of int
+        Numbers of linked tables
+    formats: list of str
+        "sparse" and/or "dense" columns
+    benchmarks: list of str
+        Subset of `BENCHMARKS` to run, defaults to all of them
+    batch_size: int
+        Number of samples of the queried batches
+    repeat: int
+    min_time: float
+        Minimum duration of a repetition in seconds
+    seed: int
+    verbose: int
+
+    Returns
+    -------
+    dict
+        {"environment": ..., "results": [{"benchmark", "n_samples", "n_tables", "format", "batch_size", "best", "median", ...}]}
+    """
+    benchmarks = benchmarks or BENCHMARKS
+    results = []
+    for n_samples in scales:
+        for n in n_tables:
+            for fmt in formats:
+                batcher = make_synthetic_batcher(n_samples, n_tables=n, sparse=fmt == "sparse", seed=seed)
+                cases = make_cases(batcher, batch_size=batch_size, seed=seed)
+                for name in benchmarks:
+                    result = {"benchmark": name, "n_samples": n_samples, "n_tables": n, "format": fmt, "batch_size": batch_size,
+                              **measure(cases[name], repeat=repeat, min_time=min_time)}
+                    results.append(result)
+                    if verbose:
+                        print(f"{name:>24} n_samples={n_samples:<8} n_tables={n} {fmt:<6} {result['best'] * 1000:10.3f}ms")
+                del batcher, cases
+    return {"environment": get_environment(), "results": results}
+
+
+def compare_results(old, new, threshold=1.2):
+    """
+    Compare two benchmark results (as returned by `run_benchmarks` or loaded from their json files)
+
+    Parameters
+    ----------
+    old: dict
+    new: dict
+    threshold: float
+        Ratio of the new and the old best times above which a benchmark is reported as a regression
+
+    Returns
+    -------
+    list of dict
+        The benchmarks of both results with their old / new times and their ratio, and whether they regressed
+    """
+    key_names = ("benchmark", "n_samples", "n_tables", "format", "batch_size")
+    old_results = {tuple(result[key] for key in key_names): result for result in old["results"]}
+    comparison = []
+    for result in new["results"]:
+        key = tuple(result[key] for key in key_names)
+        if key in old_results:
+            ratio = result["best"] / old_results[key]["best"]
+            comparison.append({**dict(zip(key_names, key)), "old": old_results[key]["best"], "new": result["best"], "ratio": ratio, "regression": ratio > threshold})
+    return comparison
+
+
+def main(args=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths of the Batcher on synthetic data")
+    parser.add_argument("--scales", type=int, nargs="+", default=[10000, 100000, 1000000], help="Numbers of samples")
+    parser.add_argument("--tables", type=int, nargs="+", default=[1, 3, 5], help="Numbers of linked tables")
+    parser.add_argument("--formats", nargs="+", default=["sparse", "dense"], choices=["sparse", "dense"])
+    parser.add_argument("--benchmarks", nargs="+", default=None, choices=BENCHMARKS)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.05, help="Minimum duration of a repetition in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Write the results to this json file")
+    parser.add_argument("--compare", default=None, help="Compare the results to those of this json file")
+    parser.add_argument("--threshold", type=float, default=1.2, help="Slowdown ratio reported as a regression")
+    args = parser.parse_args(args)
+
+    results = run_benchmarks(scales=args.scales, n_tables=args.tables, formats=args.formats, benchmarks=args.benchmarks, batch_size=args.batch_size,
+                             repeat=args.repeat, min_time=args.min_time, seed=args.seed)
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as file:
+            comparison = compare_results(json.load(file), results, threshold=args.threshold)
+        for item in comparison:
+            print(f"{item['benchmark']:>24} n_samples={item['n_samples']:<8} n_tables={item['n_tables']} {item['format']:<6} "
+                  f"{item['old'] * 1000:10.3f}ms -> {item['new'] * 1000:10.3f}ms x{item['ratio']:.2f}" + (" REGRESSION" if item["regression"] else ""))
+        if any(item["regression"] for item in comparison):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from nlstruct.core.batcher import Batcher
+
+
+def random_csr(random, n_rows, n_cols_max, values_fn, min_length=0):
+    """
+    Random CSR matrix whose rows are prefixes of random lengths, and its mask
+
+    Parameters
+    ----------
+    random: np.random.RandomState
+    n_rows: int
+    n_cols_max: int
+        Maximum length of the rows
+    values_fn: callable
+        Function that draws the given number of values
+    min_length: int
+
+    Returns
+    -------
+    (csr_matrix, csr_matrix)
+    """
+    lengths = random.randint(min_length, n_cols_max + 1, n_rows)
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    indices = np.arange(indptr[-1]) - np.repeat(indptr[:-1], lengths)
+    width = int(lengths.max()) if n_rows else 0
+    values = csr_matrix((values_fn(indptr[-1]), indices, indptr), shape=(n_rows, width))
+    mask = csr_matrix((np.ones(indptr[-1], dtype=bool), indices, indptr), shape=(n_rows, width))
+    return values, mask
+
+
+def make_synthetic_batcher(n_samples, n_tables=3, sparse=True, max_length=40, max_refs=4, vocabulary_size=1000, seed=0):
+    """
+    Build a synthetic Batcher that looks like a preprocessed corpus, to benchmark the Batcher without any data
+
+    The main table "sample" has a token column (and its mask) and a label. Each table "table<i>" has n_samples rows,
+    a float value, and each row of a table refers to random rows of the next table, through a "table<i+1>_id"
+    column and its "table<i+1>_mask" mask. Foreign ids are in absolute mode.
+
+    Parameters
+    ----------
+    n_samples: int
+        Number of rows of every table
+    n_tables: int
+        Number of tables, including the main table
+    sparse: bool
+        Store the token and id columns as CSR matrices, or as padded dense arrays
+    max_length: int
+        Maximum number of tokens of a sample
+    max_refs: int
+        Maximum number of rows of the next table that a row refers to
+    vocabulary_size: int
+    seed: int
+
+    Returns
+    -------
+    Batcher
+    """
+    random = np.random.RandomState(seed)
+    table_names = ["sample"] + [f"table{i}" for i in range(1, n_tables)]
+    tables = {}
+    for i, table_name in enumerate(table_names):
+        table = {f"{table_name}_id": np.arange(n_samples)}
+        if i == 0:
+            table["token"], table["token_mask"] = random_csr(random, n_samples, max_length, lambda n: random.randint(0, vocabulary_size, n), min_length=1)
+            table["label"] = random.randint(0, 10, n_samples)
+        else:
+            table["value"] = random.randn(n_samples).astype(np.float32)
+        if i + 1 < n_tables:
+            next_name = table_names[i + 1]
+            table[f"{next_name}_id"], table[f"{next_name}_mask"] = random_csr(random, n_samples, max_refs, lambda n: random.randint(0, n_samples, n))
+        if not sparse:
+            table = {col_name: col.toarray() if hasattr(col, "toarray") else col for col_name, col in table.items()}
+        tables[table_name] = table
+    return Batcher(tables, foreign_ids="absolute")
@@ -0,0 +1,152 @@
+"""
+Inspect and clean the disk cache from its index (see `nlstruct.core.cache.CacheIndex`)
+
+    python -m nlstruct.cache list --function "nlstruct/core/text/*" --sort size
+    python -m nlstruct.cache query --older-than 30d --min-size 1G
+    python -m nlstruct.cache size
+    python -m nlstruct.cache prune --older-than 90d --stale-code --dry-run
+"""
+import datetime
+import json
+import re
+import sys
+import time
+
+from nlstruct.core.cache import cache_manager, parse_size
+
+SORT_COLUMNS = {"size": "size DESC", "accessed": "accessed", "created": "created", "function": "function, accessed", "load_time": "load_time DESC"}
+
+
+def parse_duration(duration):
+    """
+    Parse a duration in seconds, given as a number or a string with a s/m/h/d/w suffix ("12h", "30d")
+    """
+    match = re.fullmatch(r"\s*([0-9.]+)\s*([smhdw]?)\s*", str(duration))
+    if match is None:
+        raise ValueError(f"Invalid duration {duration!r}")
+    return float(match.group(1)) * {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}[match.group(2)]
+
+
+def format_size(size):
+    size = float(size or 0)
+    for unit in ("B", "K", "M", "G"):
+        if size < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}T"
+
+
+def format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M") if timestamp else "-"
+
+
+def stale_code_condition():
+    """
+    SQL condition on the entries that were not computed by the latest version of the code of their function
+    """
+    return """code_version IS NOT NULL AND code_version != (
+        SELECT latest.code_version FROM entries AS latest
+        WHERE latest.function = entries.function AND latest.code_version IS NOT NULL
+        ORDER BY latest.created DESC LIMIT 1)"""
+
+
+def select_entries(function=None, older_than=None, min_size=None, stale_code=False, pinned=None, sort="accessed", limit=None):
+    """
+    Select entries of the cache index
+
+    Parameters
+    ----------
+    function: str
+        Glob pattern on the function of the entries (their path without the key), such as "nlstruct/core/text/*"
+    older_than: str or float
+        Only entries that were not accessed for this duration
+    min_size: str or int
+        Only entries larger than this size
+    stale_code: bool
+        Only entries computed by another version of the code than the latest one of their function
+    pinned: bool
+    sort: str
+        One of SORT_COLUMNS
+    limit: int
+
+    Returns
+    -------
+    list of dict
+    """
+    conditions, params = [], []
+    if function is not None:
+        conditions.append("function GLOB ?")
+        params.append(function)
+    if older_than is not None:
+        conditions.append("accessed < ?")
+        params.append(time.time() - parse_duration(older_than))
+    if min_size is not None:
+        conditions.append("size >= ?")
+        params.append(parse_size(min_size))
+    if stale_code:
+        conditions.append(stale_code_condition())
+    if pinned is not None:
+        conditions.append("pinned = ?")
+        params.append(int(pinned))
+    return cache_manager.index.select(" AND ".join(conditions), tuple(params), order_by=SORT_COLUMNS[sort], limit=limit)
+
+
+def main(args=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m nlstruct.cache", description="Inspect and clean the nlstruct disk cache")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_filters(subparser):
+        subparser.add_argument("--function", default=None, help="Glob pattern on the function of the entries")
+        subparser.add_argument("--older-than", default=None, help="Not accessed for this duration (ex: 12h, 30d)")
+        subparser.add_argument("--min-size", default=None, help="Minimum size (ex: 500M)")
+        subparser.add_argument("--stale-code", action="store_true", help="Computed by an older version of the code of their function")
+        subparser.add_argument("--sort", default="accessed", choices=sorted(SORT_COLUMNS))
+        subparser.add_argument("--limit", type=int, default=None)
+
+    add_filters(subparsers.add_parser("list", help="List the entries"))
+    add_filters(subparsers.add_parser("query", help="Print the entries with all their metadata as json lines"))
+    subparsers.add_parser("size", help="Report the size of the cache by function")
+    prune_parser = subparsers.add_parser("prune", help="Delete entries (pinned entries are kept)")
+    add_filters(prune_parser)
+    prune_parser.add_argument("--dry-run", action="store_true")
+    subparsers.add_parser("reindex", help="Rebuild the index by walking the cache directory")
+    for name in ("pin", "unpin"):
+        subparsers.add_parser(name, help=f"{name.capitalize()} entries").add_argument("paths", nargs="+", help="Entry paths, relative to the cache directory")
+    args = parser.parse_args(args)
+
+    if args.command == "reindex":
+        cache_manager.reindex(clear=True)
+        print(f"Indexed {len(cache_manager.index.select())} entries")
+        return 0
+    if args.command in ("pin", "unpin"):
+        for path in args.paths:
+            getattr(cache_manager, args.command)(f"{cache_manager.root}/{path}")
+        return 0
+    # Entries that were not written by this version of the cache were not measured
+    cache_manager.update_sizes()
+    if args.command == "size":
+        rows = cache_manager.index.execute("SELECT function, COUNT(*), SUM(size), MAX(accessed) FROM entries GROUP BY function ORDER BY SUM(size) DESC")
+        for function, count, size, accessed in rows:
+            print(f"{format_size(size):>8} {count:>8} entries  last access {format_time(accessed)}  {function}")
+        print(f"{format_size(sum(row[2] or 0 for row in rows)):>8} {sum(row[1] for row in rows):>8} entries  total")
+    else:
+        entries = select_entries(function=args.function, older_than=args.older_than, min_size=args.min_size, stale_code=args.stale_code,
+                                 pinned=False if args.command == "prune" else None, sort=args.sort, limit=args.limit)
+        if args.command == "query":
+            for entry in entries:
+                print(json.dumps({**entry, "args": json.loads(entry["args"]) if entry["args"] else None}))
+        else:
+            for entry in entries:
+                print(f"{format_size(entry['size']):>8}  {format_time(entry['accessed'])}  {'P' if entry['pinned'] else ' '}  {entry['path']}")
+            if args.command == "prune":
+                if not args.dry_run:
+                    for entry in entries:
+                        cache_manager.evict(entry["path"])
+                print(f"{'Would free' if args.dry_run else 'Freed'} {format_size(sum(entry['size'] or 0 for entry in entries))} in {len(entries)} entries")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,270 @@
+import gc
+import itertools
+import os
+import resource
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+DEFAULT_GRID = {
+    "batch_size": [16, 32, 64, 128],
+    "max_tokens": [None],
+    "sparse_sort_on": [None],
+    "num_workers": [0, 2],
+}
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of the current process (only on Linux, ignored elsewhere)
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+
+def child_pids(pid="self"):
+    """
+    Pids of the child processes (such as DataLoader workers) of a process and of their own children (only on Linux, empty elsewhere)
+    """
+    pids = []
+    try:
+        tids = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return pids
+    for tid in tids:
+        try:
+            with open(f"/proc/{pid}/task/{tid}/children") as file:
+                children = [int(child) for child in file.read().split()]
+        except OSError:
+            continue
+        for child in children:
+            pids.append(child)
+            pids.extend(child_pids(child))
+    return pids
+
+
+def process_peak_rss(pid="self"):
+    """
+    Peak resident set size of a process in bytes, or None if it cannot be read
+    """
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss(children=True):
+    """
+    Peak resident set size in bytes of the current process since the last `reset_peak_rss`, plus the peak of each of its
+    running child processes (such as DataLoader workers) if `children`. Summing the peaks overestimates the memory of
+    processes whose peaks do not happen at the same time, or that share pages (forked workers). Child processes are
+    only found on Linux.
+    """
+    total = process_peak_rss()
+    if total is None:
+        # ru_maxrss is in kilobytes on Linux and cannot be reset
+        total = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    if children:
+        total += sum(process_peak_rss(pid) or 0 for pid in child_pids())
+    return total
+
+
+def count_tokens(batch, on):
+    """
+    Number of tokens of a (possibly densified) batch, ie the number of non zero entries of the `on` column
+    """
+    col = batch[on]
+    if torch.is_tensor(col):
+        return int((col != 0).sum())
+    if hasattr(col, "getnnz"):
+        return int(col.getnnz())
+    return int(np.count_nonzero(col))
+
+
+def make_grid(grid):
+    """
+    List the valid dataloader configurations of a grid (max_tokens is only used with sparse_sort_on)
+    """
+    grid = {**DEFAULT_GRID, **(grid or {})}
+    keys = list(grid.keys())
+    configs = []
+    for values in itertools.product(*(grid[key] for key in keys)):
+        config = dict(zip(keys, values))
+        if config.get("max_tokens") is not None and config.get("sparse_sort_on") is None:
+            continue
+        if config not in configs:
+            configs.append(config)
+    return configs
+
+
+def benchmark_dataloader(batcher, step_fn, config, n_iter=10, warmup=2, tokens_on=None, **dataloader_kwargs):
+    """
+    Measure the throughput of a dataloader configuration over a few batches
+
+    Parameters
+    ----------
+    batcher: Batcher
+    step_fn: callable
+        Model step, called on each batch
+    config: dict
+        Parameters of `Batcher.dataloader` to benchmark
+    n_iter: int
+        Number of measured batches
+    warmup: int
+        Number of batches that are run before measuring (to start the workers, warm the caches and the allocator)
+    tokens_on: str or tuple
+        Column whose non zero entries are counted as tokens
+    dataloader_kwargs: any
+        Other parameters of `Batcher.dataloader`, that are the same for all configurations (device, dtypes, ...)
+
+    Returns
+    -------
+    dict
+    """
+    device = dataloader_kwargs.get("device", None)
+    use_cuda = device is not None and torch.device(device).type == "cuda"
+    gc.collect()
+    reset_peak_rss()
+    if use_cuda:
+        torch.cuda.reset_peak_memory_stats(device)
+
+    loader = batcher.dataloader(shuffle=True, **config, **dataloader_kwargs)
+    n_samples = n_tokens = n_batches = 0
+    load_time = compute_time = 0.
+    iterator = iter(loader)
+    try:
+        for i in range(warmup + n_iter):
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                # Epoch is shorter than the benchmark, start another one
+                iterator = iter(loader)
+                batch = next(iterator)
+            loaded = time.perf_counter()
+            step_fn(batch)
+            if use_cuda:
+                torch.cuda.synchronize(device)
+            end = time.perf_counter()
+            if i >= warmup:
+                n_batches += 1
+                load_time += loaded - start
+                compute_time += end - loaded
+                n_samples += len(batch)
+                if tokens_on is not None:
+                    n_tokens += count_tokens(batch, tokens_on)
+        # Measured while the workers are still running
+        memory = peak_rss()
+    finally:
+        # Stop the workers before the next configuration starts its own
+        del iterator, loader
+
+    total_time = load_time + compute_time
+    return {
+        **config,
+        "samples_per_s": n_samples / total_time if total_time else float('nan'),
+        "tokens_per_s": n_tokens / total_time if tokens_on is not None and total_time else float('nan'),
+        "latency": total_time / max(n_batches, 1),
+        "load_time": load_time,
+        "compute_time": compute_time,
+        "peak_rss": memory,
+        "peak_cuda_memory": torch.cuda.max_memory_allocated(device) if use_cuda else 0,
+        "error": None,
+    }
+
+
+def autotune_dataloader(batcher, step_fn, grid=None, max_memory=None, max_latency=None, n_iter=10, warmup=2, tokens_on=None, verbose=1,
+                        **dataloader_kwargs):
+    """
+    Benchmark a grid of `Batcher.dataloader` configurations (batch sizes, token budgets, sparse_sort_on and
+    numbers of workers) for a few iterations each with the model step, and return the fastest configuration
+    that fits in the memory and latency budgets
+
+    >>> def step_fn(batch):
+    ...     model(batch).loss.backward()
+    ...     model.zero_grad()
+    >>> config, report = autotune_dataloader(batcher, step_fn, grid={
+    ...     "batch_size": [32, 64, 128],
+    ...     "sparse_sort_on": [None, "token_mask"],
+    ...     "max_tokens": [None, 4096, 8192],
+    ...     "num_workers": [0, 2, 4],
+    ... }, max_memory=10e9, device=device)
+    >>> loader = batcher.dataloader(shuffle=True, device=device, **config)
+
+    Parameters
+    ----------
+    batcher: Batcher
+    step_fn: callable
+        Model step, called on each batch. It should do the same work as a training step (forward and backward), but it
+        can skip the optimizer step so that the benchmark does not change the model.
+    grid: dict
+        Candidate values of the `Batcher.dataloader` parameters, `DEFAULT_GRID` values are used for missing parameters
+        Configurations with max_tokens but without sparse_sort_on are skipped.
+    max_memory: int
+        Memory budget in bytes, compared to the peak memory allocated by torch if the device is a CUDA device,
+        to the sum of the peak RSS of the main process and of its DataLoader workers otherwise (see `peak_rss`)
+    max_latency: float
+        Budget of the mean time of a step (loading and computation) in seconds
+    n_iter: int
+        Number of measured batches of each configuration
+    warmup: int
+        Number of batches run before measuring each configuration
+    tokens_on: str or tuple
+        Column whose non zero entries are counted as tokens. Defaults to the first sparse_sort_on of the grid.
+        If given, configurations are ranked by tokens/s, otherwise by samples/s.
+    verbose: int
+    dataloader_kwargs: any
+        Other parameters of `Batcher.dataloader`, that are the same for all configurations (device, dtypes, ...)
+
+    Returns
+    -------
+    (dict, pd.DataFrame)
+        Best configuration (None if no configuration fits in the budgets) and the measures of all configurations
+    """
+    configs = make_grid(grid)
+    if tokens_on is None:
+        tokens_on = next((config["sparse_sort_on"] for config in configs if config.get("sparse_sort_on") is not None), None)
+    device = dataloader_kwargs.get("device", None)
+    use_cuda = device is not None and torch.device(device).type == "cuda"
+
+    results = []
+    for config in configs:
+        try:
+            result = benchmark_dataloader(batcher, step_fn, config, n_iter=n_iter, warmup=warmup, tokens_on=tokens_on, **dataloader_kwargs)
+        except RuntimeError as e:
+            # Most likely an out of memory error: the configuration does not fit
+            if use_cuda:
+                torch.cuda.empty_cache()
+            result = {**config, "error": str(e).split("\n")[0]}
+        memory = result.get("peak_cuda_memory" if use_cuda else "peak_rss", None)
+        result["fits"] = (
+              result["error"] is None and
+              (max_memory is None or memory <= max_memory) and
+              (max_latency is None or result["latency"] <= max_latency))
+        results.append(result)
+        if verbose:
+            print(", ".join(f"{key}={value}" for key, value in config.items()), "->",
+                  result["error"] if result["error"] is not None else
+                  f"{result['samples_per_s']:.1f} samples/s, {result['tokens_per_s']:.1f} tokens/s, "
+                  f"latency {result['latency'] * 1000:.1f}ms (load {result['load_time'] / (result['load_time'] + result['compute_time']):.0%}), "
+                  f"memory {memory / 2 ** 20:.0f}MB" + ("" if result["fits"] else " (over budget)"))
+
+    report = pd.DataFrame(results)
+    score = "tokens_per_s" if tokens_on is not None else "samples_per_s"
+    candidates = report[report["fits"]]
+    if not len(candidates):
+        return None, report
+    # Rows of the report are in the order of the configurations
+    best_config = dict(configs[candidates[score].idxmax()])
+    if verbose:
+        print("Best configuration:", best_config)
+    return best_config, report
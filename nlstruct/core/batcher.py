@@ -1,11 +1,22 @@
+import atexit
+import json
 import logging
+import mmap
+import os
 import pprint
+import shutil
+import tempfile
+import threading
+from queue import Queue, Empty, Full
 
 import numpy as np
 import pandas as pd
 import torch
-from scipy.sparse import issparse, vstack, csr_matrix
-from torch.utils.data import DataLoader, BatchSampler
+from scipy.sparse import issparse, csr_matrix
+from torch.utils.data import DataLoader, BatchSampler, IterableDataset, get_worker_info
+from torch.utils.data.distributed import DistributedSampler
+
+from nlstruct.core.torch import get_rank, get_world_size
 
 
 def flatten_array(array, mask=None):
@@ -24,11 +35,31 @@ def flatten_array(array, mask=None):
     -------
     np.ndarray or torch.Tensor
     """
+    if isinstance(array, RaggedMask):
+        array = array.toarray()
+    if isinstance(mask, RaggedMask):
+        if issparse(array):
+            array = array.tocsr()
+            # Fast path: the array stores exactly the prefixes described by the mask
+            if (array.has_sorted_indices and np.array_equal(np.diff(array.indptr), mask.lengths) and
+                  np.array_equal(array.indices, np.arange(array.nnz) - np.repeat(array.indptr[:-1], mask.lengths))):
+                return array.data
+            mask = mask.tocsr()
+        elif torch.is_tensor(array):
+            mask = torch.as_tensor(mask.toarray(), device=array.device)
+        else:
+            mask = mask.toarray()
     if issparse(array):
         array = array.tocsr()
-        col_bis = array.copy()
-        col_bis.data = np.ones(len(array.data), dtype=bool)
         if mask is not None and issparse(mask):
+            mask = mask.tocsr()
+            # Fast path: if the mask has the same structure as the array (as built by factorize / sparsify),
+            # the active entries are exactly the stored data
+            if (array.has_sorted_indices and mask.has_sorted_indices and
+                  array.shape[0] == mask.shape[0] and array.nnz == mask.nnz and
+                  np.array_equal(array.indptr, mask.indptr) and np.array_equal(array.indices, mask.indices) and
+                  mask.data.all()):
+                return array.data
             res = array[mask]
             # If empty mask, scipy returns a sparse matrix: we use toarray to densify
             if hasattr(res, 'toarray'):
@@ -60,7 +91,201 @@ def flatten_array(array, mask=None):
         raise Exception(f"Unrecognized array type {repr(type(array))} during array flattening (mask type is {repr(type(mask))}')")
 
 
-def factorize(values, mask=None, reference_values=None, freeze_reference=True):
+class RaggedMask:
+    """
+    Boolean mask whose rows are prefixes (the first `lengths[i]` entries of the row i are True, the others are False),
+    stored as its row lengths only
+    It behaves as a read-only (n_rows, width) boolean matrix: rows can be selected, and the mask can be converted to a
+    dense array or a CSR matrix with `toarray` and `tocsr`
+
+    >>> mask = RaggedMask([2, 0, 3], width=4)
+    >>> mask.toarray()
+    ... [[ True,  True, False, False],
+    ...  [False, False, False, False],
+    ...  [ True,  True,  True, False]]
+    """
+    dtype = np.dtype(bool)
+    ndim = 2
+
+    def __init__(self, lengths, width=None):
+        self.lengths = np.asarray(lengths)
+        if width is None:
+            width = int(self.lengths.max()) if len(self.lengths) else 0
+        self.width = width
+
+    @classmethod
+    def from_mask(cls, mask):
+        """
+        Encode a mask as a RaggedMask if all its rows are prefixes
+
+        Parameters
+        ----------
+        mask: np.ndarray or scipy.sparse.spmatrix or torch.Tensor or RaggedMask
+
+        Returns
+        -------
+        RaggedMask or None
+            None if some row of the mask is not a prefix
+        """
+        if isinstance(mask, RaggedMask):
+            return mask
+        if issparse(mask):
+            mask = mask.tocsr()
+            if not mask.has_sorted_indices:
+                mask = mask.sorted_indices()
+            lengths = np.diff(mask.indptr)
+            if not mask.data.all() or not np.array_equal(mask.indices, np.arange(mask.nnz) - np.repeat(mask.indptr[:-1], lengths)):
+                return None
+            return cls(lengths, mask.shape[1])
+        mask = as_numpy_array(mask).astype(bool)
+        lengths = mask.sum(1)
+        if not np.array_equal(mask, np.arange(mask.shape[1]) < lengths[:, None]):
+            return None
+        return cls(lengths, mask.shape[1])
+
+    @property
+    def shape(self):
+        return (len(self.lengths), self.width)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, ids):
+        if isinstance(ids, tuple):
+            return self.toarray()[ids]
+        lengths = self.lengths[ids]
+        if np.ndim(lengths) == 0:
+            return np.arange(self.width) < lengths
+        return RaggedMask(lengths, self.width)
+
+    def getnnz(self, axis=None):
+        if axis is None:
+            return int(self.lengths.sum())
+        if axis in (1, -1):
+            return self.lengths
+        return (np.arange(self.width) < self.lengths[:, None]).sum(0)
+
+    def sum(self, axis=None):
+        return self.getnnz(axis)
+
+    def resize(self, *shape):
+        """
+        Change the width of the mask inplace (the number of rows cannot be changed)
+        """
+        n_rows, width = shape[0] if len(shape) == 1 else shape
+        assert n_rows == len(self.lengths), "Cannot change the number of rows of a RaggedMask"
+        if width < self.width:
+            self.lengths = np.minimum(self.lengths, width)
+        self.width = width
+
+    def copy(self):
+        return RaggedMask(self.lengths.copy(), self.width)
+
+    def toarray(self):
+        return np.arange(self.width) < self.lengths[:, None]
+
+    def tocsr(self):
+        indptr = np.zeros(len(self.lengths) + 1, dtype=np.int64)
+        np.cumsum(self.lengths, out=indptr[1:])
+        indices = np.arange(indptr[-1]) - np.repeat(indptr[:-1], self.lengths)
+        return csr_matrix((np.ones(len(indices), dtype=bool), indices, indptr), shape=self.shape)
+
+    def __repr__(self):
+        return f"RaggedMask(lengths={self.lengths!r}, width={self.width})"
+
+
+class IdIndex:
+    """
+    Persistent id -> row number index over an array of unique ids, built once and then used
+    to remap many arrays of ids in a time that only depends on the size of these arrays
+    Integer ids that span a small range are indexed by a dense lookup array, other ids by their sorted order
+    """
+
+    def __init__(self, ids, max_density=4):
+        """
+        Parameters
+        ----------
+        ids: np.ndarray
+            Unique ids, for instance the primary ids of a table
+        max_density: int
+            Max ratio between the range of integer ids and their number to use a dense lookup array
+        """
+        self.ids = ids
+        ids = np.asarray(ids)
+        self.lookup = None
+        self.offset = 0
+        self.sorter = None
+        self.sorted_ids = None
+        if np.issubdtype(ids.dtype, np.integer) and len(ids) and ids.max() - ids.min() < max(max_density * len(ids), 1024):
+            self.offset = ids.min()
+            self.lookup = np.full(ids.max() - self.offset + 1, -1, dtype=np.int64)
+            # Reversed assignment so that the first row wins in case of duplicated ids, like pd.factorize
+            self.lookup[ids[::-1] - self.offset] = np.arange(len(ids))[::-1]
+        else:
+            self.sorter = np.argsort(ids, kind="stable")
+            self.sorted_ids = ids[self.sorter]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_indexer(self, values):
+        """
+        Row numbers of the given values in the indexed ids
+
+        Parameters
+        ----------
+        values: np.ndarray
+
+        Returns
+        -------
+        np.ndarray
+            Row number of each value, -1 if the value is not in the index
+        """
+        values = np.asarray(values).reshape(-1)
+        if self.lookup is not None and np.issubdtype(values.dtype, np.integer):
+            shifted = values - self.offset
+            found = (shifted >= 0) & (shifted < len(self.lookup))
+            res = np.full(len(values), -1, dtype=np.int64)
+            res[found] = self.lookup[shifted[found]]
+            return res
+        if self.sorter is None:
+            self.sorter = np.argsort(np.asarray(self.ids), kind="stable")
+            self.sorted_ids = np.asarray(self.ids)[self.sorter]
+        if not len(self.sorted_ids):
+            return np.full(len(values), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.sorted_ids, values), len(self.sorted_ids) - 1)
+        return np.where(self.sorted_ids[positions] == values, self.sorter[positions], -1).astype(np.int64)
+
+
+def torch_factorize(values):
+    """
+    Equivalent of pd.factorize for 1d torch tensors, computed on the device of the tensor:
+    unique values are returned in their order of first appearance
+
+    Parameters
+    ----------
+    values: torch.Tensor
+
+    Returns
+    -------
+    (torch.Tensor, torch.Tensor)
+        codes and unique values
+    """
+    sorted_uniques, inverse = torch.unique(values, sorted=True, return_inverse=True)
+    n = len(values)
+    positions = torch.arange(n, device=values.device)
+    # Sorting (unique value, position) keys groups the positions of each unique value, the first key of each group
+    # being its first appearance
+    sorted_keys = torch.sort(inverse * n + positions)[0]
+    counts = torch.bincount(inverse, minlength=len(sorted_uniques))
+    first_positions = sorted_keys[torch.cumsum(counts, 0) - counts] % max(n, 1)
+    order = torch.argsort(first_positions)
+    ranks = torch.empty_like(order)
+    ranks[order] = torch.arange(len(order), device=values.device)
+    return ranks[inverse], sorted_uniques[order]
+
+
+def factorize(values, mask=None, reference_values=None, freeze_reference=True, reference_index=None):
     """
     Express values in "col" as row numbers in a reference list of values
     The reference values list is the deduplicated concatenation of preferred_unique_values (if not None) and col
@@ -84,6 +309,9 @@ def factorize(values, mask=None, reference_values=None, freeze_reference=True):
     reference_values: np.ndarray or scipy.sparse.spmatrix or torch.Tensor or list or None
         If given, any value in col that is not in prefered_unique_values will be thrown out
         and the mask will be updated to be False for this value
+    reference_index: IdIndex or None
+        Prebuilt index of reference_values: values are then remapped by looking them up in the index
+        instead of factorizing the reference values together with the values
 
     Returns
     -------
@@ -102,10 +330,15 @@ def factorize(values, mask=None, reference_values=None, freeze_reference=True):
     if reference_values is None:
         freeze_reference = False
 
+    # Ragged masks are only kept for sparse values, dense values get dense masks
+    all_masks = [mask.toarray() if isinstance(mask, RaggedMask) and not issparse(values) else mask
+                 for values, mask in zip(all_values, all_masks)]
+
     all_flat_values = []
     for values, mask in zip(all_values, all_masks):
         assert (
               (isinstance(mask, np.ndarray) and isinstance(values, np.ndarray)) or
+              (isinstance(mask, RaggedMask) and issparse(values)) or
               (issparse(mask) and issparse(values)) or
               (torch.is_tensor(mask) and torch.is_tensor(values)) or
               (mask is None and (isinstance(values, (list, tuple, np.ndarray)) or issparse(values) or torch.is_tensor(values)))), (
@@ -115,29 +348,48 @@ def factorize(values, mask=None, reference_values=None, freeze_reference=True):
     was_torch = False
     if torch.is_tensor(all_flat_values[0]):
         was_torch = True
-        # if reference_values is None:
-        #     unique_values, relative_values = torch.unique(torch.cat(all_flat_values), sorted=False, return_inverse=True)
-        # elif freeze_reference:
-        #     relative_values, unique_values = torch.unique(torch.cat((reference_values, *all_flat_values)), sorted=False, return_inverse=True)[1], reference_values
-        # else:
-        #     unique_values, relative_values = torch.unique(torch.cat((reference_values, *all_flat_values)), sorted=False, return_inverse=True)
-    if True:
+        if reference_values is not None:
+            reference_values = torch.as_tensor(reference_values, device=all_flat_values[0].device)
+    offset = 0 if reference_values is None else len(reference_values)
+    if reference_index is not None and reference_values is not None and not was_torch:
+        # Fast path: only the values are looked up, the reference values have already been indexed
+        flat_values = np.concatenate(all_flat_values)
+        relative_values = reference_index.get_indexer(flat_values)
+        unique_values = reference_values
+        if freeze_reference:
+            all_unk_masks = relative_values >= 0
+        else:
+            all_unk_masks = None
+            unknown = relative_values < 0
+            if unknown.any():
+                new_relative_values, new_unique_values = pd.factorize(flat_values[unknown])
+                relative_values[unknown] = new_relative_values + len(reference_values)
+                unique_values = np.concatenate((reference_values, new_unique_values))
+        offset = 0
+    elif was_torch:
+        # Factorize on the device of the tensors, without going back to numpy
+        if reference_values is None:
+            relative_values, unique_values = torch_factorize(torch.cat(all_flat_values))
+        elif freeze_reference:
+            relative_values, unique_values = torch_factorize(torch.cat((reference_values, *all_flat_values)))[0], reference_values
+        else:
+            relative_values, unique_values = torch_factorize(torch.cat((reference_values, *all_flat_values)))
+        if freeze_reference:
+            all_unk_masks = relative_values < len(reference_values)
+        else:
+            all_unk_masks = None
+    else:
         if reference_values is None:
             relative_values, unique_values = pd.factorize(np.concatenate(all_flat_values))
         elif freeze_reference:
             relative_values, unique_values = pd.factorize(np.concatenate((reference_values, *all_flat_values)))[0], reference_values
         else:
             relative_values, unique_values = pd.factorize(np.concatenate((reference_values, *all_flat_values)))
-    if was_torch:
-        relative_values = torch.as_tensor(relative_values)
-        unique_values = torch.as_tensor(unique_values)
-    if freeze_reference:
-        all_unk_masks = relative_values < len(reference_values)
-    else:
-        all_unk_masks = None
+        if freeze_reference:
+            all_unk_masks = relative_values < len(reference_values)
+        else:
+            all_unk_masks = None
 
-    offset = 0 if reference_values is None else len(reference_values)
-    new_flat_values = []
     new_flat_values = []
     unk_masks = []
     for flat_values in all_flat_values:
@@ -154,7 +406,8 @@ def factorize(values, mask=None, reference_values=None, freeze_reference=True):
     new_masks = []
     for values, mask, flat_relative_values, unk_mask in zip(all_values, all_masks, all_flat_values, unk_masks):
         if issparse(values):
-            values = values.tocsr()
+            # Copy to avoid modifying the given matrix inplace if it already is a csr_matrix
+            values = values.tocsr(copy=True)
             values.data = flat_relative_values + 1
             if unk_mask is not None:
                 values.data[~unk_mask] = 0
@@ -163,10 +416,13 @@ def factorize(values, mask=None, reference_values=None, freeze_reference=True):
             values.data -= 1
             new_mask.data = np.ones(len(new_mask.data), dtype=bool)
 
-            if mask is not None:
+            if isinstance(mask, RaggedMask) and (unk_mask is None or unk_mask.all()):
+                # No value was thrown out: the values still have the structure of the ragged mask
+                new_mask = mask
+            elif mask is not None:
                 new_mask = new_mask.multiply(mask.tocsr())
-            new_values.append(values.tolil())
-            new_masks.append(new_mask.tolil())
+            new_values.append(values)
+            new_masks.append(new_mask if isinstance(new_mask, RaggedMask) else new_mask.tocsr())
         elif isinstance(values, (list, tuple)):
             mask = unk_mask
             if mask is not None:
@@ -184,10 +440,10 @@ def factorize(values, mask=None, reference_values=None, freeze_reference=True):
                     new_mask = unk_mask.reshape(values.shape)
                 else:
                     new_mask = mask.copy()
-                    mask[mask] = unk_mask
+                    new_mask[mask] = unk_mask
             if mask is not None:
                 values = np.zeros(values.shape, dtype=int)
-                values[mask] = flat_relative_values[unk_mask] if unk_mask is not None else flat_relative_values
+                values[new_mask] = flat_relative_values[unk_mask] if unk_mask is not None else flat_relative_values
                 new_values.append(values)
                 new_masks.append(new_mask)
             else:
@@ -201,12 +457,12 @@ def factorize(values, mask=None, reference_values=None, freeze_reference=True):
                     new_mask = unk_mask.view(*values.shape)
                 else:
                     new_mask = mask.clone()
-                    mask[mask] = unk_mask
+                    new_mask[mask] = unk_mask
             if mask is not None:
-                values = torch.zeros(values.shape, dtype=torch.long)
-                values[mask] = flat_relative_values[unk_mask] if unk_mask is not None else flat_relative_values
+                values = torch.zeros(values.shape, dtype=torch.long, device=values.device)
+                values[new_mask] = flat_relative_values[unk_mask] if unk_mask is not None else flat_relative_values
                 new_values.append(values)
-                new_masks.append(mask)
+                new_masks.append(new_mask)
             else:
                 values = flat_relative_values.view(*values.shape)
                 new_values.append(values)
@@ -227,6 +483,135 @@ def as_numpy_array(array):
         return np.asarray(array)
 
 
+def save_column(col, prefix):
+    """
+    Save a batcher column as raw .npy files: one file for dense arrays and tensors,
+    and data / indices / indptr files for sparse matrices (stored in the CSR format)
+
+    Parameters
+    ----------
+    col: np.ndarray or scipy.sparse.spmatrix or torch.Tensor
+    prefix: str
+        Path of the files without their extensions
+
+    Returns
+    -------
+    dict
+        Description of the column, to give to `load_column`
+    """
+    if issparse(col):
+        col = col.tocsr()
+        # Store indices with the dtype scipy would choose, otherwise it would copy them when rebuilding the matrix
+        index_dtype = np.int32 if max(*col.shape, col.nnz) < np.iinfo(np.int32).max else np.int64
+        np.save(prefix + ".data.npy", col.data, allow_pickle=False)
+        np.save(prefix + ".indices.npy", col.indices.astype(index_dtype), allow_pickle=False)
+        np.save(prefix + ".indptr.npy", col.indptr.astype(index_dtype), allow_pickle=False)
+        return {"kind": "csr", "shape": list(col.shape)}
+    elif isinstance(col, RaggedMask):
+        np.save(prefix + ".lengths.npy", col.lengths, allow_pickle=False)
+        return {"kind": "ragged", "width": col.width}
+    elif torch.is_tensor(col):
+        np.save(prefix + ".npy", col.detach().cpu().numpy(), allow_pickle=False)
+        return {"kind": "tensor"}
+    else:
+        col = np.asarray(col)
+        np.save(prefix + ".npy", col, allow_pickle=col.dtype.hasobject)
+        return {"kind": "array", "object": bool(col.dtype.hasobject)}
+
+
+def load_column(description, prefix, mmap=True):
+    """
+    Load a column saved with `save_column`
+
+    Parameters
+    ----------
+    description: dict
+        Description returned by `save_column`
+    prefix: str
+        Path of the files without their extensions
+    mmap: bool
+        Map the files in memory as read-only arrays instead of reading them.
+        Tensors and arrays of python objects are always read.
+
+    Returns
+    -------
+    np.ndarray or scipy.sparse.spmatrix or torch.Tensor
+    """
+    mmap_mode = "r" if mmap else None
+    kind = description["kind"]
+    if kind == "csr":
+        return csr_matrix((
+            np.load(prefix + ".data.npy", mmap_mode=mmap_mode),
+            np.load(prefix + ".indices.npy", mmap_mode=mmap_mode),
+            np.load(prefix + ".indptr.npy", mmap_mode=mmap_mode),
+        ), shape=tuple(description["shape"]), copy=False)
+    elif kind == "ragged":
+        return RaggedMask(np.load(prefix + ".lengths.npy", mmap_mode=mmap_mode), description["width"])
+    elif kind == "tensor":
+        return torch.from_numpy(np.load(prefix + ".npy"))
+    elif kind == "array":
+        if description["object"]:
+            return np.load(prefix + ".npy", allow_pickle=True)
+        return np.load(prefix + ".npy", mmap_mode=mmap_mode)
+    raise Exception(f"Unrecognized column kind {repr(kind)}")
+
+
+def reduce_shared_column(col):
+    """
+    Describe a column so that it can be sent to another process without copying the memory mapped
+    buffers it is made of: those buffers are described by their file, and will be mapped again by
+    the receiving process
+
+    Parameters
+    ----------
+    col: np.ndarray or scipy.sparse.spmatrix or torch.Tensor
+
+    Returns
+    -------
+    tuple
+    """
+    if isinstance(col, np.ndarray):
+        # Find the array returned by np.load / np.memmap, that directly wraps the mmap buffer
+        # (scipy for instance only keeps a plain ndarray view of the memmap)
+        root = col
+        while isinstance(root, np.ndarray) and not (isinstance(root, np.memmap) and isinstance(root.base, mmap.mmap)):
+            root = root.base
+        # The column must be a full view of the file, not a slice of it
+        if (root is not None and isinstance(root, np.ndarray) and root.dtype == col.dtype and root.shape == col.shape and
+              root.__array_interface__["data"][0] == col.__array_interface__["data"][0] and root.strides == col.strides):
+            return ("memmap", root.filename, root.offset, col.dtype.str, col.shape, 'F' if col.flags.f_contiguous and not col.flags.c_contiguous else 'C')
+    if issparse(col) and col.format == "csr":
+        return ("csr", reduce_shared_column(col.data), reduce_shared_column(col.indices), reduce_shared_column(col.indptr), col.shape)
+    if isinstance(col, RaggedMask):
+        return ("ragged", reduce_shared_column(col.lengths), col.width)
+    return ("value", col)
+
+
+def rebuild_shared_column(state):
+    """
+    Inverse of `reduce_shared_column`
+
+    Parameters
+    ----------
+    state: tuple
+
+    Returns
+    -------
+    np.ndarray or scipy.sparse.spmatrix or torch.Tensor
+    """
+    kind, *args = state
+    if kind == "memmap":
+        filename, offset, dtype, shape, order = args
+        return np.memmap(filename, dtype=np.dtype(dtype), mode="r", offset=offset, shape=shape, order=order)
+    if kind == "csr":
+        data, indices, indptr, shape = args
+        return csr_matrix((rebuild_shared_column(data), rebuild_shared_column(indices), rebuild_shared_column(indptr)), shape=shape, copy=False)
+    if kind == "ragged":
+        lengths, width = args
+        return RaggedMask(rebuild_shared_column(lengths), width)
+    return args[0]
+
+
 class BatcherPrinter(pprint.PrettyPrinter):
     def format_batcher(self, obj, stream, indent, allowance, context, level):
         # Code almost equal to _format_dict, see pprint code
@@ -309,34 +694,356 @@ class BatcherPrinter(pprint.PrettyPrinter):
 
 
 class SparseBatchSampler(BatchSampler):
-    def __init__(self, batcher, on, batch_size=32, shuffle=False, drop_last=False):
+    def __init__(self, batcher, on, batch_size=32, shuffle=False, drop_last=False, max_tokens=None, budget="padded",
+                 num_replicas=None, rank=None, seed=0):
+        """
+        Batch sampler that groups samples of similar lengths, the length of a sample being its number
+        of non zero entries (or the sum of its entries if dense) in the `on` column, typically a mask.
+
+        Batches either contain `batch_size` samples, or if `max_tokens` is given, are packed with
+        samples of similar lengths as long as they fit in the token budget.
+
+        Parameters
+        ----------
+        batcher: Batcher
+        on: str or tuple
+            Column used to compute the length of each sample
+        batch_size: int
+            Number of samples per batch, or maximum number of samples per batch if max_tokens is given
+            (None for no limit)
+        shuffle: bool
+            Add noise to the lengths before sorting the samples, and shuffle the order of the batches
+        drop_last: bool
+            Drop the last incomplete batch (only if max_tokens is None)
+        max_tokens: int
+            Token budget of each batch
+        budget: str
+            How to count the tokens of a batch against `max_tokens`:
+            "padded": number of samples * max length in the batch (size of the padded batch)
+            "sum": sum of the lengths of the samples
+        num_replicas: int
+            If given, the batches are split between this number of processes: every process computes the same
+            batches (shuffled with `seed` and the epoch given to `set_epoch`) and only yields its share of them.
+            Every process yields the same number of batches (some are repeated, unless drop_last is True).
+        rank: int
+            Rank of the current process, between 0 and num_replicas - 1
+        seed: int
+            Seed of the shuffling, only used if num_replicas is given (otherwise numpy's global random state is used)
+        """
+        assert budget in ("padded", "sum"), f"Unknown budget {repr(budget)}, must be 'padded' or 'sum'"
+        assert max_tokens is not None or batch_size is not None, "Either batch_size or max_tokens must be given"
         self.batch_size = batch_size
         self.drop_last = drop_last
         self.shuffle = shuffle
         self.batcher = batcher
         self.on = on
+        self.max_tokens = max_tokens
+        self.budget = budget
+        assert num_replicas is None or rank is not None and 0 <= rank < num_replicas, "rank must be given, between 0 and num_replicas - 1"
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        # Lengths are computed once, instead of at every epoch
+        # The lengths of the rows of a view are computed on its base, without gathering the view
+        source = batcher._base if batcher.is_view else batcher
+        col = source[on]
+        self.lengths = as_numpy_array(getattr(col, "getnnz", col.sum)(1)).reshape(-1)
+        if batcher.is_view:
+            self.lengths = self.lengths[as_numpy_array(batcher._idx)]
+        self.n_batches = len(self.make_batches(np.argsort(self.lengths, kind="stable"))) if max_tokens is not None else None
+
+    def make_batches(self, sorter):
+        """
+        Pack the samples, in the order given by `sorter`, into batches that fit in the token budget
 
-    def __iter__(self):
-        length = len(self.batcher)
-        block_begins = np.arange(len(self)) * self.batch_size
+        Parameters
+        ----------
+        sorter: np.ndarray
+            Samples sorted by (noisy) lengths
+
+        Returns
+        -------
+        list of np.ndarray
+        """
+        # Count empty samples as one token so that the batches size remain bounded
+        lengths = np.maximum(self.lengths[sorter], 1)
+        max_size = min(self.max_tokens, self.batch_size) if self.batch_size is not None else self.max_tokens
+        batches = []
+        begin = 0
+        while begin < len(sorter):
+            window = lengths[begin:begin + max_size]
+            if self.budget == "padded":
+                cost = np.maximum.accumulate(window) * np.arange(1, len(window) + 1)
+            else:
+                cost = np.cumsum(window)
+            # Cost is increasing, the batch ends at the first sample that exceeds the budget
+            # but contains at least one sample, even if it exceeds the budget by itself
+            size = max(int(np.searchsorted(cost, self.max_tokens, side="right")), 1)
+            batches.append(sorter[begin:begin + size])
+            begin += size
+        return batches
+
+    def set_epoch(self, epoch):
+        """
+        Set the epoch used to seed the shuffling of distributed samplers, so that all processes
+        shuffle the batches the same way, but differently at each epoch
+        """
+        self.epoch = epoch
+
+    def iter_all_batches(self):
+        """
+        Batches of all the processes, in their iteration order
+        """
+        length = len(self.lengths)
+        random = np.random if self.num_replicas is None else np.random.RandomState(self.seed + self.epoch)
+        if self.max_tokens is not None:
+            if self.shuffle:
+                init_permut = random.permutation(length)
+                sorter = init_permut[np.argsort((self.lengths + random.poisson(1, size=length))[init_permut], kind="stable")]
+                batches = self.make_batches(sorter)
+                self.n_batches = len(batches)
+                for i in random.permutation(len(batches)):
+                    yield batches[i]
+            else:
+                batches = self.make_batches(np.argsort(self.lengths, kind="stable"))
+                self.n_batches = len(batches)
+                yield from batches
+            return
+        block_begins = np.arange(self.n_all_batches()) * self.batch_size
         block_ends = np.roll(block_begins, -1)
         block_ends[-1] = block_begins[-1] + self.batch_size
         if self.shuffle:
-            init_permut = np.random.permutation(length)
-            sorter = np.argsort(
-                (getattr(self.batcher[self.on], "getnnz", self.batcher[self.on].sum)(1) + np.random.poisson(1, size=length))[init_permut])
-            for i in np.random.permutation(len(block_begins)):
+            init_permut = random.permutation(length)
+            sorter = np.argsort((self.lengths + random.poisson(1, size=length))[init_permut])
+            for i in random.permutation(len(block_begins)):
                 yield init_permut[sorter[block_begins[i]:block_ends[i]]]
         else:
-            sorter = np.argsort(getattr(self.batcher[self.on], "getnnz", self.batcher[self.on].sum)(1))
+            sorter = np.argsort(self.lengths)
             for i in range(len(block_begins)):
                 yield sorter[block_begins[i]:block_ends[i]]
 
-    def __len__(self):
+    def __iter__(self):
+        if self.num_replicas is None:
+            yield from self.iter_all_batches()
+            return
+        batches = list(self.iter_all_batches())
+        # Every process must run the same number of steps: repeat the first batches to fill the last round,
+        # or drop the last incomplete round
+        n_per_replica = self.n_per_replica(len(batches))
+        batches = (batches + batches[:n_per_replica * self.num_replicas - len(batches)])[:n_per_replica * self.num_replicas]
+        yield from batches[self.rank::self.num_replicas]
+
+    def n_all_batches(self):
+        if self.max_tokens is not None:
+            # Number of batches of the last packing: it may slightly vary between shuffled epochs
+            return self.n_batches
         if self.drop_last:
-            return len(self.batcher) // self.batch_size
+            return len(self.lengths) // self.batch_size
         else:
-            return (len(self.batcher) + self.batch_size - 1) // self.batch_size
+            return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def n_per_replica(self, n_batches):
+        if self.drop_last:
+            return n_batches // self.num_replicas
+        return (n_batches + self.num_replicas - 1) // self.num_replicas
+
+    def __len__(self):
+        if self.num_replicas is None:
+            return self.n_all_batches()
+        return self.n_per_replica(self.n_all_batches())
+
+
+class BatcherCollate:
+    """
+    Picklable collate function for torch DataLoader that queries the batcher rows of each batch of ids
+
+    Unlike a closure, it can be sent to DataLoader worker processes (num_workers > 0). Columns that
+    were moved to memory maps with `Batcher.share_memory` are pickled as references to their files,
+    so each worker maps the same pages instead of receiving a copy of the batcher.
+    """
+
+    def __init__(self, batcher, plan=None, device=None, dtypes=None):
+        self.batcher = batcher
+        self.plan = plan if plan is not None else batcher.compile_query_plan()
+        self.device = device
+        self.dtypes = dtypes
+
+    def __call__(self, ids):
+        return self.batcher.query_ids(ids, plan=self.plan, device=self.device, dtypes=self.dtypes)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        batcher = self.batcher.copy()
+        batcher.tables = {table_name: {col_name: reduce_shared_column(col) for col_name, col in table.items()}
+                          for table_name, table in batcher.tables.items()}
+        state["batcher"] = batcher
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.batcher.tables = {table_name: {col_name: rebuild_shared_column(col) for col_name, col in table.items()}
+                               for table_name, table in self.batcher.tables.items()}
+
+
+class BatchPrefetcher:
+    """
+    Iterate over a DataLoader of host side batches in a background thread, and move them to the device ahead of time
+    so that batch N+1 is queried, densified and transferred while batch N is used
+
+    On CUDA devices, tensors are first copied into pinned host buffers that are reused across batches, and then sent
+    with non_blocking copies on a side stream. The main stream waits for these copies before the batch is yielded.
+
+    >>> for batch in batcher.dataloader(batch_size=32, device=torch.device('cuda'), prefetch=2):
+    ...     loss = model(batch)
+    """
+
+    def __init__(self, loader, device=None, prefetch=1, pin_memory=None):
+        """
+        Parameters
+        ----------
+        loader: iterable of Batcher
+            Loader of densified (cpu) or sparse batches
+        device: torch.device or None
+            Device to move the tensors of the batches to
+        prefetch: int
+            Number of batches that are prepared in advance
+        pin_memory: bool or None
+            Copy the tensors to reused pinned buffers before sending them to the device.
+            By default, only on CUDA devices.
+        """
+        self.loader = loader
+        self.device = torch.device(device) if device is not None else None
+        self.prefetch = max(prefetch, 1)
+        cuda = self.device is not None and self.device.type == "cuda" and torch.cuda.is_available()
+        self.pin_memory = cuda if pin_memory is None else (pin_memory and cuda)
+        # Pinned buffers are reused in a round robin fashion: one slot per batch that can be in the queue,
+        # plus the one being filled
+        self.slots = [{} for _ in range(self.prefetch + 1)]
+        self.slot_events = [None for _ in self.slots]
+
+    def __len__(self):
+        return len(self.loader)
+
+    def pinned_buffer(self, slot, key, tensor):
+        buffer = slot.get(key, None)
+        if buffer is None or buffer.dtype != tensor.dtype or buffer.numel() < tensor.numel():
+            numel = tensor.numel() if buffer is None or buffer.dtype != tensor.dtype else max(tensor.numel(), 2 * buffer.numel())
+            buffer = slot[key] = torch.empty(numel, dtype=tensor.dtype, pin_memory=True)
+        return buffer[:tensor.numel()].view(tensor.shape)
+
+    def transfer(self, batch, slot_idx):
+        if self.device is None or not isinstance(batch, Batcher):
+            return batch
+        slot = self.slots[slot_idx]
+        if self.slot_events[slot_idx] is not None:
+            # Wait for the previous copies from these pinned buffers to be done before overwriting them
+            self.slot_events[slot_idx].synchronize()
+        new_tables = {}
+        for table_name, table in batch.tables.items():
+            new_table = {}
+            for col_name, col in table.items():
+                if not torch.is_tensor(col):
+                    col = torch.as_tensor(as_numpy_array(col))
+                if col.device != self.device:
+                    if self.pin_memory and col.device.type == "cpu":
+                        col = self.pinned_buffer(slot, (table_name, col_name), col).copy_(col)
+                    col = col.to(self.device, non_blocking=self.pin_memory)
+                new_table[col_name] = col
+            new_tables[table_name] = new_table
+        res = batch.copy()
+        res.tables = new_tables
+        if self.pin_memory:
+            self.slot_events[slot_idx] = torch.cuda.Event()
+            self.slot_events[slot_idx].record()
+        return res
+
+    def produce(self, queue, stop):
+        try:
+            if self.pin_memory:
+                stream = torch.cuda.Stream(device=self.device)
+                with torch.cuda.stream(stream):
+                    self.produce_batches(queue, stop)
+            else:
+                self.produce_batches(queue, stop)
+        except BaseException as e:
+            self.put(queue, stop, ("error", e))
+
+    def produce_batches(self, queue, stop):
+        for i, batch in enumerate(self.loader):
+            batch = self.transfer(batch, i % len(self.slots))
+            event = self.slot_events[i % len(self.slots)] if self.pin_memory else None
+            if not self.put(queue, stop, ("batch", (batch, event))):
+                return
+        self.put(queue, stop, ("end", None))
+
+    @staticmethod
+    def put(queue, stop, item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def __iter__(self):
+        queue = Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.produce, args=(queue, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                kind, item = queue.get()
+                if kind == "end":
+                    break
+                elif kind == "error":
+                    raise item
+                batch, event = item
+                if event is not None:
+                    # Make the compute stream wait for the transfer, and tell the allocator that the tensors
+                    # allocated on the side stream are now used by the compute stream
+                    torch.cuda.current_stream(self.device).wait_event(event)
+                    for table in batch.tables.values():
+                        for col in table.values():
+                            col.record_stream(torch.cuda.current_stream(self.device))
+                yield batch
+        finally:
+            stop.set()
+            while thread.is_alive():
+                try:
+                    queue.get(timeout=0.1)
+                except Empty:
+                    pass
+            thread.join()
+
+
+class QueryPlan:
+    """
+    Fixed traversal of the foreign ids graph of a Batcher, computed once by `Batcher.compile_query_plan`
+    and replayed by `Batcher.query_ids` for every queried batch
+
+    Attributes
+    ----------
+    main_table: str
+        Table from which the queried ids are taken
+    steps: list of (str, list of str, list of (str, str, str, bool))
+        Tables in traversal order, as (table_name, gathered column names, foreign id bindings)
+        where each foreign id binding is (col_name, foreign_table_name, mask_name, freeze_reference)
+    mask_bindings: list of (str, str, str)
+        (table_name, col_name, mask_name) columns to truncate to the length of their mask
+    signature: tuple
+        Structure of the batcher the plan was compiled for, used to check if the plan is still valid
+    """
+
+    def __init__(self, main_table, steps, mask_bindings, signature):
+        self.main_table = main_table
+        self.steps = steps
+        self.mask_bindings = mask_bindings
+        self.signature = signature
+
+    def __repr__(self):
+        return "QueryPlan({})".format(" -> ".join(table_name for table_name, _, _ in self.steps))
 
 
 class Batcher:
@@ -353,6 +1060,9 @@ class Batcher:
                         self.tables.setdefault(table_name, {}).setdefault(col_name, col.values)
                     elif isinstance(col, pd.Categorical):
                         self.tables.setdefault(table_name, {}).setdefault(col_name, col.codes)
+                    elif issparse(col) and col.format != "csr":
+                        # Sparse columns are always kept in CSR format to allow fast row gathering
+                        self.tables.setdefault(table_name, {}).setdefault(col_name, col.tocsr())
                     else:
                         assert col is not None, f"Column {repr(table_name)}{repr(col_name)} cannot be None"
                         self.tables.setdefault(table_name, {}).setdefault(col_name, col)
@@ -360,6 +1070,8 @@ class Batcher:
             self.tables = tables
         self.main_table = main_table or next(iter(tables.keys()))
         self.masks = masks or {}
+        self.query_plan = None
+        self.id_indexes = {}
         if primary_ids is not None:
             self.primary_ids = primary_ids
         else:
@@ -421,12 +1133,91 @@ class Batcher:
                 assert table_name in self.tables, f"Unknown table {repr(table_name)} in `primary_ids`"
                 assert col_name in self.tables[table_name], f"Unknown column {repr(col_name)} for table {repr(table_name)} in `primary_ids`"
 
+    @property
+    def tables(self):
+        if self._tables is None:
+            # Lazy view: the rows are only gathered from the base batcher when the tables are first read
+            self._tables = self._base.query_ids(self._idx).tables
+            self._base = self._idx = None
+        return self._tables
+
+    @tables.setter
+    def tables(self, tables):
+        self._tables = tables
+        self._base = None
+        self._idx = None
+
+    @property
+    def is_view(self):
+        return self._tables is None
+
+    def view(self, ids):
+        """
+        Lazily select rows of the main table: the returned batcher only holds the selected row numbers and
+        shares the columns of this batcher, and the rows are only gathered when its tables are read.
+        Views of views compose their row numbers, and querying a view queries its base batcher directly.
+
+        The view keeps a snapshot of the tables of this batcher: columns that are later added, replaced or
+        deleted in this batcher do not change the view. The column buffers are shared though, so in-place
+        writes to the arrays of this batcher are seen by the view until it is gathered.
+
+        Parameters
+        ----------
+        ids: np.ndarray or torch.Tensor or list of int
+            Row numbers in the main table
+
+        Returns
+        -------
+        Batcher
+        """
+        if self._tables is None:
+            base, ids = self._base, self.compose_ids(ids)
+        else:
+            base = self
+            if not all(mode == "relative"
+                       for table_name, col_to_modes in self.foreign_ids.items()
+                       for col_name, (_, mode) in col_to_modes.items()):
+                base = self.switch_foreign_ids_mode("relative")
+            if not torch.is_tensor(ids):
+                ids = np.asarray(ids)
+            # Snapshot of the table dicts, so that replacing columns of this batcher does not change the view
+            base = base.copy()
+        res = base.copy()
+        res._tables = None
+        res._base = base
+        res._idx = ids
+        return res
+
+    def compose_ids(self, ids):
+        """
+        Convert row numbers of a view into row numbers of its base batcher
+        """
+        if torch.is_tensor(self._idx):
+            return self._idx[torch.as_tensor(ids, device=self._idx.device)]
+        return self._idx[as_numpy_array(ids)]
+
+    def gather(self):
+        """
+        Gather the rows of a view from its base batcher (nothing is done for other batchers)
+
+        Returns
+        -------
+        Batcher
+        """
+        self.tables
+        return self
+
     def __len__(self):
+        if self._tables is None:
+            return len(self._idx)
         return next(iter(self.tables[self.main_table].values())).shape[0]
 
     @property
     def device(self):
-        return getattr(next(iter(self.tables[self.main_table].values())), 'device', None)
+        if self._tables is None:
+            return self._base.device
+        col = next(iter(self.tables[self.main_table].values()))
+        return col.device if torch.is_tensor(col) else None
 
     @property
     def shape(self):
@@ -442,8 +1233,8 @@ class Batcher:
         return self.tables[self.main_table].items()
 
     def copy(self):
-        return Batcher(
-            {key: dict(table) for key, table in self.tables.items()},
+        res = Batcher(
+            {key: dict(table) for key, table in self._tables.items()} if self._tables is not None else None,
             main_table=self.main_table,
             masks=dict(self.masks),
             subcolumn_names=dict(self.subcolumn_names),
@@ -451,10 +1242,42 @@ class Batcher:
             primary_ids=dict(self.primary_ids),
             check=False,
         )
+        # The plan only depends on the structure of the batcher, and is checked against it before being used
+        res.query_plan = self.query_plan
+        # Indexes are checked against the primary ids they were built from, and can be shared between copies
+        res.id_indexes = self.id_indexes
+        # Copies of a view are views of the same rows
+        if self._tables is None:
+            res._tables, res._base, res._idx = None, self._base, self._idx
+        return res
+
+    def id_index(self, table_name):
+        """
+        Persistent index from the primary ids of a table to its row numbers, built on first use
+        and rebuilt only if the primary ids column is replaced
+
+        Parameters
+        ----------
+        table_name: str
+
+        Returns
+        -------
+        IdIndex or None
+            None if the primary ids are not a numpy array
+        """
+        ids = self.tables[table_name][self.primary_ids[table_name]]
+        if not isinstance(ids, np.ndarray):
+            return None
+        index = self.id_indexes.get(table_name, None)
+        if index is None or index.ids is not ids:
+            index = self.id_indexes[table_name] = IdIndex(ids)
+        return index
 
     def set_main_table(self, name, inplace=False):
         if not inplace:
             self = self.copy()
+        # The rows of a view are rows of the main table of its base
+        self.gather()
         self.main_table = name
         if not inplace:
             return self
@@ -465,15 +1288,22 @@ class Batcher:
         if isinstance(indexer, slice):
             device = self.device
             if device is None:
-                indexer = np.arange(indexer.start or 0, indexer.stop, indexer.step or 1)
+                indexer = np.arange(*indexer.indices(len(self)))
             else:
-                indexer = torch.arange(indexer.start or 0, indexer.stop, indexer.step or 1, device=device)
+                indexer = torch.arange(*indexer.indices(len(self)), device=device)
         if isinstance(indexer, tuple):
-            if indexer[0] not in self.tables:
+            table_names = self._base.tables if self._tables is None else self.tables
+            if indexer[0] not in table_names:
                 indexer = (self.main_table, *indexer)
-            current = self.tables[indexer[0]]
             if len(indexer) == 1:
                 return self.slice_tables({indexer[0]: slice(None)})
+            if self._tables is None and indexer[0] == self._base.main_table and all(
+                  self.is_plain_main_column(name) for name in (indexer[1] if isinstance(indexer[1], list) else [indexer[1]])):
+                # Columns that are not modified by query_ids are directly gathered from the base of the view
+                current = {name: self._base.tables[indexer[0]][name][self._idx]
+                           for name in (indexer[1] if isinstance(indexer[1], list) else [indexer[1]])}
+            else:
+                current = self.tables[indexer[0]]
             if len(indexer) > 1:
                 if isinstance(indexer[1], list):
                     current = [current[name] for name in indexer[1]]
@@ -506,7 +1336,7 @@ class Batcher:
             if isinstance(indexer[0], str):
                 return self.slice_tables({table_name: slice(None) for table_name in indexer})
             else:
-                return self.query_ids(indexer)
+                return self.view(indexer)
         elif isinstance(indexer, dict):
             return self.slice_tables(indexer)
         else:
@@ -515,12 +1345,22 @@ class Batcher:
                     indexer = indexer.toarray()
                 else:
                     indexer = np.asarray(indexer)
-            if len(indexer.shape) == 1 and indexer.dtype == np.bool:
-                return self.query_ids(np.flatnonzero(indexer))
+            if len(indexer.shape) == 1 and not torch.is_tensor(indexer) and indexer.dtype == bool:
+                return self.view(np.flatnonzero(indexer))
             elif len(indexer.shape) == 1 and torch.is_tensor(indexer) and indexer.dtype == torch.bool:
-                return self.query_ids(torch.nonzero(indexer, as_tuple=True)[0])
+                return self.view(torch.nonzero(indexer, as_tuple=True)[0])
             else:
-                return self.query_ids(indexer)
+                return self.view(indexer)
+
+    def is_plain_main_column(self, col_name):
+        """
+        Is this column of the main table returned as is (only indexed by the queried rows) by `query_ids`,
+        ie. is it neither a foreign id nor a mask / masked column
+        """
+        masks = self.masks.get(self.main_table, {})
+        return (col_name not in self.foreign_ids.get(self.main_table, {}) and
+                col_name not in masks and
+                col_name not in masks.values())
 
     def __setitem__(self, key, value):
         if isinstance(key, str):
@@ -581,18 +1421,190 @@ class Batcher:
                    shuffle=False,
                    device=None,
                    dtypes=None,
+                   share_memory=False,
+                   max_tokens=None,
+                   prefetch=0,
+                   pin_memory=None,
+                   distributed=False,
+                   seed=0,
                    **kwargs):
+        """
+        Make a torch DataLoader that yields queried (and optionally densified) batches of this batcher
+
+        Parameters
+        ----------
+        batch_size: int
+        sparse_sort_on: str
+            If given, group samples of similar lengths in this column (see `SparseBatchSampler`)
+        max_tokens: int
+            If given, pack samples of similar lengths in `sparse_sort_on` into batches of at most
+            `max_tokens` padded tokens, and at most `batch_size` samples (see `SparseBatchSampler`)
+        shuffle: bool
+        device: torch.device
+            If given, batches are densified on this device
+        dtypes: dict
+            Dtypes of the densified columns
+        share_memory: bool or str
+            Move the columns to memory maps before sending the batcher to the workers (see `share_memory`).
+            If a str is given, it is used as the directory of the memory mapped files.
+            Prefer calling `share_memory` once on the batcher if you create a dataloader at each epoch.
+        prefetch: int
+            If > 0, batches are densified on the cpu and moved to `device` this number of batches in advance
+            by a background thread (see `BatchPrefetcher`)
+        pin_memory: bool or None
+            When prefetching, copy the batches to reused pinned buffers before sending them to the device.
+            By default, only on CUDA devices. Without prefetching, passed to the DataLoader to pin the
+            cpu tensors of the batches (see `Batcher.pin_memory`).
+        distributed: bool
+            Split the batches between the processes of the default torch.distributed process group.
+            All processes must create the dataloader with the same parameters, and call `set_epoch` on its
+            sampler at each epoch to change the shuffling (see `nlstruct.xp_helpers.train_epoch`).
+        seed: int
+            Seed of the shuffling of distributed batches
+        kwargs: any
+            Other DataLoader parameters, such as num_workers
+
+        Returns
+        -------
+        DataLoader or BatchPrefetcher
+        """
         batch_sampler = kwargs.pop("batch_sampler", None)
+        num_replicas, rank = (get_world_size(), get_rank()) if distributed else (None, None)
         if sparse_sort_on is not None:
-            batch_sampler = SparseBatchSampler(self, on=sparse_sort_on, batch_size=batch_size, shuffle=shuffle, drop_last=False)
+            batch_sampler = SparseBatchSampler(self, on=sparse_sort_on, batch_size=batch_size, shuffle=shuffle, drop_last=False, max_tokens=max_tokens,
+                                               num_replicas=num_replicas, rank=rank, seed=seed)
         else:
+            assert max_tokens is None, "sparse_sort_on must be given to compute the number of tokens of the samples"
             kwargs['batch_size'] = batch_size
-            kwargs['shuffle'] = shuffle
-        self = self.switch_foreign_ids_mode("relative")
-        return DataLoader(range(len(self)),  # if self._idx is None else self._idx,
-                          collate_fn=lambda ids: self.query_ids(ids, device=device, dtypes=dtypes),
-                          batch_sampler=batch_sampler,
-                          **kwargs)
+            if distributed:
+                kwargs['sampler'] = DistributedSampler(range(len(self)), num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed)
+            else:
+                kwargs['shuffle'] = shuffle
+        if self._tables is None:
+            # Views are loaded from their base batcher, without gathering their rows
+            dataset, self = as_numpy_array(self._idx), self._base
+        else:
+            dataset, self = range(len(self)), self.switch_foreign_ids_mode("relative")
+        if share_memory:
+            self = self.share_memory(path=share_memory if isinstance(share_memory, str) else None)
+        # When prefetching, the padding and dtype conversions are done on the cpu by the loader,
+        # and the prefetcher only moves the tensors to the device
+        collate_device = torch.device("cpu") if prefetch and device is not None else device
+        if not prefetch:
+            kwargs['pin_memory'] = bool(pin_memory)
+        loader = DataLoader(dataset,
+                            collate_fn=BatcherCollate(self, device=collate_device, dtypes=dtypes),
+                            batch_sampler=batch_sampler,
+                            **kwargs)
+        if prefetch:
+            return BatchPrefetcher(loader, device=device, prefetch=prefetch, pin_memory=pin_memory)
+        return loader
+
+    def share_memory(self, path=None, inplace=False):
+        """
+        Move the numpy columns and the data / indices / indptr components of the sparse columns
+        into read-only memory mapped .npy files, and the torch tensors to shared memory.
+        The batcher can then be sent to multiple DataLoader workers (see `BatcherCollate`)
+        that will all read the same pages instead of holding their own copy.
+
+        Parameters
+        ----------
+        path: str
+            Directory of the memory mapped files. If None, a temporary directory is created
+            (in /dev/shm if available) and deleted when the process exits
+        inplace: bool
+
+        Returns
+        -------
+        Batcher
+        """
+        if not inplace:
+            self = self.copy()
+        if path is None:
+            path = tempfile.mkdtemp(prefix="batcher-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+            atexit.register(shutil.rmtree, path, True)
+        os.makedirs(path, exist_ok=True)
+
+        for table_name, table in self.tables.items():
+            os.makedirs(os.path.join(path, table_name), exist_ok=True)
+            for col_name, col in list(table.items()):
+                prefix = os.path.join(path, table_name, col_name)
+                if issparse(col) or isinstance(col, RaggedMask) or (isinstance(col, np.ndarray) and not col.dtype.hasobject):
+                    table[col_name] = load_column(save_column(col, prefix), prefix, mmap=True)
+                elif torch.is_tensor(col):
+                    table[col_name] = col.share_memory_()
+
+        if not inplace:
+            return self
+
+    def save(self, path):
+        """
+        Save the batcher in a directory, with one raw .npy file per column (data / indices / indptr files
+        for sparse columns) and a manifest.json file describing the masks, foreign ids, primary ids
+        and subcolumn names. Unlike pickles, the columns can then be memory mapped by `Batcher.load`.
+
+        This method can be used as a cache dumper:
+        >>> cache.dump(batcher, "batcher", dumper=Batcher.save)
+        >>> cache.load("batcher", loader=Batcher.load)
+
+        Parameters
+        ----------
+        path: str
+
+        Returns
+        -------
+        str
+        """
+        path = str(path)
+        os.makedirs(path, exist_ok=True)
+        columns = {}
+        for table_name, table in self.tables.items():
+            os.makedirs(os.path.join(path, table_name), exist_ok=True)
+            for col_name, col in table.items():
+                columns.setdefault(table_name, {})[col_name] = save_column(col, os.path.join(path, table_name, col_name))
+        manifest = {
+            "main_table": self.main_table,
+            "columns": columns,
+            "masks": self.masks,
+            "subcolumn_names": self.subcolumn_names,
+            "foreign_ids": self.foreign_ids,
+            "primary_ids": self.primary_ids,
+        }
+        with open(os.path.join(path, "manifest.json"), "w") as file:
+            json.dump(manifest, file, indent=2)
+        return path
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load a batcher saved with `Batcher.save`
+
+        Parameters
+        ----------
+        path: str
+        mmap: bool
+            Map the column files in memory (read-only) instead of reading them: loading is almost
+            instant and processes that load the same batcher share the same pages
+
+        Returns
+        -------
+        Batcher
+        """
+        path = str(path)
+        with open(os.path.join(path, "manifest.json"), "r") as file:
+            manifest = json.load(file)
+        return Batcher(
+            {table_name: {col_name: load_column(description, os.path.join(path, table_name, col_name), mmap=mmap)
+                          for col_name, description in table.items()}
+             for table_name, table in manifest["columns"].items()},
+            main_table=manifest["main_table"],
+            masks=manifest["masks"],
+            subcolumn_names=manifest["subcolumn_names"],
+            foreign_ids={table_name: {col_name: tuple(foreign) for col_name, foreign in cols.items()}
+                         for table_name, cols in manifest["foreign_ids"].items()},
+            primary_ids=manifest["primary_ids"],
+            check=False,
+        )
 
     @classmethod
     def query_table(cls, table, ids):
@@ -678,7 +1690,8 @@ class Batcher:
                     mask=[self.tables[other_table_referencing_it].get(self.masks.get(other_table_referencing_it, {}).get(other_table_foreign_id, None), None)
                           for other_table_referencing_it, other_table_foreign_id in others],
                     reference_values=self.tables[table_name][self.primary_ids[table_name]],
-                    freeze_reference=True
+                    freeze_reference=True,
+                    reference_index=self.id_index(table_name),
                 )[:2]
                 for (table_name, table_col_name), table_foreign_ids, table_foreign_mask in zip(others, new_relative_ids, new_masks):
                     self.tables[table_name][table_col_name] = table_foreign_ids
@@ -694,7 +1707,7 @@ class Batcher:
                         if foreign_table_name not in self.primary_ids:
                             raise Exception(f"Table {foreign_table_name} is missing its primary id in order to switch {table_name}/{table_foreign_id_col} to absolute mode")
                         if issparse(array_to_change):
-                            array_to_change = self.tables[table_name][table_foreign_id_col] = array_to_change.tocsr()
+                            array_to_change = self.tables[table_name][table_foreign_id_col] = array_to_change.tocsr(copy=True)
                             array_to_change.data = self.tables[foreign_table_name][self.primary_ids[foreign_table_name]][array_to_change.data]
                         else:
                             self.tables[table_name][table_foreign_id_col] = self.tables[foreign_table_name][self.primary_ids[foreign_table_name]][array_to_change]
@@ -770,7 +1783,7 @@ class Batcher:
         for table_name, table in self.tables.items():
             new_table = {}
             for col_name, col in table.items():
-                if issparse(col):
+                if issparse(col) or isinstance(col, RaggedMask):
                     col = col.toarray()
                 if isinstance(col, pd.DataFrame):
                     new_column_names.setdefault(table_name, {}).setdefault(col_name, list(col.columns))
@@ -789,10 +1802,31 @@ class Batcher:
         res.tables = new_tables
         return res
 
-    def sparsify(self):
+    def pin_memory(self):
+        """
+        Copy the cpu tensors of the batcher to page-locked memory, called by the DataLoader on each batch
+        when its pin_memory parameter is True
+
+        Returns
+        -------
+        Batcher
+        """
+        res = self.copy()
+        res.tables = {table_name: {col_name: col.pin_memory() if torch.is_tensor(col) and col.device.type == "cpu" else col
+                                   for col_name, col in table.items()}
+                      for table_name, table in self.tables.items()}
+        return res
+
+    def sparsify(self, ragged_masks=False):
         """
         Converts the columns into numpy arrays and scipy sparse arrays
 
+        Parameters
+        ----------
+        ragged_masks: bool
+            Also encode the masks whose rows are all prefixes as RaggedMask (masks that
+            already are RaggedMask are always kept as is)
+
         Returns
         -------
         Batcher
@@ -801,13 +1835,28 @@ class Batcher:
         new_tables = {}
         densified_masks = {}
         sparsified_masks = {}
+        raggedified_masks = {}
 
         # First sparsify column that have masks
         for table_name, table_masks in self.masks.items():
             for col_name, mask_name in table_masks.items():
                 mask = self.tables[table_name][mask_name]
                 col = self.tables[table_name][col_name]
+                if ragged_masks and not isinstance(mask, RaggedMask):
+                    if (table_name, mask_name) not in raggedified_masks:
+                        raggedified_masks[(table_name, mask_name)] = RaggedMask.from_mask(mask)
+                    if raggedified_masks[(table_name, mask_name)] is not None:
+                        mask = raggedified_masks[(table_name, mask_name)]
+                if isinstance(mask, RaggedMask):
+                    if not issparse(col):
+                        data = as_numpy_array(col)[mask.toarray()]
+                        col = mask.tocsr()
+                        col.data = data
+                    new_tables.setdefault(table_name, {}).setdefault(mask_name, mask)
+                    new_tables.setdefault(table_name, {}).setdefault(col_name, col.tocsr())
+                    continue
                 if issparse(mask) and not issparse(col):
+                    mask = mask.tocsr()
                     if mask_name not in densified_masks:
                         densified_masks[mask_name] = mask.toarray()
                     col = as_numpy_array(col)
@@ -815,6 +1864,7 @@ class Batcher:
                     col = mask.copy()
                     col.data = data
                 elif issparse(col) and not issparse(mask):
+                    col = col.tocsr()
                     if mask_name not in sparsified_masks:
                         sparsified_masks[mask_name] = mask = csr_matrix(as_numpy_array(mask))
                     else:
@@ -827,14 +1877,14 @@ class Batcher:
                         mask = sparsified_masks[mask_name]
                     col = mask.copy()
                     col.data = data
-                new_tables.setdefault(table_name, {}).setdefault(mask_name, mask.tolil())
-                new_tables.setdefault(table_name, {}).setdefault(col_name, col.tolil())
+                new_tables.setdefault(table_name, {}).setdefault(mask_name, mask.tocsr())
+                new_tables.setdefault(table_name, {}).setdefault(col_name, col.tocsr())
 
         # Then convert the other columns as numpy arrays
         for table_name, table in self.tables.items():
             for col_name, col in table.items():
                 if new_tables.get(table_name, {}).get(col_name, None) is None:
-                    new_tables.setdefault(table_name, {})[col_name] = as_numpy_array(col) if not issparse(col) else col
+                    new_tables.setdefault(table_name, {})[col_name] = as_numpy_array(col) if not (issparse(col) or isinstance(col, RaggedMask)) else col
 
         res = self.copy()
         res.tables = new_tables
@@ -863,81 +1913,150 @@ class Batcher:
             check=False, )
         return res
 
-    def query_ids(self, ids, **densify_kwargs):
-        if not all(mode == "relative"
-                   for table_name, col_to_modes in self.foreign_ids.items()
-                   for col_name, (_, mode) in col_to_modes.items()):
-            self = self.switch_foreign_ids_mode("relative")
-        device = self.device
-        if device is not None:
-            ids = torch.as_tensor(ids, device=device)
-        selected_ids = {self.main_table: ids}
-        queried_tables = {}
-        queue = {self.main_table}
+    def query_plan_signature(self):
+        """
+        Structure of the batcher that determines its query plan: main table, columns, foreign ids and masks
+        """
+        return (
+            self.main_table,
+            tuple((table_name, tuple(table.keys())) for table_name, table in self.tables.items()),
+            tuple((table_name, tuple((col_name, foreign_table_name) for col_name, (foreign_table_name, _) in cols.items()))
+                  for table_name, cols in self.foreign_ids.items()),
+            tuple((table_name, tuple(cols.items())) for table_name, cols in self.masks.items()),
+        )
+
+    def compile_query_plan(self):
+        """
+        Walk the foreign ids graph from the main table once, and record the traversal order of the tables,
+        the foreign ids / masks bindings and the columns to gather so that `query_ids` can replay them for
+        each batch. The plan is cached on the batcher (and its copies) until its structure changes.
+
+        Returns
+        -------
+        QueryPlan
+        """
+        signature = self.query_plan_signature()
+        if self.query_plan is not None and self.query_plan.signature == signature:
+            return self.query_plan
+
+        steps = []
+        queried = set()
+        queue = [self.main_table]
         while len(queue):
-            table_name = queue.pop()
+            table_name = queue.pop(0)
             # Ex: table_name = relations
-            table = self.tables[table_name]
-            try:
-                queried_table = self.query_table(table, selected_ids[table_name])
-            except:
-                raise Exception(f"Exception occured while querying table {repr(table_name)}. Previously queried tables are {repr(tuple(queried_tables.keys()))}")
-            logging.debug(f"Queried table {repr(table_name)}. Previously queried tables are {repr(tuple(queried_tables.keys()))}")
-            for col_name, col in queried_table.items():
+            bindings = []
+            for col_name in self.tables[table_name]:
                 # Ex: col_name = from_mention_id
                 #     foreign_table_name = mention
-                #     foreign_table_id = mention_id
                 foreign_table_name, mode = self.foreign_ids.get(table_name, {}).get(col_name, (None, None))
                 # We don't want to reindex the token_id column in the token table: it's useless and we will
                 # moreover need it intact for when we rebuild the original data
                 if foreign_table_name and foreign_table_name != table_name:
-                    # assert mode == "relative", "You must first switch the mode of the {}/{} column to 'relative' using the method switch_foreign_ids_mode"
-                    mask_name = self.masks.get(table_name, {}).get(col_name, None)
-                    new_col, new_mask, unique_ids = factorize(
-                        values=col,
-                        mask=queried_table.get(mask_name, None),
-                        reference_values=selected_ids.get(foreign_table_name, None),
+                    bindings.append((
+                        col_name,
+                        foreign_table_name,
+                        self.masks.get(table_name, {}).get(col_name, None),
                         # If querying was done against the main axis primary ids (main_table)
                         # then we don't want to any more ids than those that were given
                         # ex: batcher.set_main("relation")[:10] => only returns relations 0, 1, ... 9
                         # If a table refers to other relations through foreign keys, then those pointers will be masked
                         # For non main ids (ex: mentions), we allow different tables to disagree on the mentions to query
                         # and retrieve all of the needed mentions
-                        freeze_reference=foreign_table_name in queried_tables,
-                    )
-                    # new_col, new_mask, unique_ids = col, queried_table.get(mask_name, None), col.tocsr().data if hasattr(col, 'tocsr') else col#selected_ids.get(foreign_table_name, None)
-                    if mask_name is not None:
-                        queried_table[mask_name] = new_mask
-                    selected_ids[foreign_table_name] = unique_ids
-                    queried_table[col_name] = new_col
-                    if foreign_table_name not in queried_tables:
-                        queue.add(foreign_table_name)
+                        foreign_table_name in queried,
+                    ))
+                    if foreign_table_name not in queried and foreign_table_name not in queue:
+                        queue.append(foreign_table_name)
+            steps.append((table_name, list(self.tables[table_name].keys()), bindings))
+            queried.add(table_name)
+
+        mask_bindings = [(table_name, col_name, mask_name)
+                         for table_name, table_masks in self.masks.items() if table_name in queried
+                         for col_name, mask_name in table_masks.items()]
+
+        self.query_plan = QueryPlan(self.main_table, steps, mask_bindings, signature)
+        return self.query_plan
+
+    def query_ids(self, ids, plan=None, **densify_kwargs):
+        """
+        Query rows of the main table and all the rows of the other tables that they refer to
+
+        Parameters
+        ----------
+        ids: np.ndarray or torch.Tensor or list of int
+            Row numbers in the main table
+        plan: QueryPlan
+            Precompiled plan (see `compile_query_plan`), compiled from the batcher if None
+        densify_kwargs: any
+            If given, the result is densified with these parameters
+
+        Returns
+        -------
+        Batcher
+        """
+        if self._tables is None:
+            # The view itself is not gathered, only the queried rows of its base
+            return self._base.query_ids(self.compose_ids(ids), plan=plan, **densify_kwargs)
+        if not all(mode == "relative"
+                   for table_name, col_to_modes in self.foreign_ids.items()
+                   for col_name, (_, mode) in col_to_modes.items()):
+            self = self.switch_foreign_ids_mode("relative")
+        if plan is None:
+            plan = self.compile_query_plan()
+        device = self.device
+        if device is not None:
+            ids = torch.as_tensor(ids, device=device)
+        selected_ids = {plan.main_table: ids}
+        queried_tables = {}
+        for table_name, col_names, bindings in plan.steps:
+            table = self.tables[table_name]
+            try:
+                table_ids = selected_ids[table_name]
+                queried_table = {col_name: table[col_name][table_ids] for col_name in col_names}
+            except:
+                raise Exception(f"Exception occured while querying table {repr(table_name)}. Previously queried tables are {repr(tuple(queried_tables.keys()))}")
+            logging.debug(f"Queried table {repr(table_name)}. Previously queried tables are {repr(tuple(queried_tables.keys()))}")
+            for col_name, foreign_table_name, mask_name, freeze_reference in bindings:
+                new_col, new_mask, unique_ids = factorize(
+                    values=queried_table[col_name],
+                    mask=queried_table.get(mask_name, None),
+                    reference_values=selected_ids.get(foreign_table_name, None),
+                    freeze_reference=freeze_reference,
+                )
+                if mask_name is not None:
+                    queried_table[mask_name] = new_mask
+                selected_ids[foreign_table_name] = unique_ids
+                queried_table[col_name] = new_col
             queried_tables[table_name] = queried_table
 
         masks_length = {}
-        for table_name, table_masks in self.masks.items():
-            for col_name, mask_name in table_masks.items():
-                if mask_name not in masks_length:
-                    if issparse(queried_tables[table_name][mask_name]):
-                        if hasattr(queried_tables[table_name][mask_name], 'indices'):
-                            if len(queried_tables[table_name][mask_name].indices):
-                                max_length = queried_tables[table_name][mask_name].indices.max() + 1
-                            else:
-                                max_length = 0
-                        elif hasattr(queried_tables[table_name][mask_name], 'rows'):
-                            max_length = max((max(r, default=-1) + 1 for r in queried_tables[table_name][mask_name].rows), default=0)
-                        else:
-                            raise Exception(f"Unrecognized mask format for {mask_name}: {queried_tables[table_name][mask_name].__class__}")
-                        masks_length[mask_name] = max_length
-                        queried_tables[table_name][mask_name].resize(queried_tables[table_name][mask_name].shape[0], masks_length[mask_name])
-                    else:
-                        max_length = queried_tables[table_name][mask_name].sum(-1).max()
-                        masks_length[mask_name] = max_length
-                        queried_tables[table_name][mask_name] = queried_tables[table_name][mask_name][:, :masks_length[mask_name]]
-                if issparse(queried_tables[table_name][col_name]):
-                    queried_tables[table_name][col_name].resize(queried_tables[table_name][col_name].shape[0], masks_length[mask_name])
+        for table_name, col_name, mask_name in plan.mask_bindings:
+            if mask_name not in masks_length:
+                if isinstance(queried_tables[table_name][mask_name], RaggedMask):
+                    lengths = queried_tables[table_name][mask_name].lengths
+                    masks_length[mask_name] = int(lengths.max()) if len(lengths) else 0
+                    queried_tables[table_name][mask_name].resize(len(lengths), masks_length[mask_name])
+                elif issparse(queried_tables[table_name][mask_name]):
+                    if not hasattr(queried_tables[table_name][mask_name], 'indices'):
+                        queried_tables[table_name][mask_name] = queried_tables[table_name][mask_name].tocsr()
+                    indices = queried_tables[table_name][mask_name].indices
+                    max_length = int(indices.max()) + 1 if len(indices) else 0
+                    masks_length[mask_name] = max_length
+                    queried_tables[table_name][mask_name].resize(queried_tables[table_name][mask_name].shape[0], masks_length[mask_name])
                 else:
-                    queried_tables[table_name][col_name] = queried_tables[table_name][col_name][:, :masks_length[mask_name]]
+                    # Last active column of the mask (masks may have holes after a freeze_reference factorization),
+                    # only one scalar is read back from the device of torch masks
+                    active_columns = queried_tables[table_name][mask_name].any(0).nonzero()
+                    if torch.is_tensor(active_columns):
+                        max_length = int(active_columns[-1]) + 1 if len(active_columns) else 0
+                    else:
+                        max_length = int(active_columns[0][-1]) + 1 if len(active_columns[0]) else 0
+                    masks_length[mask_name] = max_length
+                    queried_tables[table_name][mask_name] = queried_tables[table_name][mask_name][:, :masks_length[mask_name]]
+            if issparse(queried_tables[table_name][col_name]):
+                queried_tables[table_name][col_name].resize(queried_tables[table_name][col_name].shape[0], masks_length[mask_name])
+            else:
+                queried_tables[table_name][col_name] = queried_tables[table_name][col_name][:, :masks_length[mask_name]]
 
         new_tables = dict(self.tables)
         new_tables.update(queried_tables)
@@ -951,96 +2070,448 @@ class Batcher:
     @classmethod
     def concat(cls, batches, sparsify=True, allow_non_unique_primary_ids=False):
         """
+        Concatenate batches (see `BatcherAccumulator` to concatenate them as they are produced)
 
         Parameters
         ----------
         batches: list of Batcher
             All those batches must have the same structure
+        sparsify: bool
+            Convert the masked columns to sparse matrices
+        allow_non_unique_primary_ids: bool
 
         Returns
         -------
         Batcher
         """
+        accumulator = BatcherAccumulator(sparsify=sparsify, allow_non_unique_primary_ids=allow_non_unique_primary_ids)
+        for batch in batches:
+            accumulator.append(batch)
+        return accumulator.finalize()
 
-        struct = batches[0].copy()
-        new_tables = {}
+    @classmethod
+    def from_dataset(cls, dataset, schema, ragged_masks=False, return_ids=False):
+        """
+        Build a Batcher from the frames of a dataset in one vectorized pass, instead of calling `factorize_rows`
+        and `df_to_csr` for each column
+
+        Each table of the schema describes where its rows and columns are read from:
+        - "id": column that identifies the rows of the table, in its frame and its nested frames
+        - "frame": frame whose rows are the rows of the table (otherwise the rows are the distinct ids of the nested frames)
+        - "columns": {batcher column: frame column (or list of frame columns)} read from "frame"
+        - "nested": {frame: {"columns": {...}, "position": column, "mask": name}} frames with many rows per row of the table,
+          whose columns become CSR matrices. Elements are placed at their "position" in their row if given, by order of appearance
+          otherwise, and the "mask" (defaults to "<frame>_mask") tells which elements exist. Nested columns are read from a single
+          frame column each: lists of frame columns are only allowed in "columns".
+
+        Every table with an "id" gets a "<table>_id" primary id column, and the columns named "<table>_id" are remapped to the rows of
+        this table, in "absolute" mode. Categorical columns are replaced by their codes.
+
+        >>> batcher = Batcher.from_dataset(dataset, {
+        ...     "doc": {"id": "doc_id", "nested": {
+        ...         "tokens": {"columns": {"token_norm": "token_norm", "token_tag": "tag"}, "position": "token_idx", "mask": "token_mask"},
+        ...         "mentions": {"columns": {"mention_id": "mention_id"}, "mask": "mention_mask"}}},
+        ...     "mention": {"id": "mention_id", "frame": "mentions", "columns": {"doc_id": "doc_id", "begin": "begin", "end": "end", "category": "category"}},
+        ... }).prepare_for_indexing()
+
+        Parameters
+        ----------
+        dataset: Dataset or dict of pd.DataFrame
+        schema: dict
+            The first table is the main table
+        ragged_masks: bool
+            Store the masks of the nested columns as RaggedMask instead of CSR matrices
+        return_ids: bool
+            Also return the original ids of the rows of each table
+
+        Returns
+        -------
+        Batcher or (Batcher, dict of np.ndarray)
+        """
+        rows = {}
+        table_ids = dataset_table_ids(dataset, schema, rows=rows)
+        tables, masks, subcolumn_names = build_dataset_tables(dataset, schema, table_ids, ragged_masks=ragged_masks, rows=rows)
+        batcher = Batcher(tables, masks=masks, subcolumn_names=subcolumn_names, foreign_ids="absolute")
+        if return_ids:
+            return batcher, table_ids
+        return batcher
+
+    @classmethod
+    def iter_from_dataset(cls, dataset, schema, chunk_size=10000, ragged_masks=False, return_ids=False):
+        """
+        Streaming variant of `from_dataset`, that yields a Batcher for every `chunk_size` rows of the main table,
+        for instance to write them with a `BatcherShardWriter` without building the whole corpus in memory
+
+        The rows of the frames that have the id column of the main table are split between the chunks in a single pass.
+        The tables whose frames do not have this column (such as a charset shared by the documents) are built once,
+        and each chunk only keeps the rows of these tables that it refers to. These shared tables cannot refer to the other tables.
+        Primary ids continue from one chunk to the next, so the chunks can be concatenated with `Batcher.concat`
+        (with `allow_non_unique_primary_ids=True` if there are shared tables).
+
+        >>> writer = BatcherShardWriter("/data/mimic_shards")
+        >>> for batcher in Batcher.iter_from_dataset(dataset, schema, chunk_size=10000):
+        ...     writer.write(batcher)
+
+        Parameters
+        ----------
+        dataset: Dataset or dict of pd.DataFrame
+        schema: dict
+            See `from_dataset`
+        chunk_size: int
+            Number of rows of the main table in each chunk
+        ragged_masks: bool
+        return_ids: bool
+            Also yield the original ids of the rows of each table of the chunk
+
+        Returns
+        -------
+        iterable of Batcher or of (Batcher, dict of np.ndarray)
+        """
+        main_table = next(iter(schema))
+        main_id = schema[main_table].get("id", None)
+        assert main_id is not None, f"Main table {repr(main_table)} must have an 'id' to be split in chunks"
+        main_ids = dataset_table_ids(dataset, {main_table: schema[main_table]})[main_table]
+        main_index = pd.Index(main_ids)
+
+        frame_names = {frame_name for table_schema in schema.values() for frame_name in schema_frames(table_schema)}
+        chunked_frames = {frame_name for frame_name in frame_names if main_id in dataset[frame_name].columns}
+        chunked_tables = [table_name for table_name, table_schema in schema.items() if any(name in chunked_frames for name in schema_frames(table_schema))]
+        shared_table_names = [table_name for table_name in schema if table_name not in chunked_tables]
+        for table_name in chunked_tables:
+            for frame_name in schema_frames(schema[table_name]):
+                if frame_name not in chunked_frames:
+                    raise Exception(f"Frame {repr(frame_name)} of table {repr(table_name)} must have a {repr(main_id)} column to be split in chunks")
+
+        # Sort the rows of each chunked frame by chunk once, each chunk is then a contiguous slice of rows
+        n_chunks = (len(main_ids) + chunk_size - 1) // chunk_size
+        frame_slices = {}
+        for frame_name in chunked_frames:
+            frame = dataset[frame_name]
+            chunks = main_index.get_indexer(np.asarray(frame[main_id]))
+            if len(chunks) and chunks.min() < 0:
+                raise Exception(f"Some ids of {frame_name}/{main_id} could not be found in table {repr(main_table)}")
+            chunks //= chunk_size
+            order = None if (np.diff(chunks) >= 0).all() else np.argsort(chunks, kind="stable")
+            bounds = np.searchsorted(chunks if order is None else chunks[order], np.arange(n_chunks + 1))
+            frame_slices[frame_name] = (frame, order, bounds)
+
+        rows = {}
+        shared_ids = dataset_table_ids(dataset, {table_name: schema[table_name] for table_name in shared_table_names}, rows=rows)
+        shared_tables, shared_masks, shared_subcolumn_names = build_dataset_tables(dataset, schema, shared_ids, subset=shared_table_names, ragged_masks=ragged_masks, rows=rows)
+
+        offsets = {}
+        for chunk_idx in range(n_chunks):
+            chunk_dataset = {}
+            for frame_name, (frame, order, bounds) in frame_slices.items():
+                begin, end = bounds[chunk_idx], bounds[chunk_idx + 1]
+                chunk_dataset[frame_name] = frame.iloc[begin:end] if order is None else frame.iloc[order[begin:end]]
+            rows = {}
+            chunk_ids = {**shared_ids, **dataset_table_ids(chunk_dataset, {table_name: schema[table_name] for table_name in chunked_tables}, rows=rows)}
+            tables, masks, subcolumn_names = build_dataset_tables(chunk_dataset, schema, chunk_ids, subset=chunked_tables, offsets=offsets, ragged_masks=ragged_masks, rows=rows)
+            batcher = Batcher(
+                {table_name: tables[table_name] if table_name in tables else dict(shared_tables[table_name]) for table_name in schema},
+                masks={**shared_masks, **masks},
+                subcolumn_names={**shared_subcolumn_names, **subcolumn_names},
+                foreign_ids="absolute")
+            if len(shared_table_names):
+                # Only keep the rows of the shared tables that the chunk refers to
+                batcher = batcher.prepare_for_indexing().query_ids(np.arange(len(batcher))).switch_foreign_ids_mode("absolute")
+            if return_ids:
+                # Rows may have been reordered by the query, primary ids tell which row is which
+                yield batcher, {table_name: ids[batcher.tables[table_name][f"{table_name}_id"] - offsets.get(table_name, 0)]
+                                for table_name, ids in chunk_ids.items()}
+            else:
+                yield batcher
+            for table_name in chunked_tables:
+                if table_name in chunk_ids:
+                    offsets[table_name] = offsets.get(table_name, 0) + len(chunk_ids[table_name])
+
+
+class DenseColumnBuffer:
+    """
+    Growable numpy buffer: rows are appended in a preallocated array whose capacity grows geometrically,
+    and whose trailing dimensions grow (zero padded) to fit the largest appended array
+    """
+
+    def __init__(self, growth=2.):
+        self.growth = growth
+        self.array = None
+        self.length = 0
+
+    def reserve(self, length, shape=(), dtype=np.int64):
+        """
+        Make room for `length` rows of trailing shape `shape` after the last appended rows, and return the
+        view of the buffer where they must be written
+        """
+        if self.array is None:
+            self.array = np.zeros((max(length, 1), *shape), dtype=dtype)
+        dtype = np.result_type(self.array.dtype, dtype) if not self.array.dtype.hasobject else self.array.dtype
+        trailing_shape = tuple(np.maximum(self.array.shape[1:], shape))
+        capacity = self.array.shape[0]
+        if self.length + length > capacity:
+            capacity = max(int(capacity * self.growth), self.length + length)
+        if capacity != self.array.shape[0] or trailing_shape != self.array.shape[1:] or dtype != self.array.dtype:
+            new_array = np.zeros((capacity, *trailing_shape), dtype=dtype)
+            new_array[(slice(0, self.length), *(slice(0, n) for n in self.array.shape[1:]))] = self.array[:self.length]
+            self.array = new_array
+        view = self.array[(slice(self.length, self.length + length), *(slice(0, n) for n in shape))]
+        self.length += length
+        return view
+
+    def append(self, array, offset=0):
+        """
+        Append the rows of `array`, adding `offset` to them as they are written
+        """
+        array = as_numpy_array(array)
+        view = self.reserve(len(array), array.shape[1:], array.dtype)
+        view[...] = array
+        if offset:
+            view += offset
+
+    def append_range(self, start, stop):
+        """
+        Append the integers from `start` to `stop` (excluded)
+        """
+        view = self.reserve(stop - start)
+        view[...] = np.arange(start, stop)
+
+    def finalize(self, shape1=None):
+        # Copy to release the unused capacity
+        return self.array[:self.length].copy()
+
+
+class SparseColumnBuffer:
+    """
+    Growable CSR buffer: the data and indices of the appended rows are written in preallocated arrays
+    whose capacity grows geometrically, and the matrix is built only once at the end
+    """
+
+    def __init__(self, growth=2.):
+        self.growth = growth
+        self.data = None
+        self.indices = None
+        self.indptr = DenseColumnBuffer(growth)
+        self.indptr.append(np.zeros(1, dtype=np.int64))
+        self.nnz = 0
+        self.shape1 = 0
 
-        new_batches = []
-        offsets = {table_name: 0 for table_name in struct.tables}
-        for i, batch in enumerate(batches):
-            new_batches.append(batch.fill_primary_ids(offsets=offsets).switch_foreign_ids_mode("absolute"))
-            for table_name, table in batch.tables.items():
-                offsets[table_name] += next(iter(table.values())).shape[0]
-            if sparsify:
-                new_batches[-1] = new_batches[-1].sparsify()
-        batches = new_batches
-        del new_batches
-
-        struct = batches[0]
-
-        batches = [b.tables for b in batches]
-
-        for sample_table_name, sample_table in struct.tables.items():
-            new_tables[sample_table_name] = {}
-            for sample_col_name, sample_column in sample_table.items():
-                if sample_col_name in new_tables[sample_table_name]:
+    def append(self, matrix, offset=0, mask=None):
+        """
+        Append the rows of `matrix`, adding `offset` to its entries as they are written
+        If `matrix` is dense and a `mask` is given, only the entries of the mask are written, as `Batcher.sparsify` does
+        """
+        if mask is not None and not issparse(matrix):
+            mask = mask.tocsr() if issparse(mask) or isinstance(mask, RaggedMask) else csr_matrix(as_numpy_array(mask))
+            rows = np.repeat(np.arange(mask.shape[0]), np.diff(mask.indptr))
+            data, indices, indptr, shape1 = as_numpy_array(matrix)[rows, mask.indices], mask.indices, mask.indptr, mask.shape[1]
+        else:
+            matrix = matrix.tocsr() if issparse(matrix) or isinstance(matrix, RaggedMask) else csr_matrix(as_numpy_array(matrix))
+            data, indices, indptr, shape1 = matrix.data, matrix.indices, matrix.indptr, matrix.shape[1]
+        nnz = len(data)
+        if self.data is None:
+            self.data = np.zeros(max(nnz, 1), dtype=data.dtype)
+            self.indices = np.zeros(max(nnz, 1), dtype=np.int64)
+        dtype = np.result_type(self.data.dtype, data.dtype)
+        if self.nnz + nnz > len(self.data) or dtype != self.data.dtype:
+            capacity = max(int(len(self.data) * self.growth), self.nnz + nnz) if self.nnz + nnz > len(self.data) else len(self.data)
+            new_data = np.zeros(capacity, dtype=dtype)
+            new_data[:self.nnz] = self.data[:self.nnz]
+            new_indices = np.zeros(capacity, dtype=np.int64)
+            new_indices[:self.nnz] = self.indices[:self.nnz]
+            self.data, self.indices = new_data, new_indices
+        self.data[self.nnz:self.nnz + nnz] = data
+        if offset:
+            self.data[self.nnz:self.nnz + nnz] += offset
+        self.indices[self.nnz:self.nnz + nnz] = indices
+        self.indptr.append(indptr[1:], offset=self.nnz)
+        self.nnz += nnz
+        self.shape1 = max(self.shape1, shape1)
+
+    def finalize(self, shape1=None):
+        shape1 = max(self.shape1, shape1 or 0)
+        return csr_matrix((self.data[:self.nnz].copy(), self.indices[:self.nnz].copy(), self.indptr.finalize()),
+                          shape=(self.indptr.length - 1, shape1))
+
+
+class RaggedMaskBuffer:
+    """
+    Growable RaggedMask buffer: only the lengths of the appended rows are stored.
+    If a mask that cannot be encoded as a RaggedMask is appended, the buffer switches to a SparseColumnBuffer
+    """
+
+    def __init__(self, growth=2.):
+        self.growth = growth
+        self.lengths = DenseColumnBuffer(growth)
+        self.shape1 = 0
+        self.sparse_buffer = None
+
+    def append(self, mask):
+        if self.sparse_buffer is None:
+            ragged_mask = RaggedMask.from_mask(mask)
+            if ragged_mask is not None:
+                self.lengths.append(ragged_mask.lengths)
+                self.shape1 = max(self.shape1, ragged_mask.width)
+                return
+            self.sparse_buffer = SparseColumnBuffer(self.growth)
+            if self.lengths.length:
+                self.sparse_buffer.append(RaggedMask(self.lengths.finalize(), self.shape1).tocsr())
+        self.sparse_buffer.append(mask)
+        self.shape1 = self.sparse_buffer.shape1
+
+    def finalize(self, shape1=None):
+        if self.sparse_buffer is not None:
+            return self.sparse_buffer.finalize(shape1)
+        return RaggedMask(self.lengths.finalize(), max(self.shape1, shape1 or 0))
+
+
+class TensorColumnBuffer:
+    """
+    Tensors are kept in a list, and padded / concatenated only once at the end, when their offsets are added
+    """
+
+    def __init__(self, growth=2., device=None):
+        self.tensors = []
+        self.offsets = []
+        self.device = device
+
+    def append(self, tensor, offset=0):
+        self.tensors.append(tensor)
+        self.offsets.append(offset)
+        self.device = tensor.device
+
+    def append_range(self, start, stop):
+        self.append(torch.arange(start, stop, device=self.device))
+
+    def finalize(self, shape1=None):
+        new_shape = torch.as_tensor([tensor.shape for tensor in self.tensors]).max(0)[0][1:]
+        res = torch.cat([
+            torch.nn.functional.pad(tensor, [a for p in reversed(new_shape - torch.tensor(tensor.shape[1:])) for a in (0, p)], mode="constant", value=0)
+            for tensor in self.tensors])
+        begin = 0
+        for tensor, offset in zip(self.tensors, self.offsets):
+            if offset:
+                res[(slice(begin, begin + len(tensor)), *(slice(0, n) for n in tensor.shape[1:]))] += offset
+            begin += len(tensor)
+        return res
+
+
+class BatcherAccumulator:
+    """
+    Concatenate batches with the same structure as they are produced (for instance predictions during inference)
+
+    The columns of each appended batch are written into growable preallocated buffers, without copying the batch:
+    missing primary ids are written as row numbers following the previous batches, and relative foreign ids are
+    switched to absolute mode as they are written, by adding the offset of the referenced table when its primary ids
+    are such row numbers. With `sparsify`, the masked columns are written as sparse matrices.
+    The concatenated Batcher is only built once, when calling `finalize`.
+
+    >>> accumulator = BatcherAccumulator()
+    >>> for batch in batcher.dataloader(batch_size=32):
+    ...     accumulator.append(predict(batch))
+    >>> pred = accumulator.finalize()
+    """
+
+    def __init__(self, sparsify=True, allow_non_unique_primary_ids=False, growth=2.):
+        """
+        Parameters
+        ----------
+        sparsify: bool
+            Convert the masked columns to sparse matrices
+        allow_non_unique_primary_ids: bool
+        growth: float
+            Growth factor of the buffers when their capacity is exceeded
+        """
+        self.sparsify = sparsify
+        self.allow_non_unique_primary_ids = allow_non_unique_primary_ids
+        self.growth = growth
+        self.struct = None
+        self.offsets = None
+        self.buffers = None
+
+    def __len__(self):
+        return 0 if self.struct is None else self.offsets[self.struct.main_table]
+
+    def make_buffer(self, col, is_mask, is_masked, device):
+        if col is None:
+            # Primary ids filled by the accumulator
+            return TensorColumnBuffer(self.growth, device=device) if device is not None and not self.sparsify else DenseColumnBuffer(self.growth)
+        if isinstance(col, RaggedMask):
+            return RaggedMaskBuffer(self.growth)
+        if issparse(col) or (self.sparsify and (is_mask or is_masked)):
+            return SparseColumnBuffer(self.growth)
+        if torch.is_tensor(col) and not self.sparsify:
+            return TensorColumnBuffer(self.growth)
+        return DenseColumnBuffer(self.growth)
+
+    def append(self, batch):
+        """
+        Parameters
+        ----------
+        batch: Batcher
+        """
+        tables = batch.tables
+        sizes = {table_name: next(iter(table.values())).shape[0] for table_name, table in tables.items()}
+        if self.struct is None:
+            # Only the structure of the batch is kept
+            struct = batch.copy()
+            struct.tables = {}
+            for table_name in tables:
+                struct.primary_ids.setdefault(table_name, f"{table_name}_id")
+            struct.foreign_ids = {table_name: {col_name: (foreign_table_name, "absolute") for col_name, (foreign_table_name, _) in col_to_foreign_ids.items()}
+                                  for table_name, col_to_foreign_ids in struct.foreign_ids.items()}
+            self.struct = struct
+            self.offsets = {table_name: 0 for table_name in tables}
+            self.buffers = {}
+            for table_name, table in tables.items():
+                masks = struct.masks.get(table_name, {})
+                mask_names = set(masks.values())
+                for col_name, col in (*table.items(), (struct.primary_ids[table_name], None)):
+                    if col_name not in self.buffers.get(table_name, {}):
+                        self.buffers.setdefault(table_name, {})[col_name] = self.make_buffer(col, col_name in mask_names, col_name in masks, batch.device)
+        for table_name, table in self.buffers.items():
+            masks = self.struct.masks.get(table_name, {})
+            for col_name, buffer in table.items():
+                if col_name not in tables[table_name]:
+                    # Missing primary ids are the row numbers of the concatenated table
+                    buffer.append_range(self.offsets[table_name], self.offsets[table_name] + sizes[table_name])
                     continue
-                mask_name = struct.masks.get(sample_table_name, {}).get(sample_col_name, None)
-
-                # Convert to sparse if needed
-                if issparse(sample_column):
-                    if mask_name is None:
-                        shape1 = max([dic[sample_table_name][sample_col_name].shape[1] for dic in batches])
-                        for batch in batches:
-                            batch[sample_table_name][sample_col_name].resize(batch[sample_table_name][sample_col_name].shape[0], shape1)
-                        new_tables[sample_table_name][sample_col_name] = [dic[sample_table_name][sample_col_name] for dic in batches]
+                col = tables[table_name][col_name]
+                kwargs = {}
+                foreign_table_name, mode = batch.foreign_ids.get(table_name, {}).get(col_name, (None, None))
+                if mode == "relative":
+                    foreign_id_name = self.struct.primary_ids[foreign_table_name]
+                    if foreign_id_name not in tables[foreign_table_name]:
+                        kwargs["offset"] = self.offsets[foreign_table_name]
+                    elif issparse(col):
+                        col = col.tocsr(copy=True)
+                        col.data = as_numpy_array(tables[foreign_table_name][foreign_id_name])[col.data]
                     else:
-                        shape1 = max([dic[sample_table_name][mask_name].shape[1] for dic in batches])
-                        for batch in batches:
-                            batch[sample_table_name][sample_col_name].resize(batch[sample_table_name][sample_col_name].shape[0], shape1)
-                        new_tables[sample_table_name][sample_col_name] = [dic[sample_table_name][sample_col_name] for dic in batches]
-                elif isinstance(sample_column, np.ndarray):
-                    new_shape = np.asarray([dic[sample_table_name][sample_col_name].shape for dic in batches]).max(0)[1:]
-                    new_tables[sample_table_name][sample_col_name] = [
-                        np.pad(dic[sample_table_name][sample_col_name],
-                               [(0, 0), *((0, p) for p in new_shape - np.asarray(dic[sample_table_name][sample_col_name].shape[1:]))])
-                        for dic in batches]
-                elif torch.is_tensor(sample_column):
-                    new_shape = torch.as_tensor([dic[sample_table_name][sample_col_name].shape for dic in batches]).max(0)[0][1:]
-                    new_tables[sample_table_name][sample_col_name] = [
-                        torch.nn.functional.pad(dic[sample_table_name][sample_col_name],
-                                                [a for p in reversed(new_shape - torch.tensor(dic[sample_table_name][sample_col_name].shape[1:])) for a in (0, p)],
-                                                mode="constant", value=0)
-                        for dic in batches]
-
-                # Check if we need to align ids between two or more matrices
-                # fragment_table_name = struct.foreign_ids[sample_col_name][0]
-                # if fragment_table_name and fragment_table_name != sample_table_name:
-                #     # If fragment_id doesn't exist in fragment table, (for ex: new fragments), create it
-                #     fragment_table_id_name = struct.primary_ids[fragment_table_name]
-                #     if fragment_table_id_name not in struct.tables[fragment_table_name]:
-                #         i = 0
-                #         for batch in batches:
-                #             dic_size = next(iter(batch[fragment_table_name].values())).shape[0]
-                #             batch[fragment_table_name][fragment_table_id_name] = np.arange(i, i + dic_size)
-                #             i += dic_size
-                #     # Until now new_tables["sample"]["fragment_id"] was row numbers to each batch in the given batches
-                #     # Here we transform those row numbers into the actual ids batches["fragment"]["fragment_id"]
-                #     if issparse(new_tables[sample_table_name][sample_col_name][0]):
-                #         for sps, batch in zip(new_tables[sample_table_name][sample_col_name], batches):
-                #             sps.data = batch[fragment_table_name][fragment_table_id_name][sps.data]
-                #     else:
-                #         new_tables[sample_table_name][sample_col_name] = [
-                #             dic[fragment_table_name][fragment_table_id_name][x]
-                #             for x, dic in zip(new_tables[sample_table_name][sample_col_name], batches)]
-
-                # Finally concatenate the matrices, sparse or dense
-                if issparse(new_tables[sample_table_name][sample_col_name][0]):
-                    new_tables[sample_table_name][sample_col_name] = vstack(new_tables[sample_table_name][sample_col_name]).tolil()
-                elif isinstance(new_tables[sample_table_name][sample_col_name][0], np.ndarray):
-                    new_tables[sample_table_name][sample_col_name] = np.concatenate(new_tables[sample_table_name][sample_col_name])
-                else:
-                    new_tables[sample_table_name][sample_col_name] = torch.cat(new_tables[sample_table_name][sample_col_name])
+                        col = tables[foreign_table_name][foreign_id_name][col]
+                if self.sparsify and col_name in masks and not issparse(col):
+                    kwargs["mask"] = tables[table_name][masks[col_name]]
+                buffer.append(col, **kwargs)
+        for table_name, size in sizes.items():
+            self.offsets[table_name] += size
+
+    def finalize(self):
+        """
+        Build the concatenated Batcher
+
+        Returns
+        -------
+        Batcher
+        """
+        if self.struct is None:
+            raise ValueError("Cannot build a Batcher from an empty BatcherAccumulator: at least one batch must be appended")
+        struct = self.struct
+        new_tables = {}
+        for table_name, table in self.buffers.items():
+            for col_name, buffer in table.items():
+                # Sparse columns are resized to the width of their mask
+                mask_name = struct.masks.get(table_name, {}).get(col_name, None)
+                mask_buffer = table.get(mask_name, None)
+                shape1 = getattr(mask_buffer, 'shape1', None)
+                new_tables.setdefault(table_name, {})[col_name] = buffer.finalize(shape1)
 
         new_tables = Batcher(new_tables,
                              main_table=struct.main_table,
@@ -1049,26 +2520,421 @@ class Batcher:
                              foreign_ids=struct.foreign_ids,
                              primary_ids=struct.primary_ids,
                              check=False, )
-        for sample_table_name, table in list(new_tables.tables.items()):
-            id_name = struct.primary_ids[sample_table_name]
+        for table_name, table in list(new_tables.tables.items()):
+            id_name = struct.primary_ids[table_name]
             if id_name in table:
-                if not allow_non_unique_primary_ids:
-                    message = f"Primary id {table_name}/{id_name} is not unique.\n" \
-                              f"You can either set Batcher.concat `allow_non_unique_primary_ids` parameter to True or check that each concatenated" \
-                              f" batch has no redundant {table_name}/{id_name}.\n" \
-                              f"You maybe forgot to set foreign_ids='relative' when you created these batches."
+                message = f"Primary id {table_name}/{id_name} is not unique.\n" \
+                          f"You can either set Batcher.concat `allow_non_unique_primary_ids` parameter to True or check that each concatenated" \
+                          f" batch has no redundant {table_name}/{id_name}.\n" \
+                          f"You maybe forgot to set foreign_ids='relative' when you created these batches."
 
                 if torch.is_tensor(table[id_name]):
                     uniq, inverse = torch.unique(table[id_name], sorted=False, return_inverse=True)
-                    if not allow_non_unique_primary_ids:
-                        assert len(uniq) == len(table[id_name]), message
-                    uniquifier = inverse.argsort()[:len(table[id_name])]
+                    inverse = inverse.cpu().numpy()
                 elif isinstance(table[id_name], np.ndarray):
                     inverse, uniq = pd.factorize(table[id_name])
-                    if not allow_non_unique_primary_ids:
-                        assert len(uniq) == len(table[id_name]), message
-                    uniquifier = inverse.argsort()[:len(table[id_name])]
                 else:
-                    raise Exception(f"Primary id {id_name} of table {sample_table_name} should be a torch tensor or a numpy ndarray")
-                new_tables.tables[sample_table_name] = new_tables.query_table(table, uniquifier)
+                    raise Exception(f"Primary id {id_name} of table {table_name} should be a torch tensor or a numpy ndarray")
+                if len(uniq) == len(table[id_name]):
+                    # Unique ids: rows are already in the order of their first appearance
+                    continue
+                assert self.allow_non_unique_primary_ids, message
+                # Group the rows that share the same primary id
+                uniquifier = np.argsort(inverse, kind="stable")
+                if torch.is_tensor(table[id_name]):
+                    uniquifier = torch.as_tensor(uniquifier, device=table[id_name].device)
+                new_tables.tables[table_name] = new_tables.query_table(table, uniquifier)
         return new_tables
+
+
+class BatcherShardWriter:
+    """
+    Write a corpus as a sequence of Batcher shards, that can be appended incrementally (for instance by
+    a preprocessing pipeline) and then streamed by `ShardedBatcherDataset`
+
+    Each shard is saved with `Batcher.save` in its own directory, and a shards.json index listing the complete
+    shards is rewritten after each shard, so readers never see partially written shards.
+    Every shard must be self contained: its foreign ids must refer to rows of the same shard.
+
+    >>> writer = BatcherShardWriter("/data/mimic_shards")
+    >>> for chunk in chunks:
+    ...     writer.write(preprocess(chunk))
+    """
+
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path: str
+            Directory of the shards, existing shards are kept and new ones are appended
+        """
+        self.path = str(path)
+        os.makedirs(self.path, exist_ok=True)
+        self.shards = read_shards_index(self.path)
+
+    def write(self, batcher):
+        """
+        Save a batcher as a new shard
+
+        Parameters
+        ----------
+        batcher: Batcher
+
+        Returns
+        -------
+        str
+            Path of the shard
+        """
+        name = f"shard-{len(self.shards):05d}"
+        batcher.save(os.path.join(self.path, name))
+        self.shards.append({"path": name, "length": len(batcher)})
+        index_path = os.path.join(self.path, "shards.json")
+        with open(index_path + ".tmp", "w") as file:
+            json.dump({"shards": self.shards}, file, indent=2)
+        os.replace(index_path + ".tmp", index_path)
+        return os.path.join(self.path, name)
+
+
+def read_shards_index(path):
+    """
+    List of the shards written by `BatcherShardWriter` in a directory, as {"path", "length"} dicts
+    """
+    index_path = os.path.join(str(path), "shards.json")
+    if not os.path.exists(index_path):
+        return []
+    with open(index_path) as file:
+        return json.load(file)["shards"]
+
+
+class ShardedBatcherDataset(IterableDataset):
+    """
+    Stream batches from Batcher shards written by `BatcherShardWriter`, for corpora that do not fit in memory
+
+    Shards are memory mapped one after the other, their foreign ids are switched to relative mode and their
+    rows are queried by batches, as `Batcher.dataloader` would do on the whole corpus. When shuffling, the shards
+    are read in a random order and the batches of consecutive shards are mixed in a bounded shuffle buffer.
+    Shards are split between the DataLoader workers and the distributed processes.
+
+    >>> dataset = ShardedBatcherDataset("/data/mimic_shards", batch_size=32, shuffle=True, device=device)
+    >>> for epoch in range(n_epochs):
+    ...     dataset.set_epoch(epoch)
+    ...     for batch in dataset.dataloader(num_workers=4):
+    ...         ...
+    """
+
+    def __init__(self, path, batch_size=32, shuffle=False, shuffle_buffer=16, sparse_sort_on=None, seed=0, distributed=False, **densify_kwargs):
+        """
+        Parameters
+        ----------
+        path: str
+            Directory of the shards
+        batch_size: int
+        shuffle: bool
+        shuffle_buffer: int
+            Number of batches (that may come from different shards) among which the next batch is drawn when shuffling
+        sparse_sort_on: str
+            If given, group the samples of each shard by similar lengths in this column (see `SparseBatchSampler`)
+        seed: int
+            Seed of the shuffling, combined with the epoch given to `set_epoch`
+        distributed: bool
+            Split the shards between the processes of the default torch.distributed process group.
+            Every process yields the same number of batches: processes that read fewer batches than the others
+            repeat their first batches.
+        densify_kwargs: any
+            If given, batches are densified with these parameters (device, dtypes)
+        """
+        self.path = str(path)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.sparse_sort_on = sparse_sort_on
+        self.seed = seed
+        self.distributed = distributed
+        self.densify_kwargs = densify_kwargs
+        self.epoch = 0
+        # (num_replicas, rank) of the main process, since DataLoader workers are not part of the process group
+        self.replica = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def get_replica(self):
+        """
+        Number of distributed processes and rank of the current process
+        """
+        if not self.distributed:
+            return 1, 0
+        if self.replica is not None:
+            return self.replica
+        return get_world_size(), get_rank()
+
+    def ordered_shards(self):
+        """
+        Shards of the index, as {"path", "length"} dicts, in their reading order for the current epoch
+        """
+        shards = read_shards_index(self.path)
+        if self.shuffle:
+            shards = [shards[i] for i in np.random.RandomState(self.seed + self.epoch).permutation(len(shards))]
+        return shards
+
+    def shards(self):
+        """
+        Shards read by the current worker of the current process, in their reading order
+        """
+        worker_info = get_worker_info()
+        num_workers, worker_id = (worker_info.num_workers, worker_info.id) if worker_info is not None else (1, 0)
+        num_replicas, rank = self.get_replica()
+        return [os.path.join(self.path, shard["path"]) for shard in self.ordered_shards()[rank * num_workers + worker_id::num_replicas * num_workers]]
+
+    def padding(self):
+        """
+        Number of batches that the current worker repeats after reading its shards, so that the current process
+        yields as many batches as the distributed process with the most batches
+        """
+        if not self.distributed:
+            return 0
+        worker_info = get_worker_info()
+        num_workers, worker_id = (worker_info.num_workers, worker_info.id) if worker_info is not None else (1, 0)
+        num_replicas, rank = self.get_replica()
+        # Shards are split in batches of batch_size samples, with or without sparse_sort_on
+        n_batches = [-(-shard["length"] // self.batch_size) for shard in self.ordered_shards()]
+        # Worker w of process r reads the shards r * num_workers + w, r * num_workers + w + num_replicas * num_workers, ...
+        stride = num_replicas * num_workers
+        per_process = [sum(sum(n_batches[r * num_workers + w::stride]) for w in range(num_workers)) for r in range(num_replicas)]
+        missing = max(per_process) - per_process[rank]
+        return missing // num_workers + int(worker_id < missing % num_workers)
+
+    def shard_batches(self, batcher, random):
+        if self.sparse_sort_on is not None:
+            # A single replica sampler shuffles with its own random state, seeded from ours to draw the same batches in
+            # every run, instead of numpy's global random state
+            sampler = SparseBatchSampler(batcher, on=self.sparse_sort_on, batch_size=self.batch_size, shuffle=self.shuffle,
+                                         num_replicas=1, rank=0, seed=random.randint(np.iinfo(np.int32).max))
+            return list(sampler)
+        ids = random.permutation(len(batcher)) if self.shuffle else np.arange(len(batcher))
+        return [ids[i:i + self.batch_size] for i in range(0, len(ids), self.batch_size)]
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        random = np.random.RandomState([self.seed, self.epoch, self.get_replica()[1], worker_info.id if worker_info is not None else 0])
+        padding = self.padding()
+        # First batches of the worker, repeated at the end to pad the process to the same number of steps as the others
+        repeated = []
+        buffer = []
+
+        def pop():
+            item = buffer.pop(random.randint(len(buffer)) if self.shuffle else 0)
+            if len(repeated) < padding:
+                repeated.append(item)
+            return item
+
+        for shard_path in self.shards():
+            batcher = Batcher.load(shard_path, mmap=True).prepare_for_indexing()
+            plan = batcher.compile_query_plan()
+            for ids in self.shard_batches(batcher, random):
+                buffer.append((batcher, plan, ids))
+                if len(buffer) >= max(self.shuffle_buffer if self.shuffle else 1, 1):
+                    batcher_, plan_, ids_ = pop()
+                    yield batcher_.query_ids(ids_, plan=plan_, **self.densify_kwargs)
+        while buffer:
+            batcher_, plan_, ids_ = pop()
+            yield batcher_.query_ids(ids_, plan=plan_, **self.densify_kwargs)
+        if padding and not repeated:
+            # This worker had no shard to read, repeat the batches of the first shard instead
+            batcher = Batcher.load(os.path.join(self.path, self.ordered_shards()[0]["path"]), mmap=True).prepare_for_indexing()
+            plan = batcher.compile_query_plan()
+            repeated = [(batcher, plan, ids) for ids in self.shard_batches(batcher, random)]
+        for i in range(padding):
+            batcher_, plan_, ids_ = repeated[i % len(repeated)]
+            yield batcher_.query_ids(ids_, plan=plan_, **self.densify_kwargs)
+
+    def dataloader(self, **kwargs):
+        """
+        Make a torch DataLoader that iterates over the batches of this dataset
+
+        Parameters
+        ----------
+        kwargs: any
+            Other DataLoader parameters, such as num_workers
+
+        Returns
+        -------
+        DataLoader
+        """
+        if self.distributed:
+            self.replica = (get_world_size(), get_rank())
+        return DataLoader(self, batch_size=None, **kwargs)
+
+
+def dataset_column_values(frame, frame_col):
+    """
+    Values of a column of a frame (or of several columns stacked in a 2d array if `frame_col` is a list),
+    categorical columns are replaced by their codes
+    """
+    if isinstance(frame_col, (list, tuple)):
+        return np.stack([dataset_column_values(frame, name) for name in frame_col], axis=1)
+    col = frame[frame_col]
+    if hasattr(col, 'cat'):
+        return np.asarray(col.cat.codes)
+    return np.asarray(col)
+
+
+def schema_frames(table_schema):
+    """
+    Names of the frames that the rows and the columns of a table of a `Batcher.from_dataset` schema are read from
+    """
+    return ([table_schema["frame"]] if table_schema.get("frame", None) is not None else []) + list(table_schema.get("nested", {}).keys())
+
+
+def dataset_table_ids(dataset, schema, rows=None):
+    """
+    Ids of the rows of the tables of a `Batcher.from_dataset` schema that have an "id" column
+
+    Parameters
+    ----------
+    dataset: Dataset or dict of pd.DataFrame
+    schema: dict
+    rows: dict
+        If given, the row numbers of the ids of the nested frames, that are computed along the ids, are stored
+        in this dict by (frame, id column) so that `build_dataset_tables` does not have to look them up again
+
+    Returns
+    -------
+    dict of np.ndarray
+        Unique ids of each table, in the order of the rows of the table
+    """
+    table_ids = {}
+    for table_name, table_schema in schema.items():
+        id_name = table_schema.get("id", None)
+        if id_name is None:
+            continue
+        if table_schema.get("frame", None) is not None:
+            ids = np.asarray(dataset[table_schema["frame"]][id_name])
+            if not pd.Index(ids).is_unique:
+                raise Exception(f"Ids {repr(id_name)} of frame {repr(table_schema['frame'])} must be unique to be the rows of table {repr(table_name)}")
+        else:
+            # Rows are the distinct ids of the nested frames, by order of appearance
+            nested_ids = [np.asarray(dataset[frame_name][id_name]) for frame_name in table_schema.get("nested", {})]
+            codes, ids = pd.factorize(np.concatenate(nested_ids))
+            if rows is not None:
+                for frame_name, frame_codes in zip(table_schema.get("nested", {}), np.split(codes, np.cumsum([len(x) for x in nested_ids])[:-1])):
+                    rows[(frame_name, id_name)] = frame_codes
+        table_ids[table_name] = np.asarray(ids)
+    return table_ids
+
+
+def build_dataset_tables(dataset, schema, table_ids, subset=None, offsets=None, ragged_masks=False, rows=None):
+    """
+    Build the columns of the tables of a `Batcher.from_dataset` schema
+
+    Nested frames are sorted once by (row, position) if they are not sorted already, and each of their columns
+    is then made into a CSR matrix that shares the indices and indptr arrays of the other columns of the frame
+
+    Parameters
+    ----------
+    dataset: Dataset or dict of pd.DataFrame
+    schema: dict
+    table_ids: dict of np.ndarray
+        Unique ids of the tables (see `dataset_table_ids`), foreign ids are remapped to the rows of these tables
+    subset: list of str
+        Tables to build, defaults to all the tables of the schema
+    offsets: dict of int
+        First primary id of each table
+    ragged_masks: bool
+        Store the masks of the nested columns as RaggedMask instead of CSR matrices
+    rows: dict
+        Row numbers of the ids of the nested frames computed by `dataset_table_ids`
+
+    Returns
+    -------
+    (dict, dict, dict)
+        tables, masks and subcolumn_names parameters of the Batcher
+    """
+    offsets = offsets or {}
+    indexes = {table_name: pd.Index(ids) for table_name, ids in table_ids.items()}
+
+    def row_numbers(table_name, values, where):
+        rows = indexes[table_name].get_indexer(values)
+        if len(rows) and rows.min() < 0:
+            raise Exception(f"Some ids of {where} could not be found in table {repr(table_name)}")
+        return rows
+
+    def column(col_name, frame, frame_col, where):
+        values = dataset_column_values(frame, frame_col)
+        if col_name.endswith('_id'):
+            # Same rule as the Batcher to find the table that an id column refers to
+            foreign_table_name = next((name for name in schema if col_name[:-3].endswith(name)), None)
+            if foreign_table_name in indexes:
+                values = row_numbers(foreign_table_name, values, where) + offsets.get(foreign_table_name, 0)
+        return values
+
+    tables, masks, subcolumn_names = {}, {}, {}
+    for table_name in (subset if subset is not None else schema):
+        table_schema = schema[table_name]
+        table = tables[table_name] = {}
+        frame_name = table_schema.get("frame", None)
+        if table_name in table_ids:
+            n_rows = len(table_ids[table_name])
+            offset = offsets.get(table_name, 0)
+            table[f"{table_name}_id"] = np.arange(offset, offset + n_rows)
+        else:
+            assert frame_name is not None, f"Table {repr(table_name)} must have an 'id' or a 'frame' in the schema"
+            assert not table_schema.get("nested", None), f"Table {repr(table_name)} must have an 'id' to have nested frames"
+            n_rows = len(dataset[frame_name])
+
+        if frame_name is not None:
+            frame = dataset[frame_name]
+            for col_name, frame_col in table_schema.get("columns", {}).items():
+                table[col_name] = column(col_name, frame, frame_col, f"{frame_name}/{frame_col}")
+                if isinstance(frame_col, (list, tuple)):
+                    subcolumn_names.setdefault(table_name, {})[col_name] = list(frame_col)
+
+        for nested_name, nested_schema in table_schema.get("nested", {}).items():
+            frame = dataset[nested_name]
+            if rows is not None and (nested_name, table_schema["id"]) in rows:
+                frame_rows = rows[(nested_name, table_schema["id"])]
+            else:
+                frame_rows = row_numbers(table_name, np.asarray(frame[table_schema["id"]]), f"{nested_name}/{table_schema['id']}")
+            positions = np.asarray(frame[nested_schema["position"]]) if nested_schema.get("position", None) is not None else None
+
+            # Sort the frame by (row, position) unless it is already sorted, sorting a single int64 key
+            # (with the index of the element as position if none is given, to keep the order of appearance)
+            # is much faster than a lexsort or a stable sort
+            row_diffs = np.diff(frame_rows)
+            if positions is None:
+                is_sorted = (row_diffs >= 0).all()
+                order = None if is_sorted else np.argsort(frame_rows.astype(np.int64) * len(frame_rows) + np.arange(len(frame_rows)))
+            else:
+                is_sorted = ((row_diffs > 0) | ((row_diffs == 0) & (np.diff(positions) > 0))).all()
+                order = None if is_sorted else np.argsort(frame_rows.astype(np.int64) * (int(positions.max()) + 1) + positions)
+            if order is not None:
+                frame_rows = frame_rows[order]
+                positions = positions[order] if positions is not None else None
+
+            lengths = np.bincount(frame_rows, minlength=n_rows)
+            indptr = np.zeros(n_rows + 1, dtype=np.int64)
+            np.cumsum(lengths, out=indptr[1:])
+            if positions is None:
+                # Elements are numbered by order of appearance in their row
+                indices = np.arange(len(frame_rows)) - np.repeat(indptr[:-1], lengths)
+            else:
+                indices = positions.astype(np.int64, copy=False)
+                if order is not None and ((frame_rows[1:] == frame_rows[:-1]) & (indices[1:] == indices[:-1])).any():
+                    raise Exception(f"Positions {repr(nested_schema['position'])} of frame {repr(nested_name)} must be unique for each {repr(table_schema['id'])}")
+            width = int(indices.max()) + 1 if len(indices) else 0
+
+            mask_name = nested_schema.get("mask", f"{nested_name}_mask")
+            for col_name, frame_col in nested_schema.get("columns", {}).items():
+                if isinstance(frame_col, (list, tuple)):
+                    raise Exception(f"Nested column {repr(col_name)} of table {repr(table_name)} must be read from a single column of frame {repr(nested_name)}, "
+                                    f"lists of columns {repr(list(frame_col))} are only allowed in the 'columns' of a table: use one nested column per frame column")
+                values = column(col_name, frame, frame_col, f"{nested_name}/{frame_col}")
+                if order is not None:
+                    values = values[order]
+                table[col_name] = csr_matrix((values, indices, indptr), shape=(n_rows, width))
+                masks.setdefault(table_name, {})[col_name] = mask_name
+            mask = csr_matrix((np.ones(len(indices), dtype=bool), indices, indptr), shape=(n_rows, width))
+            if ragged_masks:
+                mask = RaggedMask(lengths, width) if positions is None else (RaggedMask.from_mask(mask) or mask)
+            table[mask_name] = mask
+    return tables, masks, subcolumn_names
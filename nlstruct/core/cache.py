@@ -1,12 +1,27 @@
+import atexit
+import contextvars
 import glob
 import inspect
+import io
+import json
 import logging
 import os
 import pickle
+import queue
+import reprlib
+import shutil
+import sqlite3
+import struct
 import sys
+import threading
+import time
 import types
-from collections import Sequence, Mapping, defaultdict
-from contextlib import contextmanager
+import uuid
+import weakref
+from collections import OrderedDict, defaultdict
+from collections.abc import Sequence, Mapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from copy import copy
 from copyreg import dispatch_table
 from pathlib import Path
@@ -18,15 +33,43 @@ import pandas as pd
 import torch
 import xxhash
 import yaml
-from joblib._compat import PY3_OR_LATER
+from joblib.compressor import CompressorWrapper, register_compressor
 from joblib.hashing import Hasher, _MyHash
 from joblib.numpy_pickle import NumpyArrayWrapper, NumpyUnpickler
 from joblib.numpy_pickle_compat import NDArrayWrapper
-from joblib.numpy_pickle_utils import _read_fileobject
 from sklearn.base import BaseEstimator
 
+from nlstruct.core.batcher import Batcher
 from nlstruct.core.environment import RelativePath, env
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from joblib._compat import PY3_OR_LATER
+except ImportError:
+    # joblib >= 0.14 only supports python 3
+    PY3_OR_LATER = True
+try:
+    from joblib.numpy_pickle_utils import _read_fileobject
+except ImportError:
+    # joblib >= 1.3 yields the file object with the mmap_mode that can be used to read it
+    from joblib.numpy_pickle_utils import _validate_fileobject_and_memmap as _read_fileobject
+# torch >= 2.6 only loads tensors by default, the storages of pickled tensors are loaded as torch does
+TORCH_LOAD_KWARGS = {"weights_only": False} if "weights_only" in inspect.signature(torch.load).parameters else {}
+# joblib >= 1.5 unpicklers convert the read arrays to the native byte order (unless they are memory mapped)
+UNPICKLER_BYTE_ORDER = "ensure_native_byte_order" in inspect.signature(NumpyUnpickler.__init__).parameters
+
 logger = logging.getLogger()
 
 if PY3_OR_LATER:
@@ -36,8 +79,8 @@ else:
 
 
 class HashWriter:
-    def __init__(self):
-        self._hash = xxhash.xxh64()
+    def __init__(self, algorithm=xxhash.xxh64):
+        self._hash = algorithm()
 
     def write(self, data):
         self._hash.update(data)
@@ -46,6 +89,46 @@ class HashWriter:
         return self._hash.hexdigest()
 
 
+EXACT_HASH_CHUNK_SIZE = 8 << 20
+hash_executor = None
+hash_executor_pid = None
+hash_executor_lock = threading.Lock()
+
+
+def hash_buffers(buffers, chunk_size=EXACT_HASH_CHUNK_SIZE):
+    """
+    Exact xxh128 digests of byte buffers, computed by chunks in a pool of threads (xxhash releases the GIL)
+
+    A buffer is split in chunks of `chunk_size` bytes, and its digest is the xxh128 of the digests of its chunks,
+    so the chunks of all the buffers are spread over the threads.
+
+    Parameters
+    ----------
+    buffers: list of memoryview
+    chunk_size: int
+
+    Returns
+    -------
+    list of bytes
+    """
+    global hash_executor, hash_executor_pid
+    buffers = [memoryview(buffer).cast("B") for buffer in buffers]
+    chunks = [(i, buffer[start:start + chunk_size]) for i, buffer in enumerate(buffers) for start in range(0, len(buffer), chunk_size)]
+    if sum(len(chunk) for _, chunk in chunks) > chunk_size:
+        with hash_executor_lock:
+            # The pool threads do not survive a fork (such as DataLoader workers)
+            if hash_executor is None or hash_executor_pid != os.getpid():
+                hash_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="hash")
+                hash_executor_pid = os.getpid()
+        chunk_digests = list(hash_executor.map(lambda chunk: xxhash.xxh3_128(chunk[1]).digest(), chunks))
+    else:
+        chunk_digests = [xxhash.xxh3_128(chunk).digest() for _, chunk in chunks]
+    digests = [xxhash.xxh3_128(len(buffer).to_bytes(8, "little")) for buffer in buffers]
+    for (i, _), chunk_digest in zip(chunks, chunk_digests):
+        digests[i].update(chunk_digest)
+    return [digest.digest() for digest in digests]
+
+
 class Dispatcher(dict):
     def __getitem__(self, item):
         try:
@@ -65,13 +148,162 @@ class Dispatcher(dict):
             return default
 
 
+def get_mutation_signal(obj):
+    """
+    Cheap value that changes when an object is replaced, without reading its data, for the objects whose data
+    cannot be modified in place: read-only numpy arrays (such as memory mapped cache results) whose bases are
+    read-only too. Writeable arrays, dataframes and tensors can be written in place without any reliable signal
+    (`array[i] = x`, `df.loc[i, col] = x`, `param.data[i] = x` or `tensor.numpy()[i] = x` do not change their
+    version counter), so their data is hashed every time.
+
+    Returns
+    -------
+    tuple or None
+        None if the object cannot be watched (its fingerprint is not memoized)
+    """
+    if not isinstance(obj, np.ndarray) or obj.dtype.hasobject:
+        return None
+    base = obj
+    while isinstance(base, np.ndarray):
+        if base.flags.writeable:
+            return None
+        base = base.base
+    return (obj.__array_interface__["data"], obj.shape, obj.strides, obj.dtype.str)
+
+
+# Mutation signal of the objects frozen in the fingerprint registry
+FROZEN = object()
+
+
+class FingerprintRegistry:
+    """
+    Memoize the fingerprints of read-only arrays by object identity, so that hashing the same array again (a memory
+    mapped cache result passed to chained cached functions, ...) does not read its data again. An entry is dropped
+    when its object is garbage collected, and is ignored when the mutation signal of the object
+    (see `get_mutation_signal`) has changed since its fingerprint was computed.
+
+    Other objects (models, dataframes, tensors, ...) are only memoized once `freeze` has been called on them, by
+    callers that promise not to modify them in place until they call `invalidate`.
+
+    >>> fingerprint_registry.freeze(model)
+    >>> train(model, docs)  # model is hashed once, even if train is called many times
+    >>> model.load_state_dict(other_state)
+    >>> fingerprint_registry.invalidate(model)
+    """
+
+    def __init__(self):
+        self.entries = {}
+        # Reentrant: the weakref callbacks can be called by the garbage collector while the lock is held
+        self.lock = threading.RLock()
+
+    def get(self, obj, variant):
+        """
+        Memoized fingerprint of an object for a given hashing variant (max_length, coerce_mmap), or None
+        """
+        entry = self.entries.get(id(obj))
+        if entry is None or entry[0]() is not obj:
+            return None
+        if entry[1] is not FROZEN and entry[1] != get_mutation_signal(obj):
+            self.invalidate(obj)
+            return None
+        return entry[2].get(variant, entry[2].get(None))
+
+    def set(self, obj, variant, digest):
+        key = id(obj)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0]() is obj and entry[1] is FROZEN:
+                entry[2][variant] = digest
+                return
+        signal = get_mutation_signal(obj)
+        if signal is None:
+            return
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0]() is not obj or entry[1] != signal:
+                try:
+                    ref = weakref.ref(obj, lambda ref, key=key: self._remove(key, ref))
+                except TypeError:
+                    return
+                entry = self.entries[key] = (ref, signal, {})
+            entry[2][variant] = digest
+
+    def _remove(self, key, ref):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] is ref:
+                del self.entries[key]
+
+    def freeze(self, obj, digest=None):
+        """
+        Memoize the fingerprint of an object of any type, until `invalidate` is called on it or it is garbage collected.
+        The object must not be modified in place in the meantime: its fingerprint would not change.
+
+        Parameters
+        ----------
+        obj: Any
+        digest: str
+            If given, fingerprint of the object instead of the hash of its data, for instance the key of the cache
+            entry it was computed for
+
+        Returns
+        -------
+        bool
+            False if the object cannot be weakly referenced, and therefore cannot be frozen
+        """
+        key = id(obj)
+        with self.lock:
+            try:
+                ref = weakref.ref(obj, lambda ref, key=key: self._remove(key, ref))
+            except TypeError:
+                return False
+            entry = self.entries.get(key)
+            # Fingerprints that were memoized until now are still valid
+            digests = dict(entry[2]) if entry is not None and entry[0]() is obj else {}
+            self.entries[key] = (ref, FROZEN, {None: digest} if digest is not None else digests)
+        return True
+
+    def is_frozen(self, obj):
+        entry = self.entries.get(id(obj))
+        return entry is not None and entry[1] is FROZEN and entry[0]() is obj
+
+    def invalidate(self, obj):
+        """
+        Forget the fingerprint of an object, to hash its data again (after an undetected in-place modification, or
+        a modification of a frozen object)
+        """
+        with self.lock:
+            entry = self.entries.get(id(obj))
+            if entry is not None and entry[0]() is obj:
+                del self.entries[id(obj)]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+fingerprint_registry = FingerprintRegistry()
+
+
 class TruncatedNumpyHasher(Hasher):
     def __init__(self, max_length=2000, coerce_mmap=False):
+        """
+        Parameters
+        ----------
+        max_length: int
+            Only hash the first `max_length` elements of each axis of arrays, tensors and dataframes, and the
+            first and last `max_length / 2` elements of sequences. If None, hash their full content (exact mode),
+            with `hash_buffers` for the buffers of arrays and of the columns of dataframes.
+        coerce_mmap: bool
+        """
 
         # By default we want a pickle protocol that only changes with
         # the major python version and not the minor one
         protocol = (pickle.DEFAULT_PROTOCOL if PY3_OR_LATER else pickle.HIGHEST_PROTOCOL)
-        self.stream = HashWriter()
+        self.stream = HashWriter(xxhash.xxh64 if max_length is not None else xxhash.xxh3_64)
         Pickler.__init__(self, self.stream, protocol=protocol)
 
         self.coerce_mmap = coerce_mmap
@@ -84,6 +316,8 @@ class TruncatedNumpyHasher(Hasher):
             self._getbuffer = memoryview
 
         self.max_length = max_length
+        # Object that is being fingerprinted by this hasher, whose data must be hashed instead of its fingerprint
+        self.fingerprinted = None
 
     def hash(self, obj, return_digest=True):
         try:
@@ -115,6 +349,11 @@ class TruncatedNumpyHasher(Hasher):
                 self.write(self.get(x[0]))
                 return
 
+            # Frozen objects are saved as their memoized fingerprint
+            if obj is not self.fingerprinted and fingerprint_registry.is_frozen(obj):
+                self.save_fingerprint(obj, None)
+                return
+
             # Check the type dispatch table
             t = type(obj)
             f = self.dispatch.get(t)
@@ -168,9 +407,52 @@ class TruncatedNumpyHasher(Hasher):
         # Save the reduce() output and finally memoize the object
         self.save_reduce(obj=obj, *rv)
 
+    def save_fingerprint(self, obj, save_data):
+        """
+        Save the fingerprint of an array, a tensor, a dataframe or a frozen object (the hash of its data, memoized in
+        `fingerprint_registry`) instead of its data
+        """
+        if obj is self.fingerprinted:
+            save_data(self, obj)
+            return
+        variant = (self.max_length, self.coerce_mmap)
+        digest = fingerprint_registry.get(obj, variant)
+        if digest is None:
+            hasher = TruncatedNumpyHasher(max_length=self.max_length, coerce_mmap=self.coerce_mmap)
+            hasher.fingerprinted = obj
+            digest = hasher.hash(obj)
+            fingerprint_registry.set(obj, variant, digest)
+        self.save(("FINGERPRINT", digest))
+
+    def truncate(self, obj):
+        if self.max_length is None:
+            return obj
+        return obj[tuple(slice(min(size, self.max_length)) for size in obj.shape)]
+
     # noinspection PyProtectedMember
-    def save_dataframe(self, obj):
-        if len(obj) > self.max_length:
+    def save_dataframe_data(self, obj):
+        if self.max_length is None:
+            # Hash the buffers of all the columns at once, so that they are spread over the hashing threads
+            columns, buffers = [], []
+            for i, name in enumerate(obj.columns):
+                values = obj.iloc[:, i].values
+                if isinstance(values, pd.Categorical):
+                    columns.append((name, "CATEGORICAL", values.categories, values.ordered))
+                    values = values.codes
+                elif not isinstance(values, np.ndarray):
+                    # Other extension arrays (strings, nullable integers, ...)
+                    values = np.asarray(values)
+                if values.dtype.hasobject and pd.api.types.infer_dtype(values, skipna=False) == "string":
+                    # Vectorized 64 bits hashes of the strings, much faster than pickling them
+                    columns.append((name, "STRINGS"))
+                    values = pd.util.hash_array(values, categorize=False)
+                if not values.dtype.hasobject:
+                    columns.append((name, values.dtype, values.shape, len(buffers)))
+                    buffers.append(np.ascontiguousarray(values).reshape(-1).view(np.uint8))
+                else:
+                    columns.append((name, values))
+            self.save((type(obj), obj.index, columns, hash_buffers(buffers)))
+        elif len(obj) > self.max_length:
             self.save(dict(
                 _data_axes=obj._data.axes,
                 _data_blocks=[(b.ndim, b.mgr_locs, b.values.T) for b in obj._data.blocks],
@@ -179,9 +461,18 @@ class TruncatedNumpyHasher(Hasher):
         else:
             self.save(obj, bypass_dispatch=True)
 
+    def save_dataframe(self, obj):
+        self.save_fingerprint(obj, TruncatedNumpyHasher.save_dataframe_data)
+
     def save_ndarray(self, obj):
         if not obj.dtype.hasobject:
-            obj = obj[tuple(slice(min(size, self.max_length)) for size in obj.shape)]
+            self.save_fingerprint(obj, TruncatedNumpyHasher.save_ndarray_data)
+        else:
+            self.save(obj, bypass_dispatch=True)
+
+    def save_ndarray_data(self, obj):
+        if not obj.dtype.hasobject:
+            obj = self.truncate(obj)
             # Compute a hash of the object
             # The update function of the hash requires a c_contiguous buffer.
             if obj.shape == ():
@@ -219,7 +510,10 @@ class TruncatedNumpyHasher(Hasher):
             # The object will be pickled by the pickler hashed at the end.
             obj = (klass, 'HASHED', obj.dtype, obj.shape, obj.strides)
             self.save(obj)
-            self.save_memoryview(self._getbuffer(obj_c_contiguous.view(self.np.uint8)))
+            if self.max_length is None:
+                self.save_memoryview(hash_buffers([obj_c_contiguous.view(self.np.uint8)])[0])
+            else:
+                self.save_memoryview(self._getbuffer(obj_c_contiguous.view(self.np.uint8)))
         else:
             self.save(obj, bypass_dispatch=True)
 
@@ -287,7 +581,7 @@ class TruncatedNumpyHasher(Hasher):
             self.write(pickle.MARK + pickle.LIST)
 
         self.memoize(obj)
-        if len(obj) > self.max_length:
+        if self.max_length is not None and len(obj) > self.max_length:
             self._batch_appends(obj[:self.max_length // 2])
             self._batch_appends(obj[-self.max_length // 2:])
         else:
@@ -308,11 +602,16 @@ class TruncatedNumpyHasher(Hasher):
         self.save(new_optim, bypass_dispatch=True)
 
     def save_tensor(self, obj):
-        self.save(obj.detach().cpu().numpy()[tuple(slice(min(size, self.max_length)) for size in obj.shape)])
+        self.save_fingerprint(obj, TruncatedNumpyHasher.save_tensor_data)
+
+    def save_tensor_data(self, obj):
+        self.save(self.truncate(obj.detach().cpu().numpy()))
 
     def save_parameter(self, obj):
-        obj = (obj.detach().cpu().numpy()[tuple(slice(min(size, self.max_length)) for size in obj.shape)],
-               obj.requires_grad)
+        self.save_fingerprint(obj, TruncatedNumpyHasher.save_parameter_data)
+
+    def save_parameter_data(self, obj):
+        obj = (self.truncate(obj.detach().cpu().numpy()), obj.requires_grad)
         self.save(obj)
 
     def save_base_estimator(self, obj):
@@ -358,15 +657,625 @@ class TruncatedNumpyHasher(Hasher):
         Pickler._batch_setitems(self, items)
 
 
-def hash_object(obj, max_length=2000, mmap_mode=None):
-    return TruncatedNumpyHasher(max_length=max_length, coerce_mmap=mmap_mode is not None).hash(obj)
+def hash_object(obj, max_length=2000, mmap_mode=None, exact=False):
+    """
+    Hash an object, truncating its arrays and sequences to `max_length` elements (see `TruncatedNumpyHasher`),
+    or hashing their full content if `exact`
+    """
+    return TruncatedNumpyHasher(max_length=None if exact else max_length, coerce_mmap=mmap_mode is not None).hash(obj)
+
+
+def parse_size(size):
+    """
+    Parse a size in bytes, given as a number or a string with a K/M/G/T suffix ("500M", "20G")
+
+    Parameters
+    ----------
+    size: int or float or str or None
+
+    Returns
+    -------
+    int or None
+    """
+    if size is None or size == "":
+        return None
+    if isinstance(size, str):
+        size = size.strip().upper().rstrip("B")
+        units = {"K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30, "T": 2 ** 40}
+        if size and size[-1] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+    return int(float(size))
+
+
+def get_entry_size(path):
+    """
+    Total size in bytes of the files of a cache entry
+    """
+    total = 0
+    for root, dirs, files in os.walk(str(path)):
+        for name in files:
+            try:
+                total += os.stat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def get_object_size(obj, seen=None):
+    """
+    Estimated size in bytes of an object in memory: the buffers of the arrays, tensors and dataframes it contains
+    (in sequences, mappings and attributes, such as the tables of a Batcher or the matrices of a scipy.sparse
+    matrix) and sys.getsizeof of the other objects. Long sequences and object columns are estimated from
+    their first elements.
+
+    Parameters
+    ----------
+    obj: any
+    seen: set
+        Ids of the objects that were already counted
+
+    Returns
+    -------
+    int
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, torch.Tensor):
+        if obj.is_sparse:
+            return get_object_size(obj._values(), seen) + get_object_size(obj._indices(), seen)
+        return obj.element_size() * obj.nelement()
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        frame = obj.to_frame() if isinstance(obj, pd.Series) else obj
+        size = int(frame.memory_usage(index=True, deep=False).sum())
+        for name, dtype in frame.dtypes.items():
+            if dtype == object and len(frame):
+                # Python objects (strings) are not counted by memory_usage(deep=False), and counting them is slow
+                sample = frame[name].iloc[:100]
+                size += int(sum(sys.getsizeof(value) for value in sample) * len(frame) / len(sample))
+        return size
+    if isinstance(obj, (str, bytes, int, float, bool, type, types.ModuleType, types.FunctionType)) or obj is None:
+        return sys.getsizeof(obj)
+    if isinstance(obj, Mapping):
+        return sys.getsizeof(obj) + sum(get_object_size(key, seen) + get_object_size(value, seen) for key, value in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        items = list(obj)[:100] if len(obj) > 100 else obj
+        items_size = sum(get_object_size(item, seen) for item in items)
+        return sys.getsizeof(obj) + (items_size * len(obj) // len(items) if len(items) else 0)
+    size = sys.getsizeof(obj)
+    if hasattr(obj, "__dict__"):
+        size += get_object_size(vars(obj), seen)
+    return size
+
+
+def get_physical_memory():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+class CacheIndex:
+    """
+    SQLite database of the entries of the disk cache, stored as CACHE_PATH/index.sqlite, that records for each entry
+    (path relative to the cache directory): its function (the keys of the entry), its key (hash of its arguments),
+    the fingerprints of its arguments, the version of the code of its function, its size (NULL until its first output
+    is written), its creation and last access times, the duration of its last load and whether it is pinned.
+
+    The database is shared by all the processes that use the cache, each process opens its own connection.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS entries (
+        path TEXT PRIMARY KEY,
+        function TEXT,
+        key TEXT,
+        args TEXT,
+        code_version TEXT,
+        size INTEGER,
+        created REAL,
+        accessed REAL,
+        load_time REAL,
+        pinned INTEGER DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS entries_function ON entries (function);
+    CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+    """
+    COLUMNS = ("path", "function", "key", "args", "code_version", "size", "created", "accessed", "load_time", "pinned")
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.lock = threading.RLock()
+        self._connection = None
+        self._pid = None
+
+    @property
+    def connection(self):
+        # Connections cannot be shared with forked processes (such as DataLoader workers)
+        if self._connection is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False, isolation_level=None)
+            try:
+                connection.execute("PRAGMA journal_mode=WAL")
+            except sqlite3.DatabaseError:
+                pass
+            connection.executescript(self.SCHEMA)
+            self._connection, self._pid = connection, os.getpid()
+        return self._connection
+
+    def execute(self, query, params=()):
+        with self.lock:
+            return self.connection.execute(query, params).fetchall()
+
+    def executemany(self, query, params):
+        with self.lock:
+            with self.connection:
+                self.connection.executemany(query, params)
+
+    def is_empty(self):
+        return not self.execute("SELECT 1 FROM entries LIMIT 1")
+
+    def upsert(self, path, **fields):
+        """
+        Insert an entry or update some of its fields
+        """
+        now = time.time()
+        fields = {key: value for key, value in fields.items() if value is not None}
+        self.execute("INSERT OR IGNORE INTO entries (path, size, created, accessed) VALUES (?, NULL, ?, ?)", (path, now, now))
+        if fields:
+            self.execute(f"UPDATE entries SET {', '.join(f'{key} = ?' for key in fields)} WHERE path = ?", (*fields.values(), path))
+
+    def remove(self, path):
+        self.execute("DELETE FROM entries WHERE path = ?", (path,))
+
+    def select(self, where="", params=(), order_by=None, limit=None):
+        """
+        Query entries as dicts
+
+        Parameters
+        ----------
+        where: str
+            SQL condition on the columns of the entries
+        params: tuple
+            Parameters of the condition
+        order_by: str
+        limit: int
+
+        Returns
+        -------
+        list of dict
+        """
+        query = f"SELECT {', '.join(self.COLUMNS)} FROM entries"
+        if where:
+            query += f" WHERE {where}"
+        if order_by:
+            query += f" ORDER BY {order_by}"
+        if limit is not None:
+            query += f" LIMIT {int(limit)}"
+        return [dict(zip(self.COLUMNS, row)) for row in self.execute(query, params)]
+
+
+class CacheManager:
+    """
+    Keep track of the entries of the disk cache in a `CacheIndex`, and evict the least recently used entries after
+    a write when the cache exceeds its quota (in total, or for the entries of a function)
+
+    An entry is a directory of the cache that contains an inputs.txt file (as created by `get_cache`).
+    Entries that contain a .pinned file are never evicted. The default manager `cache_manager` reads its quotas from
+    the CACHE_MAX_SIZE and CACHE_MAX_SIZE_PER_FUNCTION environment variables, and the quota of a function can also be
+    given with `cached(max_size=...)`. The cache directory is only walked to build the index if it does not exist yet.
+    The size of an entry is measured after each write, and is NULL in the index until its first output is complete.
+    """
+    PIN_FILE = ".pinned"
+
+    def __init__(self, root=None, max_size=None, max_size_per_function=None):
+        """
+        Parameters
+        ----------
+        root: str
+            Cache directory, defaults to CACHE_PATH
+        max_size: int or str
+            Quota of the whole cache (bytes or size with a K/M/G/T suffix), None for no limit
+        max_size_per_function: int or str
+            Default quota of the entries of each function, None for no limit
+        """
+        self._root = root
+        self.max_size = parse_size(max_size)
+        self.max_size_per_function = parse_size(max_size_per_function)
+        self.function_quotas = {}
+        self.lock = threading.RLock()
+        self._index = None
+
+    @property
+    def root(self):
+        return os.path.abspath(str(self._root if self._root is not None else env["CACHE_PATH"]))
+
+    @property
+    def index(self):
+        path = os.path.join(self.root, "index.sqlite")
+        if self._index is None or self._index.path != path:
+            missing = not os.path.exists(path)
+            self._index = CacheIndex(path)
+            if missing:
+                self.reindex()
+        return self._index
+
+    @property
+    def has_quota(self):
+        return self.max_size is not None or self.max_size_per_function is not None or any(quota is not None for quota in self.function_quotas.values())
+
+    def set_quota(self, max_size=None, max_size_per_function=None, function=None):
+        """
+        Change the quota of the whole cache, or of the entries of a function
+
+        Parameters
+        ----------
+        max_size: int or str
+        max_size_per_function: int or str
+        function: str
+            Path of the function entries relative to the cache directory, such as "nlstruct/core/text/transform_text".
+            If given, `max_size` is the quota of the entries of this function only
+        """
+        if function is not None:
+            self.function_quotas[function] = parse_size(max_size)
+        else:
+            self.max_size = parse_size(max_size)
+            self.max_size_per_function = parse_size(max_size_per_function)
+
+    def relpath(self, path):
+        return os.path.relpath(os.path.abspath(str(path)), self.root)
+
+    def reindex(self, clear=False):
+        """
+        Walk the cache directory to add its entries, with their size, to the index
+
+        Parameters
+        ----------
+        clear: bool
+            Remove all the entries of the index first, to forget the entries that were deleted by other means
+        """
+        path = os.path.join(self.root, "index.sqlite")
+        if self._index is None or self._index.path != path:
+            # The index is filled below, do not walk the cache directory twice if it does not exist yet
+            self._index = CacheIndex(path)
+        rows = []
+        for root, dirs, files in os.walk(self.root):
+            if "inputs.txt" in files:
+                # Do not look for entries inside an entry
+                dirs.clear()
+                path = self.relpath(root)
+                mtime = os.stat(root).st_mtime
+                # Entries whose outputs are still being written are measured when they are recorded
+                size = get_entry_size(root) if any(name.endswith(".done") for name in files) else None
+                rows.append((path, os.path.dirname(path), os.path.basename(path), size, mtime, mtime, int(self.PIN_FILE in files)))
+        if clear:
+            self._index.execute("DELETE FROM entries")
+        self._index.executemany(
+            "INSERT OR REPLACE INTO entries (path, function, key, size, created, accessed, pinned) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def register(self, path, args=None, code_version=None):
+        """
+        Record a new entry, with the fingerprints of its arguments and the version of the code of its function
+        """
+        rel = self.relpath(path)
+        self.index.upsert(rel, function=os.path.dirname(rel), key=os.path.basename(rel),
+                          args=json.dumps(args) if args is not None else None, code_version=code_version)
+
+    def touch(self, path, load_time=None):
+        """
+        Record an access to an entry
+        """
+        rel = self.relpath(path)
+        self.index.upsert(rel, accessed=time.time(), load_time=load_time)
+
+    def record(self, path):
+        """
+        Record the size of an entry after a complete write, and evict other entries if the cache is over quota
+
+        Parameters
+        ----------
+        path: str
+            Directory of the entry
+        """
+        rel = self.relpath(path)
+        with self.lock:
+            self.index.upsert(rel, function=os.path.dirname(rel), key=os.path.basename(rel), size=get_entry_size(path), accessed=time.time())
+            if self.has_quota:
+                self.enforce(protect=rel)
+
+    def update_sizes(self):
+        """
+        Measure the complete entries that have no size in the index (written by older versions, or by other means).
+        Entries without any complete output are being written, and are measured when they are recorded.
+        """
+        rows = []
+        # Sizes of 0 are the default of the indexes created by older versions
+        for (path,) in self.index.execute("SELECT path FROM entries WHERE size IS NULL OR size = 0"):
+            directory = os.path.join(self.root, path)
+            try:
+                complete = any(name.endswith(".done") for name in os.listdir(directory))
+            except OSError:
+                complete = False
+            if complete:
+                rows.append((get_entry_size(directory), path))
+        self.index.executemany("UPDATE entries SET size = ? WHERE path = ?", rows)
+
+    def is_pinned(self, path):
+        return os.path.exists(os.path.join(str(path), self.PIN_FILE))
+
+    def pin(self, path):
+        """
+        Protect an entry from eviction
+        """
+        with open(os.path.join(str(path), self.PIN_FILE), "w"):
+            pass
+        self.index.upsert(self.relpath(path), pinned=1)
+
+    def unpin(self, path):
+        try:
+            os.remove(os.path.join(str(path), self.PIN_FILE))
+        except FileNotFoundError:
+            pass
+        self.index.upsert(self.relpath(path), pinned=0)
+
+    def evict(self, path):
+        """
+        Delete an entry from the cache and the index
+
+        Parameters
+        ----------
+        path: str
+            Directory of the entry, absolute or relative to the cache directory
+        """
+        path = os.path.join(self.root, str(path))
+        logger.info(f"Evicting cache entry {path}")
+        shutil.rmtree(path, ignore_errors=True)
+        self.index.remove(self.relpath(path))
+
+    def evict_lru(self, quota, function=None, protect=None):
+        """
+        Evict the least recently used entries that are not pinned (of a function or of the whole cache)
+        until their total size fits in the quota
+        """
+        where, params = ("function = ?", (function,)) if function is not None else ("", ())
+        total = self.index.execute(f"SELECT COALESCE(SUM(size), 0) FROM entries" + (f" WHERE {where}" if where else ""), params)[0][0]
+        evicted = []
+        if total <= quota:
+            return evicted
+        for entry in self.index.select(" AND ".join(filter(None, [where, "pinned = 0"])), params, order_by="accessed"):
+            if total <= quota:
+                break
+            if entry["path"] == protect or self.is_pinned(os.path.join(self.root, entry["path"])):
+                continue
+            self.evict(entry["path"])
+            total -= entry["size"] or 0
+            evicted.append(entry["path"])
+        return evicted
+
+    def enforce(self, protect=None):
+        """
+        Evict the least recently used entries (that are not pinned) until the cache fits in its quotas
+
+        Parameters
+        ----------
+        protect: str
+            Entry that must not be evicted (typically the one that was just written), relative to the cache directory
+
+        Returns
+        -------
+        list of str
+            Evicted entries
+        """
+        evicted = []
+        with self.lock:
+            # Entries found by other means than a write were not measured
+            self.update_sizes()
+            if self.max_size_per_function is not None:
+                functions = [row[0] for row in self.index.execute("SELECT DISTINCT function FROM entries")]
+            else:
+                functions = [function for function, quota in self.function_quotas.items() if quota is not None]
+            for function in functions:
+                quota = self.function_quotas.get(function, self.max_size_per_function)
+                if quota is not None:
+                    evicted.extend(self.evict_lru(quota, function=function, protect=protect))
+            if self.max_size is not None:
+                evicted.extend(self.evict_lru(self.max_size, protect=protect))
+        return evicted
+
+    def total_size(self):
+        return self.index.execute("SELECT COALESCE(SUM(size), 0) FROM entries")[0][0]
+
+
+cache_manager = CacheManager(max_size=env.get("CACHE_MAX_SIZE", None), max_size_per_function=env.get("CACHE_MAX_SIZE_PER_FUNCTION", None))
+
+
+def get_path_size(path):
+    return get_entry_size(path) if os.path.isdir(path) else os.path.getsize(path)
+
+
+def remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def parse_compression(compress):
+    """
+    Parse a compression given as in joblib.dump: a method name ("zstd", "lz4", "zlib", ...), a (method, level) tuple,
+    an int (zlib level) or a bool
+
+    Returns
+    -------
+    (str, int)
+        Method (None for no compression) and level (None for the default level of the method)
+    """
+    if not compress:
+        return None, None
+    if compress is True:
+        return "zlib", 3
+    if isinstance(compress, int):
+        return "zlib", compress
+    if isinstance(compress, str):
+        return compress, None
+    method, level = compress
+    return method, level
+
+
+if zstandard is not None:
+    class ZstdCompressorWrapper(CompressorWrapper):
+        """
+        Zstandard compression of joblib pickles, ie joblib.dump(obj, path, compress=("zstd", 3))
+        """
+
+        def __init__(self):
+            CompressorWrapper.__init__(self, obj=None, prefix=b"\x28\xb5\x2f\xfd", extension=".zst")
+
+        def compressor_file(self, fileobj, compresslevel=None):
+            # joblib gives the path of the file to write
+            if isinstance(fileobj, str):
+                fileobj = open(fileobj, "wb")
+            return zstandard.ZstdCompressor(level=3 if compresslevel is None else compresslevel).stream_writer(fileobj)
+
+        def decompressor_file(self, fileobj):
+            return zstandard.ZstdDecompressor().stream_reader(fileobj)
+
+
+    try:
+        register_compressor("zstd", ZstdCompressorWrapper())
+    except ValueError:
+        # Already registered
+        pass
+
+
+def dump_pickle(obj, path, compress=None):
+    method, level = parse_compression(compress)
+    dump(obj, path, compress=(method, level if level is not None else 3) if method is not None else 0)
+
+
+def load_pickle(path, mmap_mode=None, map_location=None):
+    return load(path, mmap_mode=mmap_mode, map_location=map_location)
+
+
+def match_dataframe(obj):
+    # Other python objects than strings (lists, tuples, ...) would not be loaded back as the same objects
+    return (pyarrow is not None and type(obj) is pd.DataFrame and
+            all(pd.api.types.infer_dtype(obj[name], skipna=True) in ("string", "empty")
+                for name, dtype in obj.dtypes.items() if dtype == object))
+
+
+def dump_dataframe(obj, path, compress=None):
+    method, level = parse_compression(compress)
+    method = {"zlib": "gzip"}.get(method, method)
+    # Categorical columns are stored as dictionaries, and are categorical again when loaded
+    obj.to_parquet(path, engine="pyarrow", compression=method, **({"compression_level": level} if level is not None else {}))
+
+
+def load_dataframe(path, mmap_mode=None, map_location=None):
+    return pd.read_parquet(path, engine="pyarrow", memory_map=mmap_mode is not None)
+
+
+def dump_array(obj, path, compress=None):
+    # Never compressed, so that it can be memory mapped
+    with open(path, "wb") as file:
+        np.save(file, obj, allow_pickle=False)
+
+
+def load_array(path, mmap_mode=None, map_location=None):
+    return np.load(path, mmap_mode=mmap_mode, allow_pickle=False)
+
+
+def dump_arrays(obj, path, compress=None):
+    os.makedirs(path)
+    keys = list(obj.keys())
+    for i, key in enumerate(keys):
+        dump_array(obj[key], os.path.join(path, f"{i}.npy"))
+    with open(os.path.join(path, "keys.json"), "w") as file:
+        json.dump(keys, file)
+
+
+def load_arrays(path, mmap_mode=None, map_location=None):
+    with open(os.path.join(path, "keys.json")) as file:
+        keys = json.load(file)
+    return {key: load_array(os.path.join(path, f"{i}.npy"), mmap_mode=mmap_mode) for i, key in enumerate(keys)}
+
+
+def dump_state_dict(obj, path, compress=None):
+    torch.save(obj, path)
+
+
+def load_state_dict(path, mmap_mode=None, map_location=None):
+    return torch.load(path, map_location=map_location)
+
+
+def dump_batcher(obj, path, compress=None):
+    Batcher.save(obj, path)
+
+
+def load_batcher(path, mmap_mode=None, map_location=None):
+    return Batcher.load(path, mmap=mmap_mode is not None)
+
+
+serializers = OrderedDict()
+
+
+def register_serializer(name, match, dumper, loader):
+    """
+    Register a serializer of the results written to the cache by `CacheHandle.dump` when no dumper is given.
+    The serializer of a result is the last registered serializer that matches it, and its name is recorded in
+    the completion marker of the file so that `CacheHandle.load` uses the same serializer to load it.
+    If a serializer fails to write a result, the next matching serializer is used (ultimately joblib's pickle).
+
+    Parameters
+    ----------
+    name: str
+    match: callable
+        Returns whether an object can be written with this serializer
+    dumper: callable
+        dumper(obj, path, compress=None), where compress is given as in joblib.dump (see `parse_compression`)
+    loader: callable
+        loader(path, mmap_mode=None, map_location=None), where map_location is given as in torch.load
+    """
+    serializers[name] = (match, dumper, loader)
+    serializers.move_to_end(name, last=False)
+
+
+register_serializer("pickle", lambda obj: True, dump_pickle, load_pickle)
+register_serializer("dataframe", match_dataframe, dump_dataframe, load_dataframe)
+register_serializer("array", lambda obj: type(obj) in (np.ndarray, np.memmap) and not obj.dtype.hasobject, dump_array, load_array)
+register_serializer("arrays", lambda obj: (
+      type(obj) is dict and len(obj) > 0 and
+      all(isinstance(key, str) and isinstance(value, np.ndarray) and not value.dtype.hasobject for key, value in obj.items())), dump_arrays, load_arrays)
+register_serializer("state_dict", lambda obj: (
+      isinstance(obj, Mapping) and len(obj) > 0 and
+      all(isinstance(key, str) and isinstance(value, torch.Tensor) for key, value in obj.items())), dump_state_dict, load_state_dict)
+register_serializer("batcher", lambda obj: isinstance(obj, Batcher), dump_batcher, load_batcher)
 
 
 class CacheHandle(RelativePath):
-    def __init__(self, path, loader=None, dumper=None):
+    def __init__(self, path, loader=None, dumper=None, compress=None, mmap_mode=None):
+        """
+        Parameters
+        ----------
+        path: str
+        loader: callable
+        dumper: callable
+            Loader and dumper of the files of the entry, defaults to the serializers registered with
+            `register_serializer`, chosen by the type of the written objects
+        compress: str or int or tuple
+            Compression of the written files, as in joblib.dump ("zstd", ("lz4", 3), ...)
+        mmap_mode: str
+            Memory map mode of the loaded arrays (for the serializers that support it)
+        """
         super(CacheHandle, self).__init__(path)
-        self.loader = loader if loader is not None else load
-        self.dumper = dumper if dumper is not None else dump
+        self.loader = loader
+        self.dumper = dumper
+        self.compress = compress
+        self.mmap_mode = mmap_mode
         print(f"Using cache {self}")
 
     def entry(self, name):
@@ -376,27 +1285,142 @@ class CacheHandle(RelativePath):
     def tmp(self, item):
         return env.tmp(os.path.join(item))
 
+    @contextmanager
+    def lock(self):
+        """
+        Exclusive lock of the entry, shared by all the processes that use the cache directory, so that only one
+        of them computes a missing result while the others wait for it (see `cached`)
+
+        The lock is released when all the descriptors of the yielded lock file are closed, so it can be held
+        longer by duplicating its descriptor (as `AsyncWriter` does until the result is written).
+        """
+        if fcntl is None:
+            yield None
+            return
+        os.makedirs(str(self), exist_ok=True)
+        with open(os.path.join(str(self), ".lock"), "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print(f"Waiting for another process to compute {self}...", flush=True)
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield lock_file
+
+    def read_marker(self, name="output.pkl"):
+        """
+        Completion marker of a file of the entry: {"size": ..., "serializer": ...}, None if the file has no marker
+        """
+        with open(str(self / name) + ".done") as marker:
+            content = json.loads(marker.read())
+        # Markers used to only contain the size
+        return content if isinstance(content, dict) else {"size": content}
+
+    def is_complete(self, name="output.pkl"):
+        """
+        Whether a file of the entry was completely written: its completion marker records its size.
+        Files of older caches, that were written without a completion marker, are assumed to be complete.
+        """
+        path = str(self / name)
+        try:
+            size = self.read_marker(name)["size"]
+        except FileNotFoundError:
+            return os.path.exists(path)
+        except (OSError, ValueError, KeyError):
+            return False
+        try:
+            return get_path_size(path) == size
+        except OSError:
+            return False
+
     def load(self, source="output.pkl", loader=None, **kwargs):
         path = str(self / source)
+        pending = async_writer.get(path)
+        if pending is not None:
+            # Still being written by the background writer
+            return pending
         if os.path.exists(str(path)):
+            if not self.is_complete(source):
+                logger.warning(f"Ignoring incomplete cache file {path}")
+                return None
             print(f"Loading {path}... ", end="", flush=True)
-            if loader is None:
-                res = self.loader(path, **kwargs)
-            else:
+            start = time.time()
+            try:
+                if loader is None:
+                    loader = self.loader
+                if loader is None:
+                    try:
+                        serializer = self.read_marker(source).get("serializer") or "pickle"
+                    except FileNotFoundError:
+                        serializer = "pickle"
+                    loader = serializers[serializer][2]
+                    kwargs.setdefault("mmap_mode", self.mmap_mode)
                 res = loader(path, **kwargs)
+            except (EOFError, pickle.UnpicklingError, OSError, ValueError, IndexError, struct.error) as e:
+                # Truncated or unpicklable file: the result is computed again, other errors are raised
+                print("Failed")
+                logger.warning(f"Could not load cache file {path}: {e!r}")
+                return None
             print("Done")
+            cache_manager.touch(self, load_time=time.time() - start)
             return res
         return None
 
     def dump(self, obj, dest="output.pkl", dumper=None, **kwargs):
+        """
+        Write an object to a temporary file (or directory) that is atomically renamed to its destination once
+        complete, followed by a completion marker, so that readers never see a partially written file.
+        Without dumper, the object is written by the first registered serializer that matches it (see
+        `register_serializer`).
+        """
         assert obj is not None
         path = str(self / dest)
+        # Keep the name of the destination at the end, for the dumpers that add a missing extension
+        tmp_path = os.path.join(os.path.dirname(path), f".tmp-{os.getpid()}-{uuid.uuid4().hex[:8]}-{os.path.basename(path)}")
         if dumper is None:
-            self.dumper(obj, path, **kwargs)
-        else:
-            dumper(obj, path, **kwargs)
+            dumper = self.dumper
+        serializer = None
+        try:
+            if dumper is not None:
+                dumper(obj, tmp_path, **kwargs)
+            else:
+                compress = kwargs.pop("compress", self.compress)
+                for name, (match, serializer_dumper, _) in serializers.items():
+                    if not match(obj):
+                        continue
+                    try:
+                        serializer_dumper(obj, tmp_path, compress=compress)
+                        serializer = name
+                        break
+                    except Exception as e:
+                        if name == "pickle":
+                            raise
+                        logger.info(f"Could not write {path} with the {name} serializer, trying the next one: {e!r}")
+                        remove_path(tmp_path)
+            # os.replace cannot replace a directory, nor a file by a directory
+            if os.path.isdir(path) or os.path.exists(path) and os.path.isdir(tmp_path):
+                remove_path(path)
+            os.replace(tmp_path, path)
+        finally:
+            remove_path(tmp_path)
+        with open(path + ".done", "w") as marker:
+            json.dump({"size": get_path_size(path), "serializer": serializer}, marker)
+        cache_manager.record(self)
         return path
 
+    def pin(self):
+        """
+        Protect this entry from the eviction of the least recently used entries (see `CacheManager`)
+        """
+        os.makedirs(str(self), exist_ok=True)
+        cache_manager.pin(self)
+
+    def unpin(self):
+        cache_manager.unpin(self)
+
+    @property
+    def pinned(self):
+        return cache_manager.is_pinned(self)
+
     def listdir(self, glob_expr="*"):
         return sorted(glob.glob(os.path.join(str(self), glob_expr)))
 
@@ -404,11 +1428,231 @@ class CacheHandle(RelativePath):
         return "{}({!r})".format(self.__class__.__name__, self.as_posix())
 
 
-class RAMCacheHandle(RelativePath):
-    records = {}
+class AsyncWriter:
+    """
+    Background thread that writes the results of `cached(async_dump=True)` functions to the disk cache, so that
+    the functions return as soon as their results are computed. Until it is written, a result is served from
+    memory to the readers of its entry in the process, and the lock of its entry is held (see `CacheHandle.lock`).
+    At most `max_pending` results wait to be written: further writes block until one of them is written.
+    The writes are flushed when the interpreter exits.
 
-    def __init__(self, path):
+    The results must not be modified while they are written.
+    """
+
+    def __init__(self, max_pending=4):
+        self.max_pending = max_pending
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.tasks = None
+        self.thread = None
+        self.pid = None
+
+    def start(self):
+        with self.lock:
+            # The thread does not survive a fork (such as DataLoader workers)
+            if self.thread is None or self.pid != os.getpid():
+                self.pending = {}
+                self.tasks = queue.Queue(maxsize=self.max_pending)
+                self.thread = threading.Thread(target=self.run, args=(self.tasks,), name="cache-writer", daemon=True)
+                self.pid = os.getpid()
+                self.thread.start()
+
+    def submit(self, handle, obj, dest="output.pkl", lock_fd=None):
+        """
+        Write an object to a cache entry in the background
+
+        Parameters
+        ----------
+        handle: CacheHandle
+        obj: any
+        dest: str
+        lock_fd: int
+            Duplicated descriptor of the lock of the entry, closed once the object is written
+        """
+        self.start()
+        with self.lock:
+            self.pending[str(handle / dest)] = obj
+        self.tasks.put((handle, obj, dest, lock_fd))
+
+    def get(self, path):
+        return self.pending.get(str(path))
+
+    def run(self, tasks):
+        while True:
+            handle, obj, dest, lock_fd = tasks.get()
+            path = str(handle / dest)
+            try:
+                handle.dump(obj, dest)
+            except Exception as e:
+                logger.error(f"Could not write cache file {path}: {e!r}")
+            finally:
+                with self.lock:
+                    if self.pending.get(path) is obj:
+                        del self.pending[path]
+                if lock_fd is not None:
+                    os.close(lock_fd)
+                tasks.task_done()
+
+    def flush(self):
+        """
+        Wait until all the pending results are written
+        """
+        if self.tasks is not None and self.pid == os.getpid():
+            self.tasks.join()
+
+
+async_writer = AsyncWriter()
+atexit.register(async_writer.flush)
+
+
+class RAMCache:
+    """
+    Memory tier of the results of `cached(ram=True)` functions
+
+    Results are kept in memory up to a budget of bytes (estimated with `get_object_size`). When the budget is
+    exceeded, the least recently used results are demoted to the disk cache (see `RAMCacheHandle`), from where
+    they are loaded and promoted back to memory when they are used again. The default tier `ram_cache` reads its
+    budget from the CACHE_RAM_MAX_SIZE environment variable, and defaults to a quarter of the physical memory.
+    """
+
+    def __init__(self, max_size=None):
+        """
+        Parameters
+        ----------
+        max_size: int or str
+            Budget in bytes or size with a K/M/G/T suffix, None for no limit
+        """
+        self.max_size = parse_size(max_size)
+        self.records = OrderedDict()
+        self.size = 0
+        # Results that left the memory and are being written to the disk, still served until they are written
+        self.demoting = {}
+        self.lock = threading.RLock()
+
+    def get(self, path):
+        with self.lock:
+            record = self.records.get(path)
+            if record is None:
+                record = self.demoting.get(path)
+                return record["obj"] if record is not None else None
+            self.records.move_to_end(path)
+            return record["obj"]
+
+    def put(self, path, obj, demote=None):
+        """
+        Store a result in memory, and demote the least recently used results if the tier is over budget
+
+        Parameters
+        ----------
+        path: str
+        obj: any
+        demote: callable
+            Function that writes the result to the disk cache when it leaves the memory
+        """
+        size = get_object_size(obj)
+        with self.lock:
+            self.remove(path)
+            self.records[path] = {"obj": obj, "size": size, "demote": demote}
+            self.size += size
+        self.enforce()
+
+    def remove(self, path):
+        with self.lock:
+            record = self.records.pop(path, None)
+            if record is not None:
+                self.size -= record["size"]
+            return record
+
+    def demote(self, path):
+        """
+        Move a result from memory to the disk cache
+        """
+        self.write_demoted(self.pop_demoted([path]))
+
+    def pop_demoted(self, paths):
+        """
+        Remove results from memory (under the lock) before they are written to the disk by `write_demoted`
+        """
+        with self.lock:
+            records = []
+            for path in paths:
+                record = self.remove(path)
+                if record is not None and record["demote"] is not None:
+                    self.demoting[path] = record
+                    records.append((path, record))
+            return records
+
+    def write_demoted(self, records):
+        """
+        Write results removed by `pop_demoted` to the disk, without holding the lock
+        """
+        for path, record in records:
+            logger.info(f"Demoting cached result {path} to disk")
+            try:
+                record["demote"](record["obj"])
+            except Exception as e:
+                logger.warning(f"Could not demote cached result {path} to disk: {e}")
+            finally:
+                with self.lock:
+                    if self.demoting.get(path) is record:
+                        del self.demoting[path]
+
+    def enforce(self):
+        with self.lock:
+            victims = []
+            size = self.size
+            for path, record in self.records.items():
+                if self.max_size is None or size <= self.max_size:
+                    break
+                victims.append(path)
+                size -= record["size"]
+            records = self.pop_demoted(victims)
+        self.write_demoted(records)
+
+    def set_max_size(self, max_size):
+        self.max_size = parse_size(max_size)
+        self.enforce()
+
+    def clear(self, demote=False):
+        """
+        Empty the memory tier, demoting its results to the disk cache if `demote`
+        """
+        if demote:
+            self.write_demoted(self.pop_demoted(list(self.records)))
+            return
+        with self.lock:
+            for path in list(self.records):
+                self.remove(path)
+
+    def __len__(self):
+        return len(self.records)
+
+
+ram_cache = RAMCache(max_size=parse_size(env.get("CACHE_RAM_MAX_SIZE", None)) or (get_physical_memory() or 0) // 4 or None)
+
+
+class RAMCacheHandle(RelativePath):
+    def __init__(self, path, loader=None, dumper=None, describe=None, compress=None, mmap_mode=None):
+        """
+        Parameters
+        ----------
+        path: str
+        loader:
+        dumper:
+        compress:
+        mmap_mode:
+            Parameters of the disk tier (see `CacheHandle`)
+        describe: callable
+            Returns the description of the inputs of the entry (see `describe_inputs`) and the version of its
+            code, that are written to the disk tier if the result is demoted. It is only called when the result is
+            demoted, and should not keep the inputs alive (see `defer_describe_inputs`).
+        """
         super(RAMCacheHandle, self).__init__(path)
+        self.loader = loader
+        self.dumper = dumper
+        self.describe = describe
+        self.compress = compress
+        self.mmap_mode = mmap_mode
 
     def entry(self, name):
         return RelativePath(os.path.join(str(self), name))
@@ -416,16 +1660,37 @@ class RAMCacheHandle(RelativePath):
     def tmp(self, item):
         raise NotImplementedError()
 
-    def load(self, name="output.pkl"):
+    def lock(self):
+        return nullcontext(None)
+
+    def demoter(self, name, describe=None):
+        path, handle_kwargs = str(self), dict(loader=self.loader, dumper=self.dumper, compress=self.compress, mmap_mode=self.mmap_mode)
+
+        # Do not keep a reference to the handle
+        def demote(obj):
+            if os.path.exists(os.path.join(path, name)):
+                return
+            handle = CacheHandle(path, **handle_kwargs)
+            if describe is not None and not os.path.exists(os.path.join(path, "inputs.txt")):
+                write_inputs(handle, *describe())
+            handle.dump(obj, name)
+
+        return demote
+
+    def load(self, name="output.pkl", **kwargs):
         path = str(self / name)
-        if str(path) in self.records:
-            return self.records[str(path)]
-        return None
+        res = ram_cache.get(path)
+        if res is None and os.path.exists(path):
+            # The result was demoted to the disk tier
+            res = CacheHandle(str(self), loader=self.loader, dumper=self.dumper, compress=self.compress, mmap_mode=self.mmap_mode).load(name, **kwargs)
+            if res is not None:
+                ram_cache.put(path, res, self.demoter(name))
+        return res
 
     def dump(self, obj, name="output.pkl"):
         assert obj is not None
         path = str(self / name)
-        self.records[str(path)] = obj
+        ram_cache.put(path, obj, self.demoter(name, self.describe))
         return path
 
     def listdir(self, glob_expr="*"):
@@ -436,12 +1701,23 @@ class RAMCacheHandle(RelativePath):
 
 
 class CustomUnpickler(NumpyUnpickler):
-    def __init__(self, filename, file_handle, mmap_mode=None, current_cache=None):
-        super(CustomUnpickler, self).__init__(filename, file_handle, mmap_mode)
+    def __init__(self, filename, file_handle, mmap_mode=None, current_cache=None, map_location=None):
+        self.map_location = map_location
+        if UNPICKLER_BYTE_ORDER:
+            super(CustomUnpickler, self).__init__(filename, file_handle, mmap_mode is None, mmap_mode=mmap_mode)
+        else:
+            super(CustomUnpickler, self).__init__(filename, file_handle, mmap_mode)
         self.current_cache = current_cache
 
     dispatch = NumpyUnpickler.dispatch.copy()
 
+    def find_class(self, module, name):
+        # Pickled torch storages are loaded with torch.load, that can move them to another device
+        if self.map_location is not None and (module, name) == ("torch.storage", "_load_from_bytes"):
+            map_location = self.map_location
+            return lambda data: torch.load(io.BytesIO(data), map_location=map_location, **TORCH_LOAD_KWARGS)
+        return super(CustomUnpickler, self).find_class(module, name)
+
     def load_build(self):
         stack = self.stack
         state = stack.pop()
@@ -498,23 +1774,29 @@ class CustomUnpickler(NumpyUnpickler):
             # the end of the unpickling.
             if isinstance(array_wrapper, NDArrayWrapper):
                 self.compat_mode = True
-            self.stack.append(array_wrapper.read(self))
+                self.stack.append(array_wrapper.read(self))
+            elif UNPICKLER_BYTE_ORDER:
+                self.stack.append(array_wrapper.read(self, self.ensure_native_byte_order))
+            else:
+                self.stack.append(array_wrapper.read(self))
 
     dispatch[pickle.BUILD[0]] = load_build
 
 
-def load(filename, mmap_mode=None, current_cache=None):
+def load(filename, mmap_mode=None, current_cache=None, map_location=None):
     """Unpickling function."""
     if hasattr(filename, 'read'):
-        fobj = filename
-        filename = getattr(fobj, 'name', '')
-        with _read_fileobject(fobj, filename, mmap_mode) as fobj:
-            unpickler = CustomUnpickler(filename, fobj, mmap_mode=mmap_mode, current_cache=current_cache)
-            return unpickler.load()
+        return load_fileobject(filename, getattr(filename, 'name', ''), mmap_mode, current_cache, map_location)
     with open(filename, 'rb') as f:
-        with _read_fileobject(f, filename, mmap_mode) as fobj:
-            unpickler = CustomUnpickler(filename, fobj, mmap_mode=mmap_mode, current_cache=current_cache)
-            return unpickler.load()
+        return load_fileobject(f, filename, mmap_mode, current_cache, map_location)
+
+
+def load_fileobject(fobj, filename, mmap_mode=None, current_cache=None, map_location=None):
+    with _read_fileobject(fobj, filename, mmap_mode) as fobj:
+        if isinstance(fobj, tuple):
+            fobj, mmap_mode = fobj
+        unpickler = CustomUnpickler(filename, fobj, mmap_mode=mmap_mode, current_cache=current_cache, map_location=map_location)
+        return unpickler.load()
 
 
 dump = joblib.dump
@@ -543,6 +1825,16 @@ def get_class_that_defined_method(meth):
     return None
 
 
+def get_code_version(func):
+    """
+    Hash of the source code of a function, recorded in the cache index to find the entries of older versions of the code
+    """
+    try:
+        return xxhash.xxh64(inspect.getsource(func).encode()).hexdigest()
+    except (OSError, TypeError):
+        return None
+
+
 class cached(object):
     MAP = {}
 
@@ -554,7 +1846,8 @@ class cached(object):
 
         return apply_on_func
 
-    def __init__(self, with_state=False, hash_only=None, ram=False, ignore=None, loader=None, dumper=None, default_cache_mode="rw"):
+    def __init__(self, with_state=False, hash_only=None, ram=False, ignore=None, loader=None, dumper=None, default_cache_mode="rw", max_size=None,
+                 exact_hash=False, async_dump=False, compress=None, mmap_mode=None, memoize_fingerprints=False):
         self.ready = False
         self.with_state = with_state
         self.cls = None
@@ -564,8 +1857,17 @@ class cached(object):
         self.loader = loader
         self.dumper = dumper
         self.default_cache_mode = default_cache_mode
+        self.max_size = max_size
+        self.exact_hash = exact_hash
+        self.async_dump = async_dump
+        self.compress = compress
+        self.mmap_mode = mmap_mode
+        self.memoize_fingerprints = memoize_fingerprints
+        self.code_version = None
         self.func = None
-        self.caller_self = None
+        self.signature = None
+        self.expect_cache_handle = False
+        self.keys = None
 
         if hasattr(with_state, '__call__'):
             fn = with_state
@@ -574,7 +1876,7 @@ class cached(object):
 
     @property
     def nocache(self):
-        return self.func.__get__(self.caller_self) if hasattr(self.func, '__get__') and self.caller_self is not None else self.func
+        return self.func
 
     def __reduce__(self):
         if self.func is not None:
@@ -587,106 +1889,163 @@ class cached(object):
     def __get__(self, instance, owner):
         if instance is None:
             return self
-        self.caller_self = instance
-        return self
+        # Bind the instance to a new object for each access, since the decorator is shared by all the instances
+        return BoundCached(self, instance)
 
     def __call__(self, *args, cache=None, **kwargs):
         if self.ready:
-            if self.caller_self is not None:
-                args = (self.caller_self, *args)
-            if global_no_cache:
-                return self.func(*args, **kwargs)
-            sig = inspect.signature(self.func)
-            bound_arguments = sig.bind_partial(*args, **kwargs)
-            bound_arguments.apply_defaults()
-            # Get an ordered dict
-            for name in self.ignore:
-                if name in bound_arguments.arguments:
-                    del bound_arguments.arguments[name]
-            expect_cache_handle = False
-            if '_cache' in sig.parameters:
-                expect_cache_handle = True
-                if "_cache" in bound_arguments.arguments:
-                    del bound_arguments.arguments['_cache']
-
-            if self.cls is not None:
-                keys = tuple((*self.func.__module__.split('.'), self.cls.__name__, self.func.__name__))
-            else:
-                keys = tuple((*self.func.__module__.split('.'), self.func.__name__))
-
-            if self.with_state:
-                (caller_self, *args) = args
-                cache_mode = self.default_cache_mode if cache is None else cache
-                if not cache_mode:
-                    return self.func(*args, **kwargs)
-                if self.hash_only is not None:
-                    handle = get_cache(keys,
-                                       self.hash_only(caller_self, *bound_arguments.args, **bound_arguments.kwargs),
-                                       on_ram=self.ram,
-                                       loader=self.loader,
-                                       dumper=self.dumper)
-                else:
-                    handle = get_cache(keys, caller_self,
-                                       (bound_arguments.args, bound_arguments.kwargs),
-                                       on_ram=self.ram,
-                                       loader=self.loader,
-                                       dumper=self.dumper, )
-                cached_result = handle.load() if "r" in cache_mode else None
-
-                if cached_result is None:
-                    if expect_cache_handle:
-                        result = self.func(caller_self, *args, _cache=handle, **kwargs)
-                    else:
-                        result = self.func(caller_self, *args, **kwargs)
-                    if "w" in cache_mode:
-                        handle.dump((caller_self, result))
-                else:
-                    cached_self, result = cached_result
-                    caller_self.__dict__ = cached_self.__dict__
-                return result
-            else:
-                cache_mode = self.default_cache_mode if cache is None else cache
-                if not cache_mode:
-                    return self.func(*args, **kwargs)
-                if self.hash_only is not None:
-                    handle = get_cache(keys,
-                                       self.hash_only(*bound_arguments.args, **bound_arguments.kwargs),
-                                       on_ram=self.ram,
-                                       loader=self.loader,
-                                       dumper=self.dumper)
-                else:
-                    handle = get_cache(keys, (bound_arguments.args, bound_arguments.kwargs),
-                                       on_ram=self.ram,
-                                       loader=self.loader,
-                                       dumper=self.dumper, )
-                result = handle.load() if "r" in cache_mode else None
-                if result is None:
-                    if expect_cache_handle:
-                        result = self.func(*args, _cache=handle, **kwargs)
-                    else:
-                        result = self.func(*args, **kwargs)
-                    if "w" in cache_mode:
-                        handle.dump(result)
-                return result
+            return self.call(args, kwargs, cache=cache)
         else:
             func = args[0]
             if self.ignore is None:
                 self.ignore = getattr(func, '_ignore_args', ())
-            cache_key = (func, self.with_state, self.ram, self.ignore, self.loader, self.dumper, self.default_cache_mode)
+            cache_key = (func, self.with_state, self.ram, self.ignore, self.loader, self.dumper, self.default_cache_mode, self.max_size, self.exact_hash, self.async_dump,
+                         self.compress, self.mmap_mode, self.memoize_fingerprints)
             if cache_key in cached.MAP:
                 return cached.MAP[cache_key]
             self.cls = get_class_that_defined_method(func)
             self.func = func
+            self.code_version = get_code_version(func)
+            self.signature = inspect.signature(func)
+            self.expect_cache_handle = '_cache' in self.signature.parameters
+            if self.cls is not None:
+                self.keys = (*func.__module__.split('.'), self.cls.__name__, func.__name__)
+            else:
+                self.keys = (*func.__module__.split('.'), func.__name__)
             self.ready = True
             self.__name__ = func.__name__
-            self.__signature__ = inspect.signature(func)
+            self.__signature__ = self.signature
             self.__doc__ = func.__doc__
             self.__module__ = func.__module__
             cached.MAP[cache_key] = self
             return self
 
+    def call(self, args, kwargs, cache=None):
+        """
+        Load the result of the function for these arguments from the cache, or compute and store it.
+        All the state of a call is local, so that cached functions can be called from concurrent threads.
+
+        Parameters
+        ----------
+        args: tuple
+            Positional arguments, starting with the instance for methods
+        kwargs: dict
+        cache: str
+            Cache mode of this call ("r", "w", "rw" or "" to disable the cache), defaults to `default_cache_mode`
+        """
+        cache_mode = self.default_cache_mode if cache is None else cache
+        if no_cache.get() or not cache_mode:
+            return self.func(*args, **kwargs)
+        bound_arguments = self.signature.bind_partial(*args, **kwargs)
+        bound_arguments.apply_defaults()
+        # Get an ordered dict
+        for name in self.ignore:
+            if name in bound_arguments.arguments:
+                del bound_arguments.arguments[name]
+        if self.expect_cache_handle and "_cache" in bound_arguments.arguments:
+            del bound_arguments.arguments['_cache']
+
+        # The instance is the first positional argument of methods, and is hashed with the other arguments
+        if self.hash_only is not None:
+            hashed = self.hash_only(*bound_arguments.args, **bound_arguments.kwargs)
+        else:
+            hashed = (bound_arguments.args, bound_arguments.kwargs)
+        if self.memoize_fingerprints:
+            # The caller promises not to modify the arguments in place: they are only hashed once
+            # (except for the instance of methods with state, that is modified by the call)
+            for value in list(bound_arguments.arguments.values())[1 if self.with_state else 0:]:
+                fingerprint_registry.freeze(value)
+        handle = get_cache(self.keys, hashed,
+                           on_ram=self.ram,
+                           loader=self.loader,
+                           dumper=self.dumper,
+                           max_size=self.max_size,
+                           exact_hash=self.exact_hash,
+                           compress=self.compress,
+                           mmap_mode=self.mmap_mode,
+                           inputs=bound_arguments.arguments,
+                           code_version=self.code_version)
+        cached_result = handle.load() if "r" in cache_mode else None
+        if cached_result is None:
+            with handle.lock() as lock_file:
+                # Another process may have computed the result while this one was waiting for the lock
+                cached_result = handle.load() if "r" in cache_mode else None
+                if cached_result is None:
+                    if self.expect_cache_handle:
+                        result = self.func(*args, _cache=handle, **kwargs)
+                    else:
+                        result = self.func(*args, **kwargs)
+                    if "w" in cache_mode:
+                        to_dump = (args[0], result) if self.with_state else result
+                        if self.async_dump and isinstance(handle, CacheHandle):
+                            # The writer keeps the entry locked until the result is written
+                            async_writer.submit(handle, to_dump, lock_fd=os.dup(lock_file.fileno()) if lock_file is not None else None)
+                        else:
+                            handle.dump(to_dump)
+                    if self.memoize_fingerprints:
+                        self.freeze_result(result, handle)
+                    return result
+        if self.with_state:
+            cached_self, result = cached_result
+            args[0].__dict__ = cached_self.__dict__
+        else:
+            result = cached_result
+        if self.memoize_fingerprints:
+            self.freeze_result(result, handle)
+        return result
+
+    @staticmethod
+    def freeze_result(result, handle):
+        """
+        Freeze the result (or the items of a tuple result) in the fingerprint registry with the key of its cache entry as
+        fingerprint, so that the cached functions it is then given to do not hash its data
+        """
+        digest = os.path.relpath(str(handle), env['CACHE_PATH'])
+        items = enumerate(result) if isinstance(result, tuple) else [(None, result)]
+        for i, item in items:
+            # Objects that were already frozen (arguments returned as is, ...) keep their fingerprint
+            if not fingerprint_registry.is_frozen(item):
+                fingerprint_registry.freeze(item, digest if i is None else f"{digest}[{i}]")
+
+
+class BoundCached(object):
+    """
+    `cached` method bound to an instance
+    """
+
+    def __init__(self, cached_func, instance):
+        self.cached_func = cached_func
+        self.instance = instance
+        self.__name__ = getattr(cached_func, "__name__", None)
+        self.__doc__ = getattr(cached_func, "__doc__", None)
+
+    @property
+    def nocache(self):
+        return self.cached_func.func.__get__(self.instance, type(self.instance))
+
+    def __call__(self, *args, cache=None, **kwargs):
+        return self.cached_func.call((self.instance, *args), kwargs, cache=cache)
+
+    def __getattr__(self, name):
+        # copy and pickle look up special methods before __init__ sets cached_func
+        if name.startswith("__") or "cached_func" not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.cached_func, name)
+
+    def __reduce__(self):
+        return BoundCached, (self.cached_func, self.instance)
+
+    def __repr__(self):
+        return f"<bound cached method {self.cached_func.__name__} of {self.instance!r}>"
 
-def get_cache(keys, args=None, loader=None, dumper=None, on_ram=False):
+
+inputs_repr = reprlib.Repr()
+inputs_repr.maxstring = 200
+inputs_repr.maxother = 200
+
+
+def get_cache(keys, args=None, loader=None, dumper=None, on_ram=False, max_size=None, inputs=None, code_version=None, exact_hash=False,
+              compress=None, mmap_mode=None):
     """
     Get a unique cache object for given identifier and args
 
@@ -697,6 +2056,19 @@ def get_cache(keys, args=None, loader=None, dumper=None, on_ram=False):
     kwargs: Any
     loader:
     dumper:
+    max_size: int or str
+        If given, quota of all the entries of these keys (see `CacheManager`)
+    inputs: dict
+        Named arguments described in the inputs.txt file of the entry and in the cache index, defaults to args
+    code_version: str
+        Version of the code that computes the entry, recorded in the cache index
+    exact_hash: bool
+        Hash the full content of the arrays, tensors, dataframes and sequences of args, instead of their first
+        elements only (see `hash_object`)
+    compress: str or int or tuple
+        Compression of the written files, as in joblib.dump ("zstd", ("lz4", 3), ...)
+    mmap_mode: str
+        Memory map mode of the loaded arrays
 
     Returns
     -------
@@ -708,31 +2080,86 @@ def get_cache(keys, args=None, loader=None, dumper=None, on_ram=False):
         keys = [*str(keys).split("/")]
     elif not hasattr(keys, '__len__'):
         keys = [str(keys)]
-    keys = list(keys) + [hash_object(args, mmap_mode=None)]
+    if max_size is not None:
+        cache_manager.set_quota(max_size, function=os.path.join(*keys))
+    keys = list(keys) + [hash_object(args, mmap_mode=None, exact=exact_hash)]
+    if inputs is None:
+        inputs = args if hasattr(args, 'items') else dict(zip(range(len(args)), args)) if isinstance(args, (tuple, list)) else {0: args}
     if on_ram:
-        cache_handle = RAMCacheHandle(os.path.join(env['CACHE_PATH'], *keys))
+        cache_handle = RAMCacheHandle(os.path.join(env['CACHE_PATH'], *keys), loader=loader, dumper=dumper, compress=compress, mmap_mode=mmap_mode,
+                                      describe=defer_describe_inputs(keys, inputs, exact_hash=exact_hash, code_version=code_version))
     else:
-        cache_handle = CacheHandle(os.path.join(env['CACHE_PATH'], *keys), loader=loader, dumper=dumper)
+        cache_handle = CacheHandle(os.path.join(env['CACHE_PATH'], *keys), loader=loader, dumper=dumper, compress=compress, mmap_mode=mmap_mode)
         inputs_path = cache_handle.entry("inputs.txt")
-        # TODO print input files top structures like dist / lists into an inputs.txt file
         if not inputs_path.exists():
-            with open(str(cache_handle.entry("inputs.txt")), "w") as inputs_file:
-                inputs_file.write("{}({})\n".format(
-                    ".".join(keys),
-                    ", ".join((  # *("[{}]{}".format(hash_object(a), repr(a)) for a in args[0]),
-                        # FIXIT: repr(val) bellow may take a long long time for big collections
-                        (f"[{hash_object(val)}]{name}={repr(val)}"
-                         for name, val in (args.items() if hasattr(args, 'items') else zip(range(len(args)), args)))))))
+            write_inputs(cache_handle, *describe_inputs(keys, inputs, exact_hash=exact_hash), code_version)
     return cache_handle
 
 
-global_no_cache = False
+def describe_inputs(keys, inputs, exact_hash=False):
+    """
+    Description of the inputs of a cache entry written to its inputs.txt file, and fingerprints of the inputs
+
+    Returns
+    -------
+    (str, dict)
+    """
+    fingerprints = {str(name): hash_object(val, exact=exact_hash) if val is not collected_input else None for name, val in inputs.items()}
+    # reprlib truncates the representations of big collections
+    text = "{}({})\n".format(
+        ".".join(keys),
+        ", ".join(f"[{fingerprints[str(name)]}]{name}={inputs_repr.repr(val)}" for name, val in inputs.items()))
+    return text, fingerprints
+
+
+class CollectedInput:
+    def __repr__(self):
+        return "<garbage collected>"
+
+
+collected_input = CollectedInput()
+
+
+def defer_describe_inputs(keys, inputs, exact_hash=False, code_version=None):
+    """
+    Function that describes the inputs of a cache entry (see `describe_inputs`) when it is called, for the entries
+    of the memory tier that are only written to the disk if they are demoted. The inputs that can be weakly
+    referenced are not kept alive, and are described as garbage collected if they are gone by then.
+
+    Returns
+    -------
+    callable
+        Returns (text, fingerprints, code_version)
+    """
+    names, refs, values = list(inputs), {}, {}
+    for name, val in inputs.items():
+        try:
+            refs[name] = weakref.ref(val)
+        except TypeError:
+            values[name] = val
+
+    def describe():
+        alive = {name: values[name] if name in values else refs[name]() for name in names}
+        alive = {name: collected_input if val is None and name in refs else val for name, val in alive.items()}
+        return (*describe_inputs(keys, alive, exact_hash=exact_hash), code_version)
+
+    return describe
+
+
+def write_inputs(cache_handle, text, fingerprints, code_version=None):
+    with open(str(cache_handle.entry("inputs.txt")), "w") as inputs_file:
+        inputs_file.write(text)
+    cache_manager.register(cache_handle, args=fingerprints, code_version=code_version)
+
+
+# Local to each thread and asyncio task: disabling the cache in a thread does not disable it in the others
+no_cache = contextvars.ContextVar("no_cache", default=False)
 
 
 @contextmanager
 def nocache():
-    global global_no_cache
-    last = global_no_cache
-    global_no_cache = True
-    yield
-    global_no_cache = last
+    token = no_cache.set(True)
+    try:
+        yield
+    finally:
+        no_cache.reset(token)
@@ -1,4 +1,4 @@
-from collections import Iterable, Sequence, Mapping
+from collections.abc import Iterable, Sequence, Mapping
 from logging import warn, warning
 
 import pandas as pd
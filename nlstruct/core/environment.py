@@ -2,6 +2,7 @@ import contextlib
 import importlib
 import inspect
 import os
+import sys
 import tempfile
 from os.path import expanduser
 from pathlib import Path, PureWindowsPath, PurePosixPath
@@ -20,6 +21,9 @@ class RelativePath(Path):
         _flavour = PurePosixPath._flavour
 
     def __new__(cls, *args, **kwargs):
+        if not hasattr(Path, "_init"):
+            # python >= 3.10 paths do not have an _init step anymore
+            return super(RelativePath, cls).__new__(cls, *args)
         self = cls._from_parts(args, init=False)
         if not self._flavour.is_supported:
             raise NotImplementedError("cannot instantiate %r on your system"
@@ -28,7 +32,11 @@ class RelativePath(Path):
         return self
 
     def __init__(self, *args, **kwargs):
-        super(RelativePath, self).__init__()
+        if sys.version_info >= (3, 12):
+            # python >= 3.12 paths are initialized from their parts in __init__
+            super(RelativePath, self).__init__(*args)
+        else:
+            super(RelativePath, self).__init__()
 
     def format(self, *args, **kwargs):
         return type(self)(str(self).format(*args, **kwargs))
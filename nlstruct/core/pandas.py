@@ -1,9 +1,10 @@
-from collections import defaultdict, Sized
+from collections import defaultdict
+from collections.abc import Sized
 
 import numpy as np
 import pandas as pd
 from pandas._libs.lib import fast_zip
-from pandas._libs.parsers import union_categoricals
+from pandas.api.types import union_categoricals
 from pandas.core.dtypes.common import is_numeric_dtype
 from scipy.sparse import csr_matrix
 from scipy.sparse.csgraph._traversal import connected_components
@@ -220,3 +220,106 @@ def extract_slices(sequences, flat_begins, flat_ends, flat_sample_idx):
         return {k: seq[mentions_from_sequences_row_indexer, mentions_from_sequences_col_indexer] for k, seq in sequences.items()}, mask
     print("Cannot be here, already raised and exception")
 
+
+def distributed_is_initialized():
+    return torch.distributed.is_available() and torch.distributed.is_initialized()
+
+
+def get_rank():
+    """Rank of the current process, 0 if not distributed"""
+    return torch.distributed.get_rank() if distributed_is_initialized() else 0
+
+
+def get_world_size():
+    """Number of processes, 1 if not distributed"""
+    return torch.distributed.get_world_size() if distributed_is_initialized() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init_distributed(backend="gloo", init_method="env://", **kwargs):
+    """
+    Initialize the default process group (from the MASTER_ADDR, MASTER_PORT, RANK and WORLD_SIZE
+    environment variables by default), if it is not already initialized
+    """
+    if not distributed_is_initialized():
+        torch.distributed.init_process_group(backend=backend, init_method=init_method, **kwargs)
+    return get_rank(), get_world_size()
+
+
+def barrier():
+    if get_world_size() > 1:
+        torch.distributed.barrier()
+
+
+def all_reduce_gradients(net):
+    """
+    Average the gradients of the parameters across processes. Dense gradients are flattened
+    into one buffer per dtype to make a single all_reduce call for each of them. Parameters
+    that did not receive a gradient in this process get a zero gradient, so that every process
+    reduces buffers of the same layout.
+
+    Parameters
+    ----------
+    net: torch.nn.Module or iterable of torch.nn.Parameter
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return
+    params = net.parameters() if hasattr(net, 'parameters') else net
+    grads_by_dtype = {}
+    for param in params:
+        if not param.requires_grad:
+            continue
+        if param.grad is None:
+            param.grad = torch.zeros_like(param)
+        if param.grad.is_sparse:
+            torch.distributed.all_reduce(param.grad)
+            param.grad /= world_size
+        else:
+            grads_by_dtype.setdefault(param.grad.dtype, []).append(param.grad)
+    for grads in grads_by_dtype.values():
+        flat = torch.cat([grad.reshape(-1) for grad in grads])
+        torch.distributed.all_reduce(flat)
+        flat /= world_size
+        for grad, reduced in zip(grads, flat.split([grad.numel() for grad in grads])):
+            grad.copy_(reduced.view_as(grad))
+
+
+def broadcast_parameters(net, src=0):
+    """
+    Copy the parameters and buffers of the process `src` to the other processes
+
+    Parameters
+    ----------
+    net: torch.nn.Module
+    src: int
+    """
+    if get_world_size() == 1:
+        return
+    for tensor in net.state_dict().values():
+        if torch.is_tensor(tensor):
+            torch.distributed.broadcast(tensor, src)
+
+
+def all_reduce_scores(scores):
+    """
+    Average the numeric scores across processes, so that every process sees the same scores
+
+    Parameters
+    ----------
+    scores: dict
+
+    Returns
+    -------
+    dict
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return scores
+    names = sorted(name for name, score in scores.items() if isinstance(score, (int, float)) and not isinstance(score, bool))
+    values = torch.tensor([float(scores[name]) for name in names], dtype=torch.float64)
+    torch.distributed.all_reduce(values)
+    return {**scores, **dict(zip(names, (values / world_size).tolist()))}
@@ -3,13 +3,14 @@ import time
 
 import regex
 import sh
+import torch
 
 from nlstruct.core.cache import yaml_load, yaml_dump
 from nlstruct.core.collections import set_deep_attr
 from nlstruct.core.logging import TrainingLogger
 from nlstruct.core.random import seed_all
 from nlstruct.core.schedule import ConcatSchedule
-from nlstruct.core.torch import torch_global as tg
+from nlstruct.core.torch import torch_global as tg, all_reduce_gradients, all_reduce_scores, barrier, broadcast_parameters, is_main_process, training
 
 
 class TrainingState(object):
@@ -87,6 +88,52 @@ def make_optimizer_and_schedules(net, optim_factory, optim_params, names, num_it
     return optim, schedules
 
 
+def train_epoch(net, optim, loader, loss_fn, schedules=None, epoch=None):
+    """
+    Train the network for one epoch over the loader
+    When the default torch.distributed process group is initialized, the gradients are averaged across
+    processes before each optimizer step, and the returned loss is averaged over all processes
+
+    Parameters
+    ----------
+    net: torch.nn.Module
+    optim: torch.optim.Optimizer
+    loader: iterable of Batcher
+        For instance `batcher.dataloader(batch_size=32, shuffle=True, distributed=True)`
+    loss_fn: callable
+        Function that takes a batch and returns its loss
+    schedules: dict
+        Schedules to step after each optimizer step (see `make_optimizer_and_schedules`)
+    epoch: int
+        Epoch given to the `set_epoch` method of the sampler of the loader, if it has one
+
+    Returns
+    -------
+    dict
+        {"train_loss": mean loss of the samples}
+    """
+    if epoch is not None:
+        torch_loader = getattr(loader, 'loader', loader)
+        for sampler in (getattr(torch_loader, 'batch_sampler', None), getattr(torch_loader, 'sampler', None)):
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(epoch)
+    total_loss = 0
+    total_size = 0
+    with training(net):
+        for batch in loader:
+            optim.zero_grad()
+            loss = loss_fn(batch)
+            loss.backward()
+            all_reduce_gradients(net)
+            optim.step()
+            for schedule in (schedules or {}).values():
+                schedule.step()
+            total_loss += loss.item() * len(batch)
+            total_size += len(batch)
+    totals = all_reduce_scores({"loss": total_loss, "size": total_size})
+    return {"train_loss": totals["loss"] / max(totals["size"], 1)}
+
+
 def run_optimization(
       main_score,
       metrics_info,
@@ -104,6 +151,7 @@ def run_optimization(
       cache_policy="all",
       with_writer=False,
       seed=42,
+      pin_checkpoints=False,
 ):
     if state is None:
         state = {}
@@ -136,6 +184,12 @@ def run_optimization(
     assert state.setdefault("epoch", 0) == 0, "Init epoch must be 0"
     dumps = {}
 
+    # In distributed training, every process starts from the parameters of the first one, and only the
+    # first process writes the history and the checkpoints (that the others read from the same cache)
+    for persistable in state.values():
+        if isinstance(persistable, torch.nn.Module):
+            broadcast_parameters(persistable)
+
     while monitor.keep_going:
         # Example 1: monitor.epoch = 12, state["epoch"] = 7, len(history) == 12
         # -> no more scores in history: we must train the model, so we go the "else"
@@ -165,7 +219,7 @@ def run_optimization(
             # Iterate over state["epoch"] (11, 12)
             # region train until required epoch
             while state["epoch"] < monitor.epoch + 1:
-                if writer is None and with_writer and cache is not None:
+                if writer is None and with_writer and cache is not None and is_main_process():
                     from tensorboardX import SummaryWriter
                     writer = SummaryWriter(logdir=cache.entry('logs'))
 
@@ -176,6 +230,8 @@ def run_optimization(
                     epoch_scores = epoch_fn(writer)
                 else:
                     epoch_scores = epoch_fn()
+                # All processes must see the same scores to take the same decisions
+                epoch_scores = all_reduce_scores(epoch_scores)
 
                 time_end = time.time()
                 scores = {
@@ -195,7 +251,7 @@ def run_optimization(
             # region update training state and dump model and history
         history = history[:monitor.epoch] + [scores] + history[monitor.epoch + 1:]
         monitor.record(scores[main_score])
-        if "write_history" in cache_policy:
+        if "write_history" in cache_policy and is_main_process():
             cache.dump(history, "history.yaml", dumper=yaml_dump)
         if model_has_been_trained:
             dump_dict = {}
@@ -205,13 +261,21 @@ def run_optimization(
                 else:
                     dump_dict[name] = persistable
             if "write_checkpoints" in cache_policy:
-                dumps[state["epoch"]] = cache.dump(dump_dict, dest="checkpoint-{}.pt".format(state["epoch"]))
-        # Delete other dumps except the best one
+                if is_main_process():
+                    dumps[state["epoch"]] = cache.dump(dump_dict, dest="checkpoint-{}.pt".format(state["epoch"]))
+                    # Protect the checkpoints of an unfinished run from the eviction of the least recently used cache
+                    # entries, so that it can be resumed. The entry is unpinned once the run is complete.
+                    if pin_checkpoints and hasattr(cache, "pin"):
+                        cache.pin()
+                # Wait for the checkpoint to be written before other processes may read it
+                barrier()
+        # Delete other dumps except the best one (dumps are only recorded by the first process)
         for dump_epoch, dest in list(dumps.items()):
             if dump_epoch <= state["epoch"] - n_save_checkpoints and dump_epoch != monitor.best_epoch:
                 sh.rm(dest)
                 dumps.pop(dump_epoch)
-        score_logger.display({"epoch": monitor.epoch, **scores})
+        if is_main_process():
+            score_logger.display({"epoch": monitor.epoch, **scores})
     if state["epoch"] != monitor.best_epoch and "read_checkpoints" in cache_policy:
         dumped = cache.load(f"checkpoint-{str(monitor.best_epoch)}.pt", map_location=tg.device) if cache is not None else None
         if dumped is not None:
@@ -224,4 +288,6 @@ def run_optimization(
                     state[name] = dumped[name]
         else:
             print(f"Could not restore model to its best state: {monitor.best_epoch}")
+    if pin_checkpoints and "write_checkpoints" in cache_policy and hasattr(cache, "unpin") and is_main_process():
+        cache.unpin()
     return {**history[monitor.best_epoch - 1], "best_epoch": monitor.best_epoch}
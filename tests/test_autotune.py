@@ -0,0 +1,22 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from nlstruct.core.autotune import child_pids, peak_rss
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/status"), reason="child processes are only measured on Linux")
+def test_peak_rss_counts_child_processes():
+    size = 100 * 2 ** 20
+    child = subprocess.Popen(
+        [sys.executable, "-c", f"import sys; data = bytearray({size}); data[::4096] = bytes(len(data[::4096])); print(flush=True); sys.stdin.read()"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    try:
+        child.stdout.readline()
+        assert child.pid in child_pids()
+        assert peak_rss() - peak_rss(children=False) >= size
+    finally:
+        child.stdin.close()
+        child.wait()
@@ -0,0 +1,224 @@
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+from scipy.sparse import csr_matrix, issparse
+
+from nlstruct.core.batcher import Batcher, BatcherShardWriter, ShardedBatcherDataset, factorize, flatten_array, torch_factorize
+from nlstruct.core.pandas import df_to_csr, factorize_rows
+
+
+def make_batcher(foreign_ids):
+    # Ids are equal to row numbers, so that the same columns are valid in relative and absolute modes
+    return Batcher({
+        "doc": {
+            "doc_id": np.arange(5),
+            "x": np.arange(5) * 10,
+            "token": csr_matrix(np.arange(15).reshape(5, 3)),
+            "token_mask": csr_matrix(np.ones((5, 3), dtype=bool)),
+            # Built from coordinates to keep the explicit zero id of the first mention
+            "mention_id": csr_matrix((np.arange(5), ([0, 1, 1, 3, 4], [0, 0, 1, 0, 0])), shape=(5, 2)),
+            "mention_mask": csr_matrix((np.ones(5, dtype=bool), ([0, 1, 1, 3, 4], [0, 0, 1, 0, 0])), shape=(5, 2)),
+        },
+        "mention": {
+            "mention_id": np.arange(5),
+            "doc_id": np.array([0, 1, 1, 3, 4]),
+            "label": np.array([7, 8, 9, 10, 11]),
+        }},
+        masks={"doc": {"token": "token_mask", "mention_id": "mention_mask"}},
+        foreign_ids=foreign_ids)
+
+
+@pytest.mark.parametrize("foreign_ids", ["relative", "absolute"])
+def test_view_is_not_changed_by_parent_assignments(foreign_ids):
+    b = make_batcher(foreign_ids)
+    v = b[[1, 2]]
+    b["doc", "x"] = -np.arange(5)
+    b["mention", "label"] = np.zeros(5, dtype=int)
+    del b["doc", "token"]
+    assert v["doc", "x"].tolist() == [10, 20]
+    assert v["mention", "label"].tolist() == [8, 9]
+    assert v["doc", "token"].toarray().tolist() == [[3, 4, 5], [6, 7, 8]]
+
+
+@pytest.mark.parametrize("foreign_ids", ["relative", "absolute"])
+def test_gather_view_of_view(foreign_ids):
+    b = make_batcher(foreign_ids)
+    v = b[[4, 1, 3]][[1, 2]]
+    b["doc", "x"] = -np.arange(5)
+    v.gather()
+    assert not v.is_view
+    assert v["doc", "doc_id"].tolist() == [1, 3]
+    assert v["doc", "x"].tolist() == [10, 30]
+    assert v["mention", "label"].tolist() == [8, 9, 10]
+    assert v.switch_foreign_ids_mode("relative")["mention", "doc_id"].tolist() == [0, 0, 1]
+
+
+def test_torch_factorize_matches_pandas():
+    values = np.random.RandomState(0).randint(-5, 20, size=100)
+    codes, uniques = torch_factorize(torch.as_tensor(values))
+    expected_codes, expected_uniques = pd.factorize(values)
+    assert codes.tolist() == expected_codes.tolist()
+    assert uniques.tolist() == expected_uniques.tolist()
+    codes, uniques = torch_factorize(torch.as_tensor(values[:0]))
+    assert len(codes) == 0 and len(uniques) == 0
+
+
+@pytest.mark.parametrize("freeze_reference", [True, False])
+def test_factorize_tensors_matches_numpy(freeze_reference):
+    values = np.array([[4, 2, 9], [2, 7, 0]])
+    mask = np.array([[True, True, True], [True, True, False]])
+    reference_values = np.array([7, 2, 5])
+    expected = factorize(values, mask, reference_values, freeze_reference=freeze_reference)
+    result = factorize(torch.as_tensor(values), torch.as_tensor(mask), torch.as_tensor(reference_values), freeze_reference=freeze_reference)
+    for expected_item, item in zip(expected, result):
+        assert torch.is_tensor(item)
+        assert item.tolist() == expected_item.tolist()
+
+
+def test_flatten_array_and_query_table_keep_tensors():
+    array = torch.arange(6).view(2, 3)
+    mask = torch.as_tensor([[True, False, True], [False, True, False]])
+    assert flatten_array(array, mask).tolist() == [0, 2, 4]
+    table = Batcher.query_table({"x": array, "mask": mask}, torch.as_tensor([1]))
+    assert all(torch.is_tensor(col) for col in table.values())
+    assert table["x"].tolist() == [[3, 4, 5]]
+
+
+@pytest.mark.parametrize("ids", [[3, 1], [0, 2], [2]])
+def test_query_ids_on_dense_tensors_matches_numpy(ids):
+    b = make_batcher("relative")
+    expected = b.query_ids(ids).densify()
+    result = b.densify(device=torch.device("cpu")).query_ids(ids)
+    for table_name, table in expected.tables.items():
+        for col_name, col in table.items():
+            assert torch.is_tensor(result[table_name, col_name])
+            # Masks are cut after their last active column, like sparse masks
+            assert result[table_name, col_name].tolist() == np.asarray(col).tolist()
+
+
+@pytest.mark.parametrize("sparsify", [True, False])
+def test_concat_offsets_filled_primary_ids(sparsify):
+    b = make_batcher("relative").densify()
+    batches = []
+    for ids in ([0, 1], [3, 4]):
+        batch = b.query_ids(ids)
+        del batch["doc", "doc_id"]
+        del batch["mention", "mention_id"]
+        batches.append(batch)
+    res = Batcher.concat(batches, sparsify=sparsify)
+    assert res.foreign_ids["mention"]["doc_id"] == ("doc", "absolute")
+    assert res["doc", "doc_id"].tolist() == [0, 1, 2, 3]
+    assert res["mention", "mention_id"].tolist() == [0, 1, 2, 3, 4]
+    assert res["mention", "doc_id"].tolist() == [0, 1, 1, 2, 3]
+    assert res["mention", "label"].tolist() == [7, 8, 9, 10, 11]
+    mention_ids = res["doc", "mention_id"]
+    mention_mask = res["doc", "mention_mask"]
+    if sparsify:
+        mention_ids, mention_mask = mention_ids.toarray(), mention_mask.toarray()
+    assert np.where(mention_mask, mention_ids, -1).tolist() == [[0, -1], [1, 2], [3, -1], [4, -1]]
+
+
+def test_concat_nothing():
+    with pytest.raises(ValueError):
+        Batcher.concat([])
+
+
+def test_sharded_dataset_does_not_use_global_random_state(tmp_path):
+    b = make_batcher("relative")
+    writer = BatcherShardWriter(str(tmp_path))
+    for ids in ([0, 1, 2], [3, 4]):
+        writer.write(b.query_ids(ids))
+    dataset = ShardedBatcherDataset(str(tmp_path), batch_size=2, shuffle=True, sparse_sort_on="token_mask")
+    all_batches = []
+    for global_seed in (1, 2):
+        np.random.seed(global_seed)
+        state = np.random.get_state()[1].copy()
+        all_batches.append([batch["doc", "doc_id"].tolist() for batch in dataset])
+        assert np.array_equal(np.random.get_state()[1], state)
+    assert all_batches[0] == all_batches[1]
+    assert sorted(doc_id for batch in all_batches[0] for doc_id in batch) == [0, 1, 2, 3, 4]
+
+
+def make_ner_frames():
+    tokens = pd.DataFrame({
+        "doc_id": ["b", "b", "a", "a", "a", "c"],
+        "token_idx": [0, 1, 0, 1, 2, 0],
+        "token_norm": pd.Categorical(["the", "cat", "a", "dog", "barks", "hi"]),
+        "tag": pd.Categorical(["O", "B", "O", "B", "O", "O"]),
+        "token_charset_id": ["the", "cat", "a", "dog", "barks", "hi"],
+    })
+    mentions = pd.DataFrame({
+        "doc_id": ["b", "a", "a"],
+        "mention_id": ["m1", "m2", "m3"],
+        "idx": [0, 0, 1],
+        "begin": [4, 2, 0],
+        "end": [7, 5, 1],
+        "category": pd.Categorical(["animal", "animal", "det"]),
+    })
+    words = ["the", "cat", "a", "dog", "barks", "hi"]
+    charsets = pd.DataFrame({
+        "token_charset_id": [word for word in words for _ in word],
+        "char_idx": [i for word in words for i in range(len(word))],
+        "char": pd.Categorical([char for word in words for char in word]),
+    })
+    return {"tokens": tokens, "mentions": mentions, "charsets": charsets}
+
+
+NER_SCHEMA = {
+    "doc": {"id": "doc_id", "nested": {
+        "tokens": {"columns": {"token_norm": "token_norm", "token_charset_id": "token_charset_id", "token_tag": "tag"}, "position": "token_idx", "mask": "token_mask"},
+        "mentions": {"columns": {"mention_id": "mention_id"}, "position": "idx", "mask": "mention_mask"}}},
+    "token_charset": {"id": "token_charset_id", "nested": {"charsets": {"columns": {"char": "char"}, "position": "char_idx", "mask": "mask"}}},
+    "mention": {"id": "mention_id", "frame": "mentions", "columns": {"doc_id": "doc_id", "begin": "begin", "end": "end", "category": "category"}},
+}
+
+
+def test_from_dataset_matches_hand_built_batcher():
+    batcher = Batcher.from_dataset(make_ner_frames(), NER_SCHEMA).prepare_for_indexing()
+
+    # Batcher built column by column, as in the end_to_end_char_ner notebook
+    frames = make_ner_frames()
+    tokens, mentions, charsets = frames["tokens"], frames["mentions"], frames["charsets"]
+    [tokens["doc_id"], mentions["doc_id"]], unique_doc_ids = factorize_rows([tokens["doc_id"], mentions["doc_id"]])
+    [mentions["mention_id"]], unique_mention_ids = factorize_rows([mentions["mention_id"]])
+    [charsets["token_charset_id"], tokens["token_charset_id"]], unique_charset_ids = factorize_rows([charsets["token_charset_id"], tokens["token_charset_id"]])
+    expected = Batcher({
+        "doc": {
+            "token_norm": df_to_csr(tokens["doc_id"], tokens["token_idx"], tokens["token_norm"].cat.codes, n_rows=len(unique_doc_ids)),
+            "token_charset_id": df_to_csr(tokens["doc_id"], tokens["token_idx"], tokens["token_charset_id"], n_rows=len(unique_doc_ids)),
+            "token_tag": df_to_csr(tokens["doc_id"], tokens["token_idx"], tokens["tag"].cat.codes, n_rows=len(unique_doc_ids)),
+            "token_mask": df_to_csr(tokens["doc_id"], tokens["token_idx"], n_rows=len(unique_doc_ids)),
+            "mention_id": df_to_csr(mentions["doc_id"], mentions["idx"], mentions["mention_id"], n_rows=len(unique_doc_ids)),
+            "mention_mask": df_to_csr(mentions["doc_id"], mentions["idx"], n_rows=len(unique_doc_ids)),
+        },
+        "token_charset": {
+            "char": df_to_csr(charsets["token_charset_id"], charsets["char_idx"], charsets["char"].cat.codes),
+            "mask": df_to_csr(charsets["token_charset_id"], charsets["char_idx"]),
+        },
+        "mention": {
+            "mention_id": mentions["mention_id"],
+            "doc_id": mentions["doc_id"],
+            "begin": mentions["begin"],
+            "end": mentions["end"],
+            "category": mentions["category"].cat.codes,
+        }},
+        masks={"doc": {"token_charset_id": "token_mask", "token_norm": "token_mask", "token_tag": "token_mask", "mention_id": "mention_mask"},
+               "token_charset": {"char": "mask"}},
+        foreign_ids="absolute").prepare_for_indexing()
+
+    assert batcher.masks == expected.masks
+    for table_name, table in expected.tables.items():
+        assert sorted(batcher.tables[table_name]) == sorted(table)
+        for col_name, col in table.items():
+            result = batcher[table_name, col_name]
+            assert issparse(result) == issparse(col)
+            if issparse(col):
+                result, col = result.toarray(), col.toarray()
+            assert np.asarray(result).tolist() == np.asarray(col).tolist(), (table_name, col_name)
+
+
+def test_from_dataset_rejects_nested_column_lists():
+    schema = {"doc": {"id": "doc_id", "nested": {"tokens": {"columns": {"tok": ["token_idx", "token_norm"]}}}}}
+    with pytest.raises(Exception, match="only allowed in the 'columns'"):
+        Batcher.from_dataset(make_ner_frames(), schema)
@@ -0,0 +1,168 @@
+import copy
+import json
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+
+from nlstruct.cache import main as cache_cli
+from nlstruct.core.cache import TruncatedNumpyHasher, cache_manager, cached, fingerprint_registry, get_cache, get_entry_size, hash_object
+
+
+def test_rehash_after_inplace_numpy_write():
+    array = np.arange(10)
+    before = hash_object(array)
+    array[3] = 100
+    assert hash_object(array) != before
+
+
+def test_rehash_after_inplace_dataframe_write():
+    df = pd.DataFrame({"x": np.arange(10), "y": np.arange(10.)})
+    before = hash_object(df)
+    df.loc[0, "x"] = 99
+    assert hash_object(df) != before
+
+
+def test_rehash_after_untracked_tensor_writes():
+    param = torch.nn.Parameter(torch.zeros(10))
+    before = hash_object(param)
+    param.data[0] = 1
+    after_data = hash_object(param)
+    assert after_data != before
+    param.detach().numpy()[1] = 1
+    assert hash_object(param) != after_data
+
+
+def test_read_only_arrays_are_memoized():
+    array = np.arange(10)
+    array.flags.writeable = False
+    digest = hash_object(array)
+    assert fingerprint_registry.get(array, (2000, False)) is not None
+    assert hash_object(array) == digest
+    assert fingerprint_registry.get(np.arange(10), (2000, False)) is None
+
+
+class Counter:
+    def __init__(self):
+        self.calls = 0
+
+    @cached
+    def double(self, x):
+        self.calls += 1
+        return x * 2
+
+
+def test_bound_cached_method_copy_and_pickle():
+    method = Counter().double
+    assert copy.copy(method).instance is method.instance
+    restored = pickle.loads(pickle.dumps(method))
+    assert type(restored.instance) is Counter
+    assert restored.__name__ == "double"
+    assert restored.nocache(3) == 6
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("CACHE_PATH", str(tmp_path))
+    monkeypatch.setattr(cache_manager, "max_size", None)
+    monkeypatch.setattr(cache_manager, "max_size_per_function", None)
+    monkeypatch.setattr(cache_manager, "function_quotas", {})
+    return tmp_path
+
+
+def test_quota_evicts_unpinned_entries(cache_dir, monkeypatch):
+    old = get_cache("test/f", {"x": 1})
+    old.dump(np.zeros(1000))
+    pinned = get_cache("test/f", {"x": 2})
+    pinned.dump(np.zeros(1000))
+    pinned.pin()
+    monkeypatch.setattr(cache_manager, "max_size", 20000)
+    new = get_cache("test/f", {"x": 3})
+    new.dump(np.zeros(2000))
+    assert not os.path.exists(str(old))
+    assert os.path.exists(str(pinned)) and os.path.exists(str(new))
+    assert {entry["path"] for entry in cache_manager.index.select()} == {"test/f/" + os.path.basename(str(handle)) for handle in (pinned, new)}
+
+
+def test_checkpoint_round_trip(cache_dir):
+    model = torch.nn.Linear(3, 2)
+    cache = get_cache("test/checkpoints", {"seed": 0})
+    cache.dump({"model": model.state_dict(), "epoch": 3}, dest="checkpoint-3.pt")
+    dumped = cache.load("checkpoint-3.pt", map_location=torch.device("cpu"))
+    assert dumped["epoch"] == 3
+    restored = torch.nn.Linear(3, 2)
+    restored.load_state_dict(dumped["model"])
+    assert torch.equal(restored.weight, model.weight) and torch.equal(restored.bias, model.bias)
+
+
+@pytest.fixture
+def hashed_frames(monkeypatch):
+    hashed = []
+    save_dataframe_data = TruncatedNumpyHasher.save_dataframe_data
+
+    def save_and_record(self, obj):
+        hashed.append(obj)
+        save_dataframe_data(self, obj)
+
+    monkeypatch.setattr(TruncatedNumpyHasher, "save_dataframe_data", save_and_record)
+    return hashed
+
+
+def test_frozen_fingerprint_until_invalidated(hashed_frames):
+    frame = pd.DataFrame({"x": np.arange(10)})
+    assert fingerprint_registry.freeze(frame)
+    digest = hash_object(frame)
+    assert hash_object([frame, frame]) == hash_object([frame, frame])
+    assert len(hashed_frames) == 1
+    frame.loc[0, "x"] = 99
+    assert hash_object(frame) == digest
+    fingerprint_registry.invalidate(frame)
+    assert hash_object(frame) != digest
+    assert len(hashed_frames) == 2
+
+
+@cached(memoize_fingerprints=True)
+def make_frame(n):
+    return pd.DataFrame({"x": np.arange(n)})
+
+
+@cached(memoize_fingerprints=True)
+def frame_total(frame):
+    return pd.DataFrame({"total": [frame["x"].sum()]})
+
+
+def test_chained_cached_calls_reuse_digests(cache_dir, hashed_frames):
+    frame = make_frame(10)
+    assert frame_total(frame)["total"].tolist() == [45]
+    # The second result is loaded from the cache, and gets the same fingerprint as the computed one
+    loaded = make_frame(10)
+    assert loaded is not frame
+    assert hash_object(loaded) == hash_object(frame)
+    assert frame_total(loaded)["total"].tolist() == [45]
+    assert len(os.listdir(os.path.join(str(cache_dir), *frame_total.keys))) == 1
+    assert hashed_frames == []
+
+
+def test_cli_sizes_are_recorded_once_complete(cache_dir, capsys):
+    handle = get_cache("test/cli", {"x": 1})
+    path = "test/cli/" + os.path.basename(str(handle))
+
+    def query():
+        capsys.readouterr()
+        assert cache_cli(["query"]) == 0
+        return {entry["path"]: entry for entry in map(json.loads, capsys.readouterr().out.splitlines())}
+
+    # The output is not written yet: the entry is not measured, even after a reindex
+    assert query()[path]["size"] is None
+    assert cache_cli(["reindex"]) == 0
+    assert query()[path]["size"] is None
+    handle.dump(np.zeros(1000))
+    assert query()[path]["size"] == get_entry_size(str(handle)) > 8000
+    assert cache_cli(["reindex"]) == 0
+    assert query()[path]["size"] == get_entry_size(str(handle))
+    capsys.readouterr()
+    assert cache_cli(["size"]) == 0
+    assert "test/cli" in capsys.readouterr().out